@@ -1,3 +1,5 @@
+import multiprocessing
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from src.config import Config
@@ -5,7 +7,7 @@ from src.config import Config
 
 db = SQLAlchemy()
 
-def create_app(config_class=Config):
+def create_app(config_class=Config, start_background=True):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
@@ -13,4 +15,21 @@ def create_app(config_class=Config):
     from src.apps.routes.main import main as main_bp
     app.register_blueprint(main_bp)
 
-    return app
\ No newline at end of file
+    if start_background:
+        start_background_tasks(app)
+
+    return app
+
+
+def start_background_tasks(app):
+    # 编译进程池等 multiprocessing 子进程（spawn 会重新导入主模块）不启动任务队列和预热
+    if multiprocessing.parent_process() is not None:
+        return
+
+    # 恢复并启动异步任务队列（队列在服务模块导入时注册）
+    from src.apps.utils.job_queue import start_job_queues
+    start_job_queues(app)
+
+    # 后台预热规则集，/ready 报告预热进度
+    from src.apps.utils.warmup import start_warmup
+    start_warmup(app)
@@ -1,5 +1,5 @@
 import json
-from flask import Blueprint, jsonify, request,Response
+from flask import Blueprint, jsonify, request,Response, stream_with_context
 
 from src.apps.services.CnvdDataInfoImpl import getVulnByCnvdId,delVulnCnvd,insVulnCnvd,updateVulnCnvd
 from src.apps.services.CveDataInfoImpl import getVulnByCveId,delVulnCve,insVulnCve,updateVulnCve
@@ -10,9 +10,13 @@ from src.apps.services.AffectDataInfoImpl import  getAffectById,insaffect
 from src.apps.services.AtkMsgDataInfoImpl import  getAtkMsgById,delMsg,insAtkMsg
 from src.apps.services.UsedDataInfoImpl import  getUsedById,delUsed,insUsed
 from src.apps.services.MalYaraUpload import MalYaraUpload
+from src.apps.services.MalYaraLint import MalYaraLint
+from src.apps.services.MalYaraProfile import MalYaraProfile
+from src.apps.services.MalYaraArtifact import MalYaraArtifact
 from src.apps.services.MalSigmaUpload import MalSigmaUpload
 from src.apps.services.MalSigmaScan import MalSigmaScan
 from src.apps.services.MalYaraScan import MalYaraScan
+from src.apps.utils.warmup import readiness
 
 main = Blueprint('main', __name__)
 
@@ -20,6 +24,16 @@ main = Blueprint('main', __name__)
 def index():
     return jsonify({"message": "Welcome to the API"})
 
+# 负载均衡就绪检查：规则集预热完成前返回 503
+# 默认只看必需项（YARA）；?item=sigma_ruleset 可单独检查指定项
+@main.route("/ready", methods=["GET"])
+def ready():
+    try:
+        data = readiness(request.args.getlist("item"))
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+    return jsonify({"ok": data["ready"], **data}), (200 if data["ready"] else 503)
+
 #yara upload
 @main.route("/uploadYaraRule", methods=["POST"])
 def upload_yara_rule():
@@ -41,6 +55,46 @@ def upload_yara_rule_zip():
     except Exception as e:
         return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
 
+@main.route("/setYaraRuleEnabled", methods=["POST"])
+def set_yara_rule_enabled():
+    try:
+        rule_id = request.form.get("rule_id")
+        enabled = request.form.get("enabled", "1") in ("1", "true", "True")
+        data = MalYaraUpload.set_rule_enabled(rule_id, enabled)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+@main.route("/migrateYaraArtifacts", methods=["POST"])
+def migrate_yara_artifacts():
+    try:
+        clear_db = request.form.get("clear_db", "0") in ("1", "true", "True")
+        data = MalYaraArtifact.migrate(clear_db)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+@main.route("/yaraSlowRules", methods=["GET"])
+def yara_slow_rules():
+    try:
+        limit = request.args.get("limit", 100)
+        flagged_only = request.args.get("all", "0") not in ("1", "true", "True")
+        data = MalYaraLint.list_slow_rules(limit, flagged_only)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+# 慢规则人工确认：按 rule_sha256 启用 / 停用单条规则
+@main.route("/setYaraSlowRuleEnabled", methods=["POST"])
+def set_yara_slow_rule_enabled():
+    try:
+        rule_sha256 = request.form.get("rule_sha256")
+        enabled = request.form.get("enabled", "1") in ("1", "true", "True")
+        data = MalYaraLint.set_rule_enabled(rule_sha256, enabled)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
 #sigma upload
 @main.route("/uploadSigmaRuleYaml", methods=["POST"])
 def upload_sigma_json():
@@ -81,6 +135,41 @@ def detect_evtx_with_sigma():
     except Exception as e:
         return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
 
+@main.route("/submitSigmaDetectJob", methods=["POST"])
+def submit_sigma_detect_job():
+    try:
+        f = request.files.get("file")
+        label = request.form.get("label", "")
+        rule_set = request.form.get("rule_set", "enabled")
+        return_level = request.form.get("return_level", "summary")
+
+        data = MalSigmaScan.submit_detect_job(
+            f,
+            label=label,
+            rule_set=rule_set,
+            return_level=return_level
+        )
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+@main.route("/sigmaDetectJobStatus/<log_id>", methods=["GET"])
+def sigma_detect_job_status(log_id):
+    try:
+        return jsonify(MalSigmaScan.detect_job_status(log_id))
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+@main.route("/sigmaDetectJobResult/<log_id>", methods=["GET"])
+def sigma_detect_job_result(log_id):
+    try:
+        data = MalSigmaScan.detect_job_result(log_id)
+        # 任务未完成返回 202，客户端继续轮询
+        http = 202 if data.get("code") == "JOB_NOT_FINISHED" else 200
+        return jsonify(data), http
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
 #yara scan
 @main.route("/scanSampleWithYara", methods=["POST"])
 def scan_sample_with_yara():
@@ -88,11 +177,15 @@ def scan_sample_with_yara():
         f = request.files.get("file")
         label = request.form.get("label", "")
         rule_set = request.form.get("rule_set", "enabled")
+        mode = request.form.get("mode", "full")
+        selector = request.form.get("selector", "")
 
         data = MalYaraScan.scan_sample_with_yara(
             f,
             label=label,
-            rule_set=rule_set
+            rule_set=rule_set,
+            mode=mode,
+            selector=selector
         )
         return jsonify(data)
     except Exception as e:
@@ -101,11 +194,129 @@ def scan_sample_with_yara():
         http = 400
         if msg == "FILE_TOO_LARGE":
             code = "FILE_TOO_LARGE"
-        elif msg == "SCAN_TIMEOUT":
-            code = "SCAN_TIMEOUT"
         return jsonify({"ok": False, "code": code, "message": msg}), http
 
 
+@main.route("/scanSamplesWithYara", methods=["POST"])
+def scan_samples_with_yara():
+    try:
+        files = request.files.getlist("files") or request.files.getlist("file")
+        label = request.form.get("label", "")
+        rule_set = request.form.get("rule_set", "enabled")
+        mode = request.form.get("mode", "full")
+        selector = request.form.get("selector", "")
+
+        items = MalYaraScan.scan_samples_with_yara(
+            files,
+            label=label,
+            rule_set=rule_set,
+            mode=mode,
+            selector=selector,
+            labels=request.form.getlist("labels")
+        )
+        # NDJSON：每扫完一个样本输出一行
+        lines = (json.dumps(item, ensure_ascii=False) + "\n" for item in items)
+        return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+@main.route("/scanArchiveWithYara", methods=["POST"])
+def scan_archive_with_yara():
+    try:
+        f = request.files.get("file")
+        label = request.form.get("label", "")
+        rule_set = request.form.get("rule_set", "enabled")
+        mode = request.form.get("mode", "full")
+        selector = request.form.get("selector", "")
+        max_depth = request.form.get("max_depth") or None
+
+        items = MalYaraScan.scan_archive_with_yara(
+            f,
+            label=label,
+            rule_set=rule_set,
+            mode=mode,
+            max_depth=max_depth,
+            selector=selector
+        )
+        # NDJSON：每扫完一个成员输出一行
+        lines = (json.dumps(item, ensure_ascii=False) + "\n" for item in items)
+        return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+@main.route("/submitYaraScanJob", methods=["POST"])
+def submit_yara_scan_job():
+    try:
+        f = request.files.get("file")
+        label = request.form.get("label", "")
+        rule_set = request.form.get("rule_set", "enabled")
+        mode = request.form.get("mode", "full")
+        selector = request.form.get("selector", "")
+
+        data = MalYaraScan.submit_scan_job(
+            f,
+            label=label,
+            rule_set=rule_set,
+            mode=mode,
+            selector=selector
+        )
+        return jsonify(data)
+    except Exception as e:
+        msg = str(e)
+        code = "FILE_TOO_LARGE" if msg == "FILE_TOO_LARGE" else "BAD_REQUEST"
+        return jsonify({"ok": False, "code": code, "message": msg}), 400
+
+@main.route("/yaraScanJobStatus/<sample_id>", methods=["GET"])
+def yara_scan_job_status(sample_id):
+    try:
+        return jsonify(MalYaraScan.scan_job_status(sample_id))
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+@main.route("/yaraScanJobResult/<sample_id>", methods=["GET"])
+def yara_scan_job_result(sample_id):
+    try:
+        data = MalYaraScan.scan_job_result(sample_id)
+        # 任务未完成返回 202，客户端继续轮询
+        http = 202 if data.get("code") == "JOB_NOT_FINISHED" else 200
+        return jsonify(data), http
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+@main.route("/yaraScanExecutorStats", methods=["GET"])
+def yara_scan_executor_stats():
+    return jsonify(MalYaraScan.executor_stats())
+
+@main.route("/submitYaraProfileJob", methods=["POST"])
+def submit_yara_profile_job():
+    try:
+        f = request.files.get("file")
+        rule_set = request.form.get("rule_set", "enabled")
+        action = request.form.get("action", "flag")
+        data = MalYaraProfile.submit_profile_job(f, rule_set=rule_set, action=action)
+        return jsonify(data)
+    except Exception as e:
+        msg = str(e)
+        code = "FILE_TOO_LARGE" if msg == "FILE_TOO_LARGE" else "BAD_REQUEST"
+        return jsonify({"ok": False, "code": code, "message": msg}), 400
+
+@main.route("/yaraProfileJobStatus/<job_id>", methods=["GET"])
+def yara_profile_job_status(job_id):
+    try:
+        return jsonify(MalYaraProfile.profile_job_status(job_id))
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+@main.route("/yaraRuleProfileTop", methods=["GET"])
+def yara_rule_profile_top():
+    try:
+        limit = request.args.get("limit", 20)
+        flagged_only = request.args.get("flagged", "0") in ("1", "true", "True")
+        return jsonify(MalYaraProfile.top_expensive(limit, flagged_only))
+    except Exception as e:
+        return jsonify({"ok": False, "code": "BAD_REQUEST", "message": str(e)}), 400
+
+
 #cnvd
 @main.route('/CnvdVulnById/<cnvd_id>', methods=['GET','POST'])
 def cnvd_vuln(cnvd_id):
@@ -0,0 +1,127 @@
+# src/apps/services/MalSigmaConvert.py
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import MetaData, Table, Column, String, DateTime, JSON, Text, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from src.extension import *
+from src.apps.services.MalSigmaEngine import PIPELINE_KEY, convert_sigma_rule, ensure_converter
+
+metadata = MetaData()
+
+# Sigma 规则转换结果：按规则 sha256 + pipeline 保存 Zircolite 规则（SQL），
+# 上传时写入，扫描直接使用，不再每次扫描都跑 pySigma 转换
+_sigma_rule_converted = Table(
+    "sigma_rule_converted",
+    metadata,
+    Column("sha256", String(64), primary_key=True),
+    Column("pipeline", String(255), primary_key=True),
+    Column("rule_sql", JSON, nullable=True),
+    Column("error", Text, nullable=True),
+    Column("created_at", DateTime, nullable=False),
+)
+
+
+def get_sigma_rule_converted_table() -> Table:
+    return ensure_table(_sigma_rule_converted)
+
+
+_LOOKUP_BATCH = 1000
+_INSERT_BATCH = 500
+
+
+def convert_rules(rule_objs: Dict[str, Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    rule_objs: sha256 -> rule_json，返回 (待写入的转换结果行, 转换不可用的原因)。
+    单条规则转换失败记录 error（下次不再重复转换）；转换器不可用（未安装 pySigma 等）时不写任何行，
+    留给扫描时按需补转换。
+    """
+    try:
+        ensure_converter()
+    except (ValueError, ImportError) as e:
+        return [], str(e)
+
+    rows: List[Dict[str, Any]] = []
+    for sha, rule_obj in rule_objs.items():
+        try:
+            rows.append({"sha256": sha, "pipeline": PIPELINE_KEY,
+                         "rule_sql": convert_sigma_rule(rule_obj), "error": None})
+        except Exception as e:
+            rows.append({"sha256": sha, "pipeline": PIPELINE_KEY, "rule_sql": None, "error": str(e)[:2000]})
+    return rows, None
+
+
+def store_converted(conn, rows: List[Dict[str, Any]], now: datetime) -> None:
+    if not rows:
+        return
+    table = get_sigma_rule_converted_table()
+    for start in range(0, len(rows), _INSERT_BATCH):
+        batch = rows[start:start + _INSERT_BATCH]
+        stmt = mysql_insert(table).values([{**r, "created_at": now} for r in batch])
+        stmt = stmt.on_duplicate_key_update(
+            rule_sql=stmt.inserted.rule_sql,
+            error=stmt.inserted.error,
+            created_at=stmt.inserted.created_at,
+        )
+        conn.execute(stmt)
+
+
+def lookup_converted(shas: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    查询当前 pipeline 下已有的转换结果：sha256 -> {"rule_sql", "error"}。
+    """
+    table = get_sigma_rule_converted_table()
+    found: Dict[str, Dict[str, Any]] = {}
+    with db.engine.connect() as conn:
+        for start in range(0, len(shas), _LOOKUP_BATCH):
+            batch = shas[start:start + _LOOKUP_BATCH]
+            stmt = select(table.c.sha256, table.c.rule_sql, table.c.error).where(
+                table.c.pipeline == PIPELINE_KEY,
+                table.c.sha256.in_(batch),
+            )
+            for r in conn.execute(stmt).mappings():
+                found[r["sha256"]] = {"rule_sql": r["rule_sql"], "error": r["error"]}
+    return found
+
+
+def convert_new_rules(rule_objs: Dict[str, Dict[str, Any]]) \
+        -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Optional[str]]:
+    """
+    上传用：当前 pipeline 下已有转换结果的规则（重复上传 / 其它来源已入库）直接复用，只转换其余规则。
+    返回 (待写入的转换结果行, 全部规则的转换结果（含复用）, 转换不可用的原因)。
+    """
+    found = lookup_converted(list(rule_objs.keys()))
+    missing = {sha: obj for sha, obj in rule_objs.items() if sha not in found}
+    rows, unavailable = convert_rules(missing) if missing else ([], None)
+    results = rows + [{"sha256": sha, "rule_sql": item["rule_sql"], "error": item["error"]}
+                      for sha, item in found.items()]
+    return rows, results, unavailable
+
+
+def converted_ruleset(rule_objs: Dict[str, Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    扫描用：取 rule_objs（sha256 -> rule_json）对应的 Zircolite 规则，返回 (ruleset, 转换失败列表)。
+    上传时尚未转换的规则（旧数据 / 换了 pipeline / 当时转换器不可用）在这里补转换并写回。
+    """
+    found = lookup_converted(list(rule_objs.keys()))
+    missing = {sha: obj for sha, obj in rule_objs.items() if sha not in found}
+    if missing:
+        rows, unavailable = convert_rules(missing)
+        if unavailable:
+            raise ValueError(unavailable)
+        with db.engine.begin() as conn:
+            store_converted(conn, rows, datetime.now())
+        for r in rows:
+            found[r["sha256"]] = {"rule_sql": r["rule_sql"], "error": r["error"]}
+
+    ruleset: List[Dict[str, Any]] = []
+    failed: List[Dict[str, Any]] = []
+    for sha, rule_obj in rule_objs.items():
+        item = found[sha]
+        if item["rule_sql"]:
+            ruleset.append(item["rule_sql"])
+        else:
+            failed.append({"sha256": sha, "title": (rule_obj or {}).get("title"), "error": item["error"]})
+    # 与 Zircolite 一致：按 level 排序执行
+    ruleset.sort(key=lambda d: d.get("level") or "")
+    return ruleset, failed
@@ -0,0 +1,281 @@
+# src/apps/services/MalSigmaEngine.py
+import argparse
+import importlib.metadata
+import importlib.util
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# -----------------------
+# 配置：按项目实际路径
+# -----------------------
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+ZIRCOLITE_DIR = os.path.join(PROJECT_ROOT, "third_party", "Zircolite")
+ZIRCOLITE_PY = os.path.join(ZIRCOLITE_DIR, "zircolite.py")
+ZIRCOLITE_FIELD_MAPPINGS = os.path.join(ZIRCOLITE_DIR, "config", "fieldMappings.json")
+# evtx_dump 解析线程数（None 表示全部核）
+ZIRCOLITE_CORES = os.environ.get("ZIRCOLITE_CORES") or None
+# Sigma 转换使用的 pySigma pipeline（逗号分隔，如 "sysmon,windows-logsources"），为空表示不加 pipeline
+SIGMA_PIPELINES = tuple(p.strip() for p in (os.environ.get("SIGMA_PIPELINES") or "").split(",") if p.strip())
+
+
+def _dist_version(*names: str) -> str:
+    for name in names:
+        try:
+            return importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            continue
+    return "none"
+
+
+# 转换器版本：pySigma / sqlite 后端升级后转换结果（含之前失败的规则）需要重新转换
+CONVERTER_VERSION = "pysigma={},sqlite={}".format(
+    _dist_version("pySigma", "pysigma"),
+    _dist_version("pySigma-backend-sqlite", "pysigma-backend-sqlite", "pysigma_backend_sqlite"),
+)
+# 转换结果按该 key 区分；更换 pipeline 或转换器版本后旧的转换结果不再使用，扫描时按需重新转换
+PIPELINE_KEY = (",".join(SIGMA_PIPELINES) or "none") + "|" + CONVERTER_VERSION
+# 单次检测总时长上限（解析 + 入库 + 执行规则）
+DETECT_TIMEOUT_SECONDS = int(os.environ.get("SIGMA_DETECT_TIMEOUT_SECONDS") or 180)
+# SQLite 每执行这么多条虚拟机指令检查一次超时，超时即中断当前语句
+_SQLITE_PROGRESS_STEPS = 100000
+
+_module = None
+_module_lock = threading.Lock()
+_backend = None
+_backend_lock = threading.Lock()
+# pySigma 后端 / pipeline 在 convert_rule 过程中会修改自身状态，同一实例同一时刻只允许一个线程转换
+_convert_lock = threading.Lock()
+
+# Zircolite 的日志只在调试时有用，默认不输出 banner / 进度
+_logger = logging.getLogger("zircolite")
+if not _logger.handlers:
+    _logger.addHandler(logging.NullHandler())
+_logger.propagate = False
+
+
+def _load_zircolite():
+    """
+    以模块方式导入 third_party/Zircolite/zircolite.py（只导入一次），
+    不再每次检测都启动解释器、导入 orjson / pySigma / RestrictedPython。
+    """
+    global _module
+    if _module is not None:
+        return _module
+    with _module_lock:
+        if _module is None:
+            if not os.path.exists(ZIRCOLITE_PY):
+                raise ValueError(f"未找到 Zircolite：{ZIRCOLITE_PY}（请把 Zircolite 解压到 third_party/zircolite）")
+            # tqdm 进度条在服务进程里没有意义，导入前关闭
+            os.environ.setdefault("TQDM_DISABLE", "1")
+            spec = importlib.util.spec_from_file_location("zircolite", ZIRCOLITE_PY)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _module = module
+    return _module
+
+
+def _get_backend():
+    """
+    pySigma sqlite 后端（按 SIGMA_PIPELINES 组合 pipeline，与 Zircolite 命令行 -p 一致），进程内复用。
+    """
+    global _backend
+    zc = _load_zircolite()
+    if zc.sigmaConversionDisabled:
+        raise ValueError("Sigma 规则转换不可用：未安装 pySigma / pySigma-backend-sqlite")
+    with _backend_lock:
+        if _backend is None:
+            resolver = zc.ProcessingPipelineResolver()
+            if SIGMA_PIPELINES:
+                plugins = zc.InstalledSigmaPlugins.autodiscover()
+                for name in SIGMA_PIPELINES:
+                    if name not in plugins.pipelines:
+                        raise ValueError(f"未安装 pySigma pipeline：{name}")
+                    resolver.add_pipeline_class(plugins.pipelines[name]())
+            _backend = zc.sqlite.sqliteBackend(resolver.resolve(resolver.pipelines))
+    return _backend
+
+
+def _input_args() -> argparse.Namespace:
+    # JSONFlattener 通过 args_config 判断输入格式；这里固定为 EVTX
+    return argparse.Namespace(
+        json_input=False,
+        json_array_input=False,
+        xml_input=False,
+        sysmon_linux_input=False,
+        auditd_input=False,
+        evtxtract_input=False,
+        csv_input=False,
+        db_input=False,
+    )
+
+
+def _evtx_dump_path() -> str:
+    """
+    按平台选择 Zircolite 自带的 evtx_dump（与 evtxExtractor.getOSExternalTools 一致，转成绝对路径）。
+    """
+    system = platform.system()
+    machine = platform.machine()
+    if system == "Windows":
+        name = "evtx_dump_win.exe"
+    elif system == "Darwin":
+        name = "evtx_dump_mac"
+    elif machine.startswith("arm") or machine.startswith("aarch"):
+        name = "evtx_dump_lin_arm"
+    else:
+        name = "evtx_dump_lin"
+    return os.path.join(ZIRCOLITE_DIR, "bin", name)
+
+
+def _remaining(deadline: float) -> float:
+    return deadline - time.monotonic()
+
+
+def _check_deadline(deadline: float, phase: str) -> None:
+    if _remaining(deadline) <= 0:
+        raise ValueError(f"检测超时：超过 {DETECT_TIMEOUT_SECONDS} 秒（{phase}）")
+
+
+def _extract_evtx(zc, evtx_path: str, out_dir: str, deadline: float) -> List[str]:
+    """
+    EVTX -> JSONL。有 evtx_dump 时直接带超时运行（超时即结束子进程）；
+    没有时退回 Zircolite 的 evtx 绑定解析（较慢，结束后再检查超时）。
+    """
+    bin_path = _evtx_dump_path()
+    if os.path.isfile(bin_path):
+        os.makedirs(out_dir, exist_ok=True)
+        out_path = os.path.join(out_dir, os.path.basename(evtx_path) + ".json")
+        cmd = [bin_path, "--no-confirm-overwrite", "-o", "jsonl", evtx_path, "-f", out_path,
+               "-t", str(ZIRCOLITE_CORES or os.cpu_count() or 1)]
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=max(1.0, _remaining(deadline)))
+        except subprocess.TimeoutExpired:
+            raise ValueError(f"检测超时：超过 {DETECT_TIMEOUT_SECONDS} 秒（extracting）")
+        except OSError as e:
+            raise ValueError(f"evtx_dump 无法执行：{e}")
+    else:
+        # evtxExtractor 要求目录尚不存在
+        extractor = zc.evtxExtractor(logger=_logger, providedTmpDir=out_dir, coreCount=ZIRCOLITE_CORES,
+                                     useExternalBinaries=False, binPath=bin_path)
+        extractor.run(evtx_path)
+        _check_deadline(deadline, "extracting")
+
+    paths = [os.path.join(out_dir, n) for n in os.listdir(out_dir) if n.endswith(".json")]
+    return [path for path in paths if os.stat(path).st_size != 0]
+
+
+def ensure_converter() -> None:
+    """
+    初始化转换后端；Zircolite / pySigma / pipeline 不可用时抛 ValueError 或 ImportError。
+    """
+    _get_backend()
+
+
+def convert_sigma_rule(rule_obj: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    单条 Sigma 规则（dict）转换为 Zircolite 规则（含 SQL 的 dict），失败抛异常。
+    """
+    zc = _load_zircolite()
+    backend = _get_backend()
+    collection = zc.SigmaCollection.from_dicts([rule_obj])
+    with _convert_lock:
+        return backend.convert_rule(collection.rules[0], "zircolite")[0]
+
+
+def _noop_progress(phase: str, done: Optional[int] = None, total: Optional[int] = None) -> None:
+    pass
+
+
+def run_detection(evtx_path: str, ruleset: List[Dict[str, Any]], work_dir: str,
+                  progress: Optional[Callable[..., None]] = None) -> Dict[str, Any]:
+    """
+    进程内执行一次 EVTX 检测：evtx_dump 解析 -> 展平 -> 写入内存 SQLite -> 逐条执行规则。
+    结果直接以 Python 对象返回（与 zircolite 输出 JSON 的元素结构相同），不再经过结果文件。
+    progress(phase, done, total) 在各阶段回调：extracting / flattening / inserting / rules。
+    总时长超过 DETECT_TIMEOUT_SECONDS 抛 ValueError（各阶段之间检查，SQLite 语句执行中也会被中断）。
+    """
+    zc = _load_zircolite()
+    progress = progress or _noop_progress
+    started = time.perf_counter()
+    deadline = time.monotonic() + DETECT_TIMEOUT_SECONDS
+
+    extract_dir = os.path.join(os.path.abspath(work_dir), "extracted")
+    core = None
+    try:
+        progress("extracting")
+        json_list = _extract_evtx(zc, os.path.abspath(evtx_path), extract_dir, deadline)
+        if not json_list:
+            raise ValueError("EVTX 解析失败：未得到任何事件")
+
+        # 以下按 zirCore.run 的步骤拆开执行，以便逐阶段汇报进度和检查超时
+        core = zc.zirCore(ZIRCOLITE_FIELD_MAPPINGS, logger=_logger, noOutput=True)
+        # 超时后中断正在执行的 SQL（Zircolite 吞掉该错误，随后的超时检查会抛出）
+        core.dbConnection.set_progress_handler(lambda: 1 if _remaining(deadline) <= 0 else 0,
+                                               _SQLITE_PROGRESS_STEPS)
+        flattener = zc.JSONFlattener(configFile=core.config, logger=_logger,
+                                     timeAfter=core.timeAfter, timeBefore=core.timeBefore,
+                                     timeField=core.timeField, hashes=core.hashes, args_config=_input_args())
+        for i, path in enumerate(json_list):
+            _check_deadline(deadline, "flattening")
+            progress("flattening", i, len(json_list))
+            flat = flattener.run(path)
+            flattener.fieldStmt += flat["dbFields"]
+            flattener.valuesStmt += flat["dbValues"]
+
+        rows = flattener.valuesStmt
+        core.createDb(flattener.fieldStmt)
+        for i, row in enumerate(rows):
+            if i % 5000 == 0:
+                _check_deadline(deadline, "inserting")
+                progress("inserting", i, len(rows))
+            core.insertData2Db(row)
+        core.createIndex()
+        _check_deadline(deadline, "inserting")
+        del flattener, rows
+        event_count = (core.executeSelectQuery("SELECT COUNT(*) AS n FROM logs") or [{"n": None}])[0]["n"]
+
+        rules = [r for r in ruleset if r]
+        results: List[Dict[str, Any]] = []
+        for i, rule in enumerate(rules):
+            progress("rules", i, len(rules))
+            hit = core.executeRule(rule)
+            _check_deadline(deadline, f"rules {i + 1}/{len(rules)}")
+            if hit:
+                results.append(hit)
+        progress("rules", len(rules), len(rules))
+
+        return {
+            "results": results,
+            "event_count": event_count,
+            "rules": len(rules),
+            "engine_seconds": round(time.perf_counter() - started, 3),
+        }
+    except SystemExit as e:
+        # Zircolite 内部出错时直接 sys.exit，不能让它结束服务进程
+        raise ValueError(f"Zircolite 执行失败（exit {e.code}）")
+    finally:
+        if core is not None:
+            core.close()
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+
+def engine_info() -> Dict[str, Any]:
+    """
+    预热 / 就绪检查用：导入 Zircolite 并初始化转换后端。
+    """
+    zc = _load_zircolite()
+    info: Dict[str, Any] = {
+        "zircolite": ZIRCOLITE_PY,
+        "sigma_conversion": not zc.sigmaConversionDisabled,
+        "pipeline": PIPELINE_KEY,
+        "evtx_dump": os.path.isfile(_evtx_dump_path()),
+    }
+    if not zc.sigmaConversionDisabled:
+        _get_backend()
+    return info
@@ -0,0 +1,185 @@
+# src/apps/services/MalSigmaResultCache.py
+import os
+import json
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import MetaData, Table, Column, String, Integer, DateTime, JSON, select, update, delete, tuple_, func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from src.extension import *
+
+metadata = MetaData()
+
+# EVTX 检测结果缓存：同一 EVTX（sha256）+ 同一规则集版本 + 同一返回级别，结果必然相同
+_sigma_scan_result = Table(
+    "sigma_scan_result",
+    metadata,
+    Column("evtx_sha256", String(64), primary_key=True),
+    Column("ruleset_version", String(64), primary_key=True),
+    Column("return_level", String(32), primary_key=True),
+    Column("result", JSON, nullable=False),
+    Column("result_bytes", Integer, nullable=False),
+    Column("hit_count", Integer, nullable=False, default=0),
+    Column("created_at", DateTime, nullable=False),
+    Column("last_hit_at", DateTime, nullable=False, index=True),
+)
+
+
+def get_sigma_scan_result_table() -> Table:
+    return ensure_table(_sigma_scan_result)
+
+
+# -----------------------
+# 配置
+# -----------------------
+# 缓存总大小上限（按结果 JSON 字节数计），超出按最近使用时间淘汰
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("SIGMA_RESULT_CACHE_MAX_BYTES") or 512 * 1024 * 1024)
+# 缓存条目数上限
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("SIGMA_RESULT_CACHE_MAX_ENTRIES") or 5000)
+# 单条结果超过该大小不缓存（with_events 的大结果会挤掉大量小结果）
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("SIGMA_RESULT_CACHE_MAX_ENTRY_BYTES") or 32 * 1024 * 1024)
+# 命中统计（hit_count / last_hit_at）先在进程内累积，最多每隔该秒数批量写回一次
+_HIT_FLUSH_INTERVAL_SECONDS = 30
+_HIT_FLUSH_MAX_PENDING = 1000
+_EVICT_BATCH = 500
+
+# (evtx_sha256, ruleset_version, return_level) -> [累计命中次数, 最近命中时间]
+_pending_hits: Dict[Tuple[str, str, str], List[Any]] = {}
+_hits_lock = threading.Lock()
+_last_flush_at = 0.0
+
+
+def _key_where(table: Table, evtx_sha256: str, ruleset_version: str, return_level: str):
+    return (
+        (table.c.evtx_sha256 == evtx_sha256)
+        & (table.c.ruleset_version == ruleset_version)
+        & (table.c.return_level == return_level)
+    )
+
+
+def lookup_result(evtx_sha256: str, ruleset_version: str, return_level: str) -> Optional[Dict[str, Any]]:
+    """
+    命中返回缓存的检测结果，未命中返回 None。
+    最近使用时间只在进程内记录，按间隔批量写回，命中时不开写事务。
+    """
+    if RESULT_CACHE_MAX_ENTRIES <= 0:
+        return None
+    table = get_sigma_scan_result_table()
+    where = _key_where(table, evtx_sha256, ruleset_version, return_level)
+    with db.engine.connect() as conn:
+        result = conn.execute(select(table.c.result).where(where)).scalar()
+    if result is None:
+        return None
+    _record_hit((evtx_sha256, ruleset_version, return_level))
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result
+
+
+def store_result(evtx_sha256: str, ruleset_version: str, return_level: str, result: Dict[str, Any]) -> bool:
+    """
+    写入一条检测结果并按上限淘汰；结果过大时不缓存，返回是否已缓存。
+    """
+    if RESULT_CACHE_MAX_ENTRIES <= 0:
+        return False
+    size = len(json.dumps(result, ensure_ascii=False, default=str).encode("utf-8"))
+    if size > min(RESULT_CACHE_MAX_ENTRY_BYTES, RESULT_CACHE_MAX_BYTES):
+        return False
+
+    table = get_sigma_scan_result_table()
+    now = datetime.now()
+    stmt = mysql_insert(table).values(
+        evtx_sha256=evtx_sha256,
+        ruleset_version=ruleset_version,
+        return_level=return_level,
+        result=result,
+        result_bytes=size,
+        hit_count=0,
+        created_at=now,
+        last_hit_at=now,
+    )
+    # 并发扫描同一文件时后写覆盖，结果相同
+    stmt = stmt.on_duplicate_key_update(
+        result=stmt.inserted.result,
+        result_bytes=stmt.inserted.result_bytes,
+        last_hit_at=stmt.inserted.last_hit_at,
+    )
+    # 淘汰前先写回累积的命中时间，避免刚被命中的结果按旧时间被淘汰
+    _flush_hits(force=True)
+    with db.engine.begin() as conn:
+        conn.execute(stmt)
+        _evict(conn, table)
+    return True
+
+
+def _record_hit(key: Tuple[str, str, str]) -> None:
+    with _hits_lock:
+        entry = _pending_hits.setdefault(key, [0, None])
+        entry[0] += 1
+        entry[1] = datetime.now()
+        pending = len(_pending_hits)
+    if pending >= _HIT_FLUSH_MAX_PENDING:
+        _flush_hits(force=True)
+    else:
+        _flush_hits()
+
+
+def _flush_hits(force: bool = False) -> None:
+    """
+    把进程内累积的命中次数 / 最近命中时间写回（每个 key 一条 UPDATE，一个事务）。
+    """
+    global _last_flush_at
+    with _hits_lock:
+        now = time.monotonic()
+        if not _pending_hits or (not force and now - _last_flush_at < _HIT_FLUSH_INTERVAL_SECONDS):
+            return
+        hits = dict(_pending_hits)
+        _pending_hits.clear()
+        _last_flush_at = now
+
+    table = get_sigma_scan_result_table()
+    with db.engine.begin() as conn:
+        for (sha, version, level), (count, last_hit_at) in hits.items():
+            conn.execute(
+                update(table)
+                .where(_key_where(table, sha, version, level))
+                .values(hit_count=table.c.hit_count + count, last_hit_at=last_hit_at)
+            )
+
+
+def _evict(conn, table: Table) -> int:
+    """
+    条目数 / 总字节超出上限时，按 last_hit_at 从旧到新删除（LRU），直到回到上限以内。
+    未超限时只做一次聚合查询；超限时按 last_hit_at 索引分批取最旧的行，不读整表。
+    规则集换版本后旧版本的结果不会再命中，也会随之老化淘汰。
+    """
+    count, total = conn.execute(
+        select(func.count(), func.coalesce(func.sum(table.c.result_bytes), 0)).select_from(table)
+    ).one()
+    count, total = int(count or 0), int(total or 0)
+    if count <= RESULT_CACHE_MAX_ENTRIES and total <= RESULT_CACHE_MAX_BYTES:
+        return 0
+
+    key_cols = tuple_(table.c.evtx_sha256, table.c.ruleset_version, table.c.return_level)
+    removed = 0
+    while count > RESULT_CACHE_MAX_ENTRIES or total > RESULT_CACHE_MAX_BYTES:
+        rows = conn.execute(
+            select(table.c.evtx_sha256, table.c.ruleset_version, table.c.return_level, table.c.result_bytes)
+            .order_by(table.c.last_hit_at.asc())
+            .limit(_EVICT_BATCH)
+        ).all()
+        if not rows:
+            break
+        stale = []
+        for r in rows:
+            if count <= RESULT_CACHE_MAX_ENTRIES and total <= RESULT_CACHE_MAX_BYTES:
+                break
+            stale.append((r.evtx_sha256, r.ruleset_version, r.return_level))
+            count -= 1
+            total -= r.result_bytes or 0
+        conn.execute(delete(table).where(key_cols.in_(stale)))
+        removed += len(stale)
+    return removed
+
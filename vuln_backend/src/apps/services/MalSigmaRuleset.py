@@ -0,0 +1,219 @@
+# src/apps/services/MalSigmaRuleset.py
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import MetaData, Table, select, func
+
+from src.extension import *
+from src.apps.services.MalSigmaConvert import converted_ruleset
+from src.apps.services.MalSigmaEngine import PIPELINE_KEY
+
+metadata = MetaData()
+
+
+def get_sigma_rule_table() -> Table:
+    return Table("sigma_rule", metadata, autoload_with=db.engine)
+
+
+# -----------------------
+# 配置路径
+# -----------------------
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+# 每个规则集版本一个目录：<dir>/<rule_set>_<version>/ruleset.json + manifest.json
+EXPORT_DIR = os.path.join(PROJECT_ROOT, "runtime", "sigma_ruleset")
+# 每个 rule_set 在磁盘上保留的历史版本数（正在被其它进程使用的旧版本不会立刻消失）
+KEEP_VERSIONS = int(os.environ.get("SIGMA_RULESET_KEEP_VERSIONS") or 3)
+
+_RULE_SETS = ("enabled", "all")
+
+
+def _apply_rule_set(stmt, sigma_table: Table, rule_set: str):
+    if rule_set == "enabled":
+        return stmt.where(sigma_table.c.enabled == 1)
+    if rule_set == "all":
+        return stmt
+    raise ValueError("rule_set 参数非法：仅允许 enabled|all")
+
+
+def _current_version(rule_set: str) -> Optional[str]:
+    """
+    规则集版本：规则 sha256 集合 + updated_at 水位 + 转换 pipeline，
+    只查哈希列和时间列，不读取 rule_json。
+    """
+    sigma_table = get_sigma_rule_table()
+    with db.engine.connect() as conn:
+        shas = conn.execute(_apply_rule_set(select(sigma_table.c.sha256), sigma_table, rule_set)).scalars().all()
+        watermark = conn.execute(
+            _apply_rule_set(select(func.max(sigma_table.c.updated_at)), sigma_table, rule_set)
+        ).scalar()
+
+    shas = [s for s in shas if s]
+    if not shas:
+        return None
+
+    h = hashlib.sha256()
+    h.update(f"{rule_set}\n{PIPELINE_KEY}\n{watermark}\n".encode("utf-8"))
+    for sha in sorted(set(shas)):
+        h.update(sha.encode("ascii", errors="replace"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def _export_dir(rule_set: str, version: str) -> str:
+    return os.path.join(EXPORT_DIR, f"{rule_set}_{version}")
+
+
+def _prune_versions(rule_set: str, keep_dir: str) -> None:
+    try:
+        dirs = [os.path.join(EXPORT_DIR, d) for d in os.listdir(EXPORT_DIR)
+                if d.startswith(rule_set + "_") and not d.endswith(".tmp")]
+    except OSError:
+        return
+    dirs = [d for d in dirs if d != keep_dir]
+    dirs.sort(key=lambda d: os.path.getmtime(d), reverse=True)
+    for d in dirs[max(0, KEEP_VERSIONS - 1):]:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def _build_export(rule_set: str, version: str) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    导出一个规则集版本：读取 rule_json，取转换好的 Zircolite 规则，写成单个 ruleset.json。
+    先写临时目录再整体 rename，其它进程不会读到半个版本。
+    """
+    sigma_table = get_sigma_rule_table()
+    stmt = _apply_rule_set(select(sigma_table.c.sha256, sigma_table.c.rule_json), sigma_table, rule_set)
+    with db.engine.connect() as conn:
+        rows = conn.execute(stmt).mappings().all()
+
+    ruleset, failed = converted_ruleset({r["sha256"]: r["rule_json"] for r in rows})
+    manifest = {
+        "rule_set": rule_set,
+        "version": version,
+        "pipeline": PIPELINE_KEY,
+        "rules": len(rows),
+        "converted": len(ruleset),
+        "failed": failed,
+        "built_at": time.time(),
+    }
+
+    final_dir = _export_dir(rule_set, version)
+    tmp_dir = f"{final_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        with open(os.path.join(tmp_dir, "ruleset.json"), "w", encoding="utf-8") as f:
+            json.dump(ruleset, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        try:
+            os.rename(tmp_dir, final_dir)
+        except OSError:
+            # 其它进程已经导出了同一版本，直接用它的
+            if not os.path.isdir(final_dir):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    _prune_versions(rule_set, final_dir)
+    return ruleset, manifest
+
+
+class LoadedSigmaRuleset:
+    """
+    进程内缓存的一份 Zircolite 规则集（已转换好的 SQL 规则列表）。
+    """
+
+    def __init__(self, rule_set: str, version: str, rules: List[Dict[str, Any]],
+                 failed: List[Dict[str, Any]], load_seconds: float, built: bool):
+        self.rule_set = rule_set
+        self.version = version
+        self.rules = rules
+        self.failed = failed
+        self.load_seconds = load_seconds
+        # True 表示本次由当前进程导出，False 表示复用了磁盘上已有的版本
+        self.built = built
+        self.loaded_at = time.time()
+
+
+_CACHE: Dict[str, LoadedSigmaRuleset] = {}
+_CACHE_LOCK = threading.Lock()
+_BUILD_LOCK = threading.Lock()
+
+
+def _load_ruleset(rule_set: str, version: str) -> LoadedSigmaRuleset:
+    started = time.perf_counter()
+    export_dir = _export_dir(rule_set, version)
+    ruleset = None
+    manifest = None
+    built = False
+    if os.path.isdir(export_dir):
+        try:
+            with open(os.path.join(export_dir, "ruleset.json"), "r", encoding="utf-8") as f:
+                ruleset = json.load(f)
+            with open(os.path.join(export_dir, "manifest.json"), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            ruleset = None
+            manifest = None
+            shutil.rmtree(export_dir, ignore_errors=True)
+
+    if ruleset is None:
+        ruleset, manifest = _build_export(rule_set, version)
+        built = True
+
+    return LoadedSigmaRuleset(
+        rule_set=rule_set,
+        version=version,
+        rules=ruleset,
+        failed=manifest.get("failed") or [],
+        load_seconds=time.perf_counter() - started,
+        built=built,
+    )
+
+
+class MalSigmaRuleset:
+    """
+    Sigma 规则集导出缓存：
+      - 每个规则集版本只导出一次到 runtime/sigma_ruleset/<rule_set>_<version>/，所有扫描共用
+      - 进程内再缓存一份已解析的规则列表，稳态扫描只查一次版本
+    """
+
+    @staticmethod
+    def check_rule_set(rule_set: str) -> None:
+        if rule_set not in _RULE_SETS:
+            raise ValueError("rule_set 参数非法：仅允许 enabled|all")
+
+    @staticmethod
+    def current_version(rule_set: str = "enabled") -> Optional[str]:
+        MalSigmaRuleset.check_rule_set(rule_set)
+        return _current_version(rule_set)
+
+    @staticmethod
+    def get_ruleset(rule_set: str = "enabled") -> LoadedSigmaRuleset:
+        MalSigmaRuleset.check_rule_set(rule_set)
+
+        version = _current_version(rule_set)
+        if version is None:
+            raise ValueError("规则集为空：数据库里没有可用 Sigma 规则（请先上传规则或启用规则）")
+
+        with _CACHE_LOCK:
+            cached = _CACHE.get(rule_set)
+        if cached is not None and cached.version == version:
+            return cached
+
+        # 同一时刻只允许一个线程导出，其余线程等待后直接复用
+        with _BUILD_LOCK:
+            with _CACHE_LOCK:
+                cached = _CACHE.get(rule_set)
+            if cached is not None and cached.version == version:
+                return cached
+
+            loaded = _load_ruleset(rule_set, version)
+            with _CACHE_LOCK:
+                _CACHE[rule_set] = loaded
+            return loaded
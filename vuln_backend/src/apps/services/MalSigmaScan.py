@@ -1,46 +1,42 @@
 # src/apps/services/MalSigmaScan.py
 import os
 import io
-import json
 import uuid
 import shutil
 import hashlib
 import zipfile
-import subprocess
+import time
 from datetime import datetime
 from typing import Any, Dict, List, Optional
-import sys
-
-import yaml
-from sqlalchemy import MetaData, Table, select
 
 from src.extension import *
-
-
-metadata = MetaData()
-
-def get_sigma_rule_table():
-    return Table("sigma_rule", metadata, autoload_with=db.engine)
+from src.apps.services.MalSigmaEngine import engine_info, run_detection
+from src.apps.services.MalSigmaRuleset import MalSigmaRuleset
+from src.apps.services.MalSigmaResultCache import lookup_result, store_result
+from src.apps.utils.job_queue import JobQueue, STATUS_DONE, STATUS_FAILED
+from src.apps.utils.warmup import register_warmup
 
 
 # -----------------------
 # 配置：按项目实际路径
 # -----------------------
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
-ZIRCOLITE_DIR = os.path.join(PROJECT_ROOT, "third_party", "Zircolite")
-ZIRCOLITE_PY  = os.path.join(ZIRCOLITE_DIR, "zircolite.py")
-import sys
-ZIRCOLITE_PYTHON = sys.executable
-# ZIRCOLITE_PYTHON = os.path.join(
-#     ZIRCOLITE_DIR,
-#     ".venv",
-#     "Scripts",
-#     "python.exe"
-# )
-
 RUNTIME_DIR = os.path.join(PROJECT_ROOT, "runtime", "sigma_scan")
 MAX_EVTX_BYTES = 80 * 1024 * 1024  # 80MB
-SCAN_TIMEOUT_SECONDS = 180  # 超时保护
+# 异步检测任务并发数（每个任务独占一个内存 SQLite，并发过高会占满内存）
+DETECT_JOB_WORKERS = int(os.environ.get("SIGMA_JOB_WORKERS") or 2)
+
+_RETURN_LEVELS = ("summary", "with_events")
+
+# 各阶段在总进度中的区间（百分比），规则执行通常最耗时
+_PHASE_PERCENT = {
+    "extracting": (0, 15),
+    "flattening": (15, 35),
+    "inserting": (35, 50),
+    "rules": (50, 100),
+}
+# 进度写库的最小间隔，避免每条规则都写一次任务库
+_PROGRESS_INTERVAL_SECONDS = 0.5
 
 
 def _sha256_hex(data: bytes) -> str:
@@ -67,10 +63,6 @@ def _safe_filename(name: str) -> str:
     return name.replace("..", "_")
 
 
-def _dump_rule_to_yaml(rule_obj: Dict[str, Any]) -> str:
-    return yaml.safe_dump(rule_obj, sort_keys=False, allow_unicode=True)
-
-
 def _extract_alerts_from_zircolite(raw_results: List[Dict[str, Any]], return_level: str) -> Dict[str, Any]:
     """
     Zircolite 输出是 JSON 数组，每个元素大概长这样：
@@ -123,9 +115,127 @@ def _extract_alerts_from_zircolite(raw_results: List[Dict[str, Any]], return_lev
     return {"alerts": alerts, "hit_events": hit_events}
 
 
+def _build_response(result: Dict[str, Any], job_id: str, label: str, filename: str,
+                    evtx_sha256: str, rule_set: str, return_level: str, cached: bool) -> Dict[str, Any]:
+    resp = {
+        "ok": True,
+        "log_id": job_id,
+        "label": label or "",
+        "filename": filename,
+        "sha256": evtx_sha256,
+        "rule_set": rule_set,
+        "event_count": result["event_count"],
+        "alerts": result["alerts"],
+    }
+
+    if return_level == "with_events":
+        resp["hit_events"] = result["hit_events"]
+
+    resp["ruleset_version"] = result["ruleset_version"]
+    resp["rule_count"] = result["rule_count"]
+    resp["convert_failed"] = result["convert_failed"]
+    resp["engine_seconds"] = result["engine_seconds"]
+    # True 表示命中检测结果缓存，未重新执行检测
+    resp["cached"] = cached
+    return resp
+
+
+def _cached_response(evtx_sha256: str, job_id: str, label: str, filename: str,
+                     rule_set: str, return_level: str) -> Optional[Dict[str, Any]]:
+    """
+    同一 EVTX + 同一规则集版本：直接返回缓存结果，未命中返回 None。
+    """
+    version = MalSigmaRuleset.current_version(rule_set)
+    if version is None:
+        raise ValueError("规则集为空：数据库里没有可用 Sigma 规则（请先上传规则或启用规则）")
+    cached = lookup_result(evtx_sha256, version, return_level)
+    if cached is None:
+        return None
+    return _build_response(cached, job_id, label, filename, evtx_sha256, rule_set, return_level, True)
+
+
+def _detect(evtx_path: str, job_dir: str, job_id: str, label: str, filename: str, evtx_sha256: str,
+            rule_set: str, return_level: str, progress=None) -> Dict[str, Any]:
+    # --------- 规则集按版本导出一次，所有扫描共用 ----------
+    ruleset = MalSigmaRuleset.get_ruleset(rule_set)
+    if not ruleset.rules:
+        raise ValueError("规则转换失败：没有任何 Sigma 规则能转换为 Zircolite 规则")
+
+    detection = run_detection(evtx_path, ruleset.rules, job_dir, progress=progress)
+
+    # --------- 组装返回 ----------
+    pack = _extract_alerts_from_zircolite(detection["results"], return_level)
+    result = {
+        "ruleset_version": ruleset.version,
+        "event_count": detection["event_count"],
+        "alerts": pack["alerts"],
+        "hit_events": pack["hit_events"],
+        "rule_count": detection["rules"],
+        "convert_failed": ruleset.failed[:50],
+        "engine_seconds": detection["engine_seconds"],
+    }
+    store_result(evtx_sha256, ruleset.version, return_level, result)
+
+    return _build_response(result, job_id, label, filename, evtx_sha256, rule_set, return_level, False)
+
+
+def _job_progress(queue: JobQueue, job_id: str):
+    """
+    run_detection 的进度回调：换算成总百分比写入任务库（同一阶段内限频）。
+    """
+    state = {"phase": None, "at": 0.0}
+
+    def report(phase: str, done: Optional[int] = None, total: Optional[int] = None) -> None:
+        now = time.monotonic()
+        if phase == state["phase"] and now - state["at"] < _PROGRESS_INTERVAL_SECONDS and done != total:
+            return
+        state["phase"] = phase
+        state["at"] = now
+
+        lo, hi = _PHASE_PERCENT.get(phase, (0, 0))
+        percent = lo
+        if total:
+            percent = lo + (hi - lo) * min(done or 0, total) / total
+        progress = {"phase": phase, "percent": round(percent, 1)}
+        if total is not None:
+            progress["done"] = done
+            progress["total"] = total
+        queue.set_progress(job_id, **progress)
+
+    return report
+
+
+def _run_detect_job(job: Dict[str, Any], queue: JobQueue) -> Dict[str, Any]:
+    """
+    异步检测任务：EVTX 已在提交时落盘到任务目录，检测完成后删除。
+    """
+    job_id = job["job_id"]
+    params = job["params"]
+    job_dir = queue.job_dir(job_id)
+    label = params.get("label") or ""
+    filename = params.get("filename") or ""
+    rule_set = params.get("rule_set") or "enabled"
+    return_level = params.get("return_level") or "summary"
+
+    try:
+        cached = _cached_response(params["sha256"], job_id, label, filename, rule_set, return_level)
+        if cached is not None:
+            return cached
+
+        queue.set_progress(job_id, phase="loading_ruleset", percent=0)
+        return _detect(params["evtx_path"], job_dir, job_id, label, filename, params["sha256"],
+                       rule_set, return_level, progress=_job_progress(queue, job_id))
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+
+DETECT_JOBS = JobQueue("sigma_detect", _run_detect_job, workers=DETECT_JOB_WORKERS)
+
+
 class MalSigmaScan:
     """
-    对接前端：POST /detectEvtxWithSigma
+    对接前端：POST /detectEvtxWithSigma（同步），
+    POST /submitSigmaDetectJob + GET /sigmaDetectJobStatus/<log_id> + GET /sigmaDetectJobResult/<log_id>（异步）
     """
 
     @staticmethod
@@ -141,135 +251,140 @@ class MalSigmaScan:
         filename = _safe_filename(file_storage.filename or "")
         if not filename.lower().endswith(".evtx"):
             raise ValueError("文件类型不正确：仅支持 .evtx")
+        # return_level 是结果缓存主键的一部分，非法取值不能进入检测 / 缓存
+        if return_level not in _RETURN_LEVELS:
+            raise ValueError("return_level 参数非法：仅允许 summary|with_events")
 
         raw_evtx = _read_filestorage_bytes(file_storage)
         if len(raw_evtx) > MAX_EVTX_BYTES:
             raise ValueError("文件过大：超过后端限制")
 
-        if not os.path.exists(ZIRCOLITE_PY):
-            raise ValueError(f"未找到 Zircolite：{ZIRCOLITE_PY}（请把 Zircolite 解压到 third_party/zircolite）")
+        evtx_sha256 = _sha256_hex(raw_evtx)
+        job_id = uuid.uuid4().hex
+
+        cached = _cached_response(evtx_sha256, job_id, label, filename, rule_set, return_level)
+        if cached is not None:
+            return cached
 
         # --------- 创建本次任务目录 ----------
-        job_id = uuid.uuid4().hex
         job_dir = os.path.join(RUNTIME_DIR, job_id)
-        rules_dir = os.path.join(job_dir, "rules")
         logs_dir = os.path.join(job_dir, "logs")
-        out_dir = os.path.join(job_dir, "out")
-
-        _ensure_dir(rules_dir)
         _ensure_dir(logs_dir)
-        _ensure_dir(out_dir)
 
         evtx_path = os.path.join(logs_dir, filename)
-        out_json = os.path.join(out_dir, "zircolite_results.json")
-
         with open(evtx_path, "wb") as f:
             f.write(raw_evtx)
 
-        evtx_sha256 = _sha256_hex(raw_evtx)
+        try:
+            return _detect(evtx_path, job_dir, job_id, label, filename, evtx_sha256, rule_set, return_level)
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    @staticmethod
+    def submit_detect_job(file_storage,
+                          label: str = "",
+                          rule_set: str = "enabled",
+                          return_level: str = "summary") -> Dict[str, Any]:
+        """
+        异步检测：EVTX 落盘到任务目录后立即返回 log_id，
+        通过 detect_job_status / detect_job_result 轮询。
+        """
+        if file_storage is None:
+            raise ValueError("缺少上传文件：file")
+
+        filename = _safe_filename(file_storage.filename or "")
+        if not filename.lower().endswith(".evtx"):
+            raise ValueError("文件类型不正确：仅支持 .evtx")
+        MalSigmaRuleset.check_rule_set(rule_set)
+        if return_level not in _RETURN_LEVELS:
+            raise ValueError("return_level 参数非法：仅允许 summary|with_events")
 
-        # --------- 从 DB 导出规则到 rules_dir ----------
-        sigma_table = get_sigma_rule_table()
-        stmt = select(sigma_table)
-        if rule_set == "enabled":
-            stmt = stmt.where(sigma_table.c.enabled == 1)
-        elif rule_set == "all":
-            pass
-        else:
-            raise ValueError("rule_set 参数非法：仅允许 enabled|all")
-
-        # 取出规则
-        with db.engine.connect() as conn:
-            rows = conn.execute(stmt).mappings().all()
-
-        if not rows:
-            raise ValueError("规则集为空：数据库里没有可用 Sigma 规则（请先上传规则或启用规则）")
-
-        # 写入 YAML 文件
-        written = 0
-        for r in rows:
-            rule_obj = r["rule_json"]  # MySQL JSON -> dict
-            sha = r["sha256"]
-            # 文件名：sha256.yml（稳定且唯一）
-            yml_path = os.path.join(rules_dir, f"{sha}.yml")
-            try:
-                yml_text = _dump_rule_to_yaml(rule_obj)
-                with open(yml_path, "w", encoding="utf-8") as f:
-                    f.write(yml_text)
-                written += 1
-            except Exception as e:
-                # 单条规则坏了不应拖垮全局
-                continue
-
-        if written == 0:
-            raise ValueError("规则导出失败：未能写入任何 YAML 规则文件")
-
-        # --------- 调用 Zircolite ----------
-        # 关键：ruleset 直接给目录
-        # cmd = [
-        #     sys.executable,               # 用当前 Python 解释器
-        #     ZIRCOLITE_PY,
-        #     "-r", rules_dir,
-        #     "-e", evtx_path,
-        #     "-o", out_json
-        # ]
-        cmd = [
-            ZIRCOLITE_PYTHON,
-            ZIRCOLITE_PY,
-            "-r", rules_dir,
-            "-e", evtx_path,
-            "-o", out_json
-        ]
+        raw_evtx = _read_filestorage_bytes(file_storage)
+        if len(raw_evtx) > MAX_EVTX_BYTES:
+            raise ValueError("文件过大：超过后端限制")
+        evtx_sha256 = _sha256_hex(raw_evtx)
 
+        job_id = DETECT_JOBS.new_job_id()
+        logs_dir = os.path.join(DETECT_JOBS.job_dir(job_id), "logs")
+        _ensure_dir(logs_dir)
+        evtx_path = os.path.join(logs_dir, filename)
         try:
-            # cwd 指向 Zircolite 目录，避免相对路径/依赖问题
-            proc = subprocess.run(
-                cmd,
-                cwd=ZIRCOLITE_DIR,
-                capture_output=True,
-                encoding="utf-8",
-                errors="replace",
-                text=True,
-                timeout=SCAN_TIMEOUT_SECONDS
-            )
-        except subprocess.TimeoutExpired:
-            raise ValueError("检测超时：DETECT_TIMEOUT")
-        except Exception as e:
-            raise ValueError(f"调用 Zircolite 失败：{str(e)}")
-
-        if proc.returncode != 0:
-            # 把 stderr 打回去方便你调试
-            raise ValueError(f"Zircolite 执行失败：{proc.stderr[:2000]}")
-
-        if not os.path.exists(out_json):
-            raise ValueError("Zircolite 未生成输出文件")
-
-        # --------- 读取 & 组装返回 ----------
-        with open(out_json, "r", encoding="utf-8") as f:
-            raw_results = json.load(f)  # JSON 数组
-
-        # Zircolite 输出里有匹配事件，不等于“总事件数”，这里先给 -1 占位
-        # 如果你想要 event_count，需要走 EVTX 解析库统计
-        event_count = None
-
-        pack = _extract_alerts_from_zircolite(raw_results, return_level)
-
-        resp = {
+            with open(evtx_path, "wb") as f:
+                f.write(raw_evtx)
+        except BaseException:
+            shutil.rmtree(DETECT_JOBS.job_dir(job_id), ignore_errors=True)
+            raise
+
+        DETECT_JOBS.submit({
+            "label": label or "",
+            "rule_set": rule_set,
+            "return_level": return_level,
+            "filename": filename,
+            "evtx_path": evtx_path,
+            "sha256": evtx_sha256,
+            "size": len(raw_evtx),
+        }, job_id=job_id)
+
+        return {
             "ok": True,
             "log_id": job_id,
-            "label": label or "",
+            "status": "queued",
             "filename": filename,
             "sha256": evtx_sha256,
-            "rule_set": rule_set,
-            "event_count": event_count,
-            "alerts": pack["alerts"],
         }
 
-        if return_level == "with_events":
-            resp["hit_events"] = pack["hit_events"]
-
-        # 可选：把 Zircolite stdout/stderr 也带回去，调试时很有用
-        resp["engine_stdout"] = proc.stdout[-2000:]
-        resp["engine_stderr"] = proc.stderr[-2000:]
+    @staticmethod
+    def detect_job_status(log_id: str) -> Dict[str, Any]:
+        job = DETECT_JOBS.get(log_id or "")
+        if job is None:
+            raise ValueError("任务不存在：log_id")
+        params = job["params"]
+        data = {
+            "ok": True,
+            "log_id": job["job_id"],
+            "status": job["status"],
+            "progress": job["progress"],
+            "filename": params.get("filename"),
+            "sha256": params.get("sha256"),
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+        }
+        if "queue_position" in job:
+            data["queue_position"] = job["queue_position"]
+        if job["status"] == STATUS_FAILED:
+            data["message"] = job["error"]
+        return data
 
-        return resp
+    @staticmethod
+    def detect_job_result(log_id: str) -> Dict[str, Any]:
+        job = DETECT_JOBS.get(log_id or "")
+        if job is None:
+            raise ValueError("任务不存在：log_id")
+        if job["status"] == STATUS_DONE:
+            return job["result"]
+        if job["status"] == STATUS_FAILED:
+            return {"ok": False, "code": "DETECT_FAILED", "message": job["error"],
+                    "log_id": job["job_id"], "status": job["status"]}
+        return {"ok": False, "code": "JOB_NOT_FINISHED", "message": "任务尚未完成",
+                "log_id": job["job_id"], "status": job["status"], "progress": job["progress"]}
+
+
+def _warm_up() -> Dict[str, Any]:
+    """
+    启动预热：导入 Zircolite 并初始化转换后端，导出 / 加载启用规则集。
+    """
+    info = engine_info()
+    if MalSigmaRuleset.current_version("enabled") is None:
+        return {"version": None, "message": "没有启用的 Sigma 规则", **info}
+    ruleset = MalSigmaRuleset.get_ruleset("enabled")
+    return {
+        "version": ruleset.version,
+        "rules": len(ruleset.rules),
+        "load_seconds": round(ruleset.load_seconds, 3),
+        **info,
+    }
+
+
+# Sigma 依赖（Zircolite 等）缺失时不影响 YARA 实例就绪
+register_warmup("sigma_ruleset", _warm_up, required=False)
@@ -10,6 +10,7 @@ from sqlalchemy import MetaData, Table
 from sqlalchemy.dialects.mysql import insert as mysql_insert
 
 from src.extension import *
+from src.apps.services.MalSigmaConvert import convert_new_rules, store_converted
 
 
 metadata = MetaData()
@@ -156,6 +157,16 @@ def _parse_yaml(text: str, filename_for_error: str) -> Any:
     return docs
 
 
+def _convert_summary(rows: List[Dict[str, Any]], titles: Dict[str, str], unavailable: Optional[str]) -> Dict[str, Any]:
+    failed = [{"title": titles.get(r["sha256"]), "error": r["error"]} for r in rows if r["error"]]
+    return {
+        "converted_count": len(rows) - len(failed),
+        "convert_failed": failed[:50],
+        # 转换器不可用时规则照常入库，首次扫描时再补转换
+        "convert_unavailable": unavailable,
+    }
+
+
 # ---------- Service ----------
 class MalSigmaUpload:
     """
@@ -194,13 +205,18 @@ class MalSigmaUpload:
         skipped = 0
         stored_titles: List[str] = []
 
+        rules = [_jsonable(rule_obj) for rule_obj in rules]  # 关键：入库前转换
+        shas = [_sha256_hex(_canonical_json_bytes(rule_obj)) for rule_obj in rules]
+
+        # 入库时就转换为 Zircolite 规则（SQL），扫描不再跑 pySigma；已转换过的规则直接复用
+        converted, convert_results, unavailable = convert_new_rules(dict(zip(shas, rules)))
+        titles: Dict[str, str] = {}
+
         with db.engine.begin() as conn:
-            for idx, rule_obj in enumerate(rules):
-                rule_obj = _jsonable(rule_obj)  # 关键：入库前转换
+            for idx, (rule_obj, sha) in enumerate(zip(rules, shas)):
                 fallback_title = filename if len(rules) == 1 else f"{filename}#{idx+1}"
                 sigma_id, title, description, level = _extract_sigma_fields(rule_obj, fallback_title)
-
-                sha = _sha256_hex(_canonical_json_bytes(rule_obj))
+                titles[sha] = title
 
                 row = {
                     "sigma_id": sigma_id,
@@ -224,6 +240,8 @@ class MalSigmaUpload:
                 else:
                     skipped += 1
 
+            store_converted(conn, converted, now)
+
         return {
             "ok": True,
             "kind": "single",
@@ -233,6 +251,7 @@ class MalSigmaUpload:
             "skipped_count": skipped,
             "titles_sample": stored_titles[:50],
             "file_sha256": _sha256_hex(raw),
+            **_convert_summary(convert_results, titles, unavailable),
             "created_at": now.isoformat(timespec="seconds"),
         }
 
@@ -260,57 +279,71 @@ class MalSigmaUpload:
         stored_files: List[str] = []
         stored_titles: List[str] = []
 
+        # 1) 解析全部成员（不占用数据库连接）
+        parsed_members: List[Tuple[str, List[Dict[str, Any]], List[str]]] = []
         with zipfile.ZipFile(io.BytesIO(raw_zip)) as zf:
             members = _safe_zip_members(zf)
 
-            with db.engine.begin() as conn:
-                for info in members:
-                    member_name = info.filename.replace("\\", "/")
-                    data = zf.read(info)
-
-                    if len(data) > _MAX_SINGLE_FILE_BYTES:
-                        raise ValueError(f"zip 内文件过大：{member_name}")
-
-                    text = _decode_text(data)
-                    parsed = _parse_yaml(text, member_name)
-
-                    rules = _normalize_rules(parsed)
-                    if not rules:
-                        raise ValueError(f"zip 内 YAML 未找到可入库规则：{member_name}")
-
-                    file_inserted_any = False
-                    for idx, rule_obj in enumerate(rules):
-                        rule_obj = _jsonable(rule_obj)  #关键：入库前转换
-                        fallback_title = member_name if len(rules) == 1 else f"{member_name}#{idx+1}"
-                        sigma_id, title, description, level = _extract_sigma_fields(rule_obj, fallback_title)
-
-                        sha = _sha256_hex(_canonical_json_bytes(rule_obj))
-
-                        row = {
-                            "sigma_id": sigma_id,
-                            "title": title,
-                            "description": description,
-                            "rule_json": rule_obj,
-                            "level": level,
-                            "source_name": source_name or "manual-upload",
-                            "source_file": member_name,
-                            "sha256": sha,
-                            "enabled": 1,
-                            "created_at": now,
-                            "updated_at": now,
-                        }
-
-                        stmt = mysql_insert(table).values(**row).prefix_with("IGNORE")
-                        res = conn.execute(stmt)
-                        if res.rowcount == 1:
-                            inserted += 1
-                            stored_titles.append(title)
-                            file_inserted_any = True
-                        else:
-                            skipped += 1
-
-                    if file_inserted_any:
-                        stored_files.append(member_name)
+            for info in members:
+                member_name = info.filename.replace("\\", "/")
+                data = zf.read(info)
+
+                if len(data) > _MAX_SINGLE_FILE_BYTES:
+                    raise ValueError(f"zip 内文件过大：{member_name}")
+
+                text = _decode_text(data)
+                parsed = _parse_yaml(text, member_name)
+
+                rules = _normalize_rules(parsed)
+                if not rules:
+                    raise ValueError(f"zip 内 YAML 未找到可入库规则：{member_name}")
+
+                rules = [_jsonable(rule_obj) for rule_obj in rules]  #关键：入库前转换
+                shas = [_sha256_hex(_canonical_json_bytes(rule_obj)) for rule_obj in rules]
+                parsed_members.append((member_name, rules, shas))
+
+        # 2) 入库时就转换为 Zircolite 规则（SQL），扫描不再跑 pySigma；已转换过的规则直接复用
+        converted, convert_results, unavailable = convert_new_rules({
+            sha: rule_obj for _, rules, shas in parsed_members for rule_obj, sha in zip(rules, shas)
+        })
+        titles: Dict[str, str] = {}
+
+        # 3) 写库
+        with db.engine.begin() as conn:
+            for member_name, rules, shas in parsed_members:
+                file_inserted_any = False
+                for idx, (rule_obj, sha) in enumerate(zip(rules, shas)):
+                    fallback_title = member_name if len(rules) == 1 else f"{member_name}#{idx+1}"
+                    sigma_id, title, description, level = _extract_sigma_fields(rule_obj, fallback_title)
+                    titles[sha] = title
+
+                    row = {
+                        "sigma_id": sigma_id,
+                        "title": title,
+                        "description": description,
+                        "rule_json": rule_obj,
+                        "level": level,
+                        "source_name": source_name or "manual-upload",
+                        "source_file": member_name,
+                        "sha256": sha,
+                        "enabled": 1,
+                        "created_at": now,
+                        "updated_at": now,
+                    }
+
+                    stmt = mysql_insert(table).values(**row).prefix_with("IGNORE")
+                    res = conn.execute(stmt)
+                    if res.rowcount == 1:
+                        inserted += 1
+                        stored_titles.append(title)
+                        file_inserted_any = True
+                    else:
+                        skipped += 1
+
+                if file_inserted_any:
+                    stored_files.append(member_name)
+
+            store_converted(conn, converted, now)
 
         return {
             "ok": True,
@@ -322,5 +355,6 @@ class MalSigmaUpload:
             "stored_files": stored_files,
             "titles_sample": stored_titles[:50],
             "zip_sha256": _sha256_hex(raw_zip),
+            **_convert_summary(convert_results, titles, unavailable),
             "created_at": now.isoformat(timespec="seconds"),
         }
@@ -0,0 +1,143 @@
+# src/apps/services/MalYaraArchive.py
+import os
+import tarfile
+import tempfile
+import zipfile
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+_ZIP_EXT = (".zip",)
+_TAR_EXT = (".tar", ".tar.gz", ".tgz")
+
+# 嵌套压缩包最多展开的层数（最外层为 1）
+ARCHIVE_MAX_DEPTH = int(os.environ.get("YARA_ARCHIVE_MAX_DEPTH") or 3)
+# 单次请求解压出来的字节总数上限（含嵌套），防解压炸弹
+ARCHIVE_MAX_TOTAL_BYTES = int(os.environ.get("YARA_ARCHIVE_MAX_TOTAL_BYTES") or 4 * 1024 * 1024 * 1024)
+# 单次请求最多处理的成员数（含嵌套）
+ARCHIVE_MAX_MEMBERS = int(os.environ.get("YARA_ARCHIVE_MAX_MEMBERS") or 10000)
+# 嵌套压缩包需要可 seek（zip），小于该值留在内存，超过则落到临时文件
+_NESTED_SPOOL_MEMORY_BYTES = 16 * 1024 * 1024
+_COPY_CHUNK_BYTES = 1024 * 1024
+
+
+def is_archive_name(name: str) -> bool:
+    lower = (name or "").lower()
+    return lower.endswith(_ZIP_EXT) or lower.endswith(_TAR_EXT)
+
+
+def iter_archive_members(fileobj: BinaryIO, name: str) -> Iterator[Tuple[str, BinaryIO]]:
+    """
+    逐个产出压缩包成员：(成员路径, 解压流)。
+    成员不落盘，调用方在拿到下一个成员前把流读完。
+    """
+    lower = (name or "").lower()
+
+    if lower.endswith(_ZIP_EXT):
+        with zipfile.ZipFile(fileobj) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                with zf.open(info) as member:
+                    yield info.filename.replace("\\", "/"), member
+        return
+
+    if lower.endswith(_TAR_EXT):
+        # r|* 为流式模式：按顺序解压，不需要 seek
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tf:
+            for info in tf:
+                if not info.isfile():
+                    continue
+                member = tf.extractfile(info)
+                if member is None:
+                    continue
+                with member:
+                    yield info.name, member
+        return
+
+    raise ValueError("压缩包类型不支持：仅支持 .zip / .tar / .tar.gz / .tgz")
+
+
+class ArchiveBudget:
+    """
+    一次压缩包扫描的解压预算：成员数 + 解压总字节数，跨嵌套层共享。
+    """
+
+    def __init__(self, max_bytes: int = ARCHIVE_MAX_TOTAL_BYTES, max_members: int = ARCHIVE_MAX_MEMBERS):
+        self.max_bytes = max_bytes
+        self.max_members = max_members
+        self.bytes = 0
+        self.members = 0
+
+    def add_member(self) -> None:
+        # 字节预算已在上一个成员耗尽时，不再继续解压后面的成员
+        self.members += 1
+        if self.members > self.max_members or self.bytes > self.max_bytes:
+            raise ValueError("ARCHIVE_BUDGET_EXCEEDED")
+
+    def consume(self, n: int) -> None:
+        self.bytes += n
+        if self.bytes > self.max_bytes:
+            raise ValueError("ARCHIVE_BUDGET_EXCEEDED")
+
+
+class _BudgetReader:
+    """
+    包装成员解压流：每次 read 计入预算，超出时抛 ValueError。
+    """
+
+    def __init__(self, raw: BinaryIO, budget: ArchiveBudget):
+        self._raw = raw
+        self._budget = budget
+
+    def read(self, n: int = -1) -> bytes:
+        data = self._raw.read(n)
+        self._budget.consume(len(data))
+        return data
+
+
+def read_with_budget(raw: BinaryIO, budget: ArchiveBudget) -> bytes:
+    """
+    分块读完一个成员：每块先计入预算，超出立即中止，不会先把整个解压结果读进内存。
+    """
+    stream = _BudgetReader(raw, budget)
+    chunks = []
+    while True:
+        chunk = stream.read(_COPY_CHUNK_BYTES)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def iter_archive_members_recursive(fileobj: BinaryIO, name: str,
+                                   budget: Optional[ArchiveBudget] = None,
+                                   max_depth: int = ARCHIVE_MAX_DEPTH,
+                                   _prefix: str = "",
+                                   _depth: int = 1) -> Iterator[Tuple[str, BinaryIO, int]]:
+    """
+    递归产出压缩包成员：(成员路径, 流, 所在层数)，嵌套路径用 "::" 连接。
+    嵌套压缩包本身也作为一个成员产出，随后（未超过 max_depth 时）继续展开；
+    它需要可 seek，因此先放进 SpooledTemporaryFile（小的在内存，大的落临时文件）。
+    """
+    budget = budget or ArchiveBudget()
+
+    for member_name, member in iter_archive_members(fileobj, name):
+        budget.add_member()
+        path = _prefix + member_name
+        stream = _BudgetReader(member, budget)
+
+        if _depth >= max_depth or not is_archive_name(member_name):
+            yield path, stream, _depth
+            continue
+
+        with tempfile.SpooledTemporaryFile(max_size=_NESTED_SPOOL_MEMORY_BYTES) as nested:
+            while True:
+                chunk = stream.read(_COPY_CHUNK_BYTES)
+                if not chunk:
+                    break
+                nested.write(chunk)
+
+            nested.seek(0)
+            yield path, nested, _depth
+            nested.seek(0)
+            yield from iter_archive_members_recursive(nested, member_name, budget, max_depth,
+                                                      _prefix=path + "::", _depth=_depth + 1)
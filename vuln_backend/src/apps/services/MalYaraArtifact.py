@@ -0,0 +1,186 @@
+# src/apps/services/MalYaraArtifact.py
+import hashlib
+import os
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import yara  # pip install yara-python
+
+from sqlalchemy import MetaData, Table, select, update
+from src.extension import *
+
+metadata = MetaData()
+
+
+def _get_yara_rule_table() -> Table:
+    return Table("yara_rule", metadata, autoload_with=db.engine)
+
+
+# -----------------------
+# 配置
+# -----------------------
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+# 单文件编译产物按 compiled_sha256 内容寻址存放：<dir>/<sha[:2]>/<sha>.yarc
+ARTIFACT_STORE_DIR = os.environ.get("YARA_ARTIFACT_DIR") or os.path.join(PROJECT_ROOT, "runtime", "yara_artifacts")
+# 为 1 时上传仍把编译产物同时写入 yara_rule.compiled_rule（便于回滚到旧版本）
+KEEP_DB_BLOB = (os.environ.get("YARA_ARTIFACT_KEEP_DB_BLOB") or "0") in ("1", "true", "True")
+# 迁移时每批从 MySQL 读取的 blob 数
+_MIGRATE_BATCH = 50
+
+
+def artifact_path(compiled_sha: str) -> str:
+    return os.path.join(ARTIFACT_STORE_DIR, compiled_sha[:2], compiled_sha + ".yarc")
+
+
+def has_artifact(compiled_sha: str) -> bool:
+    return bool(compiled_sha) and os.path.isfile(artifact_path(compiled_sha))
+
+
+def put_artifact(blob: bytes, compiled_sha: Optional[str] = None) -> str:
+    """
+    写入编译产物，返回 sha256；同名文件已存在时不重复写。
+    先写临时文件再 os.replace，并发写同一 sha 也不会读到半个文件。
+    """
+    compiled_sha = compiled_sha or hashlib.sha256(blob).hexdigest()
+    path = artifact_path(compiled_sha)
+    if os.path.isfile(path):
+        return compiled_sha
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(blob)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return compiled_sha
+
+
+def db_blob_value(blob: bytes) -> bytes:
+    """
+    yara_rule.compiled_rule 的写入值：默认只存哈希，blob 列留空。
+    """
+    return blob if KEEP_DB_BLOB else b""
+
+
+def load_compiled_rules(compiled_ids: List[int]
+                        ) -> Tuple[List[Tuple[str, "yara.Rules"]], List[Dict[str, Any]]]:
+    """
+    按 yara_rule.id 加载单文件编译产物，按 compiled_sha256 去重：
+      - 优先从文件仓库 yara.load(filepath=...)，不经过 MySQL 连接
+      - 文件缺失时才回读 compiled_rule，并顺手写回文件仓库（惰性迁移）
+    返回 (bundles, missing)：missing 为文件仓库和 compiled_rule 都没有产物的
+    [{"id", "compiled_sha256"}]，调用方必须报告，不能当作规则不存在。
+    """
+    if not compiled_ids:
+        return [], []
+
+    yara_rule_table = _get_yara_rule_table()
+    with db.engine.connect() as conn:
+        rows = conn.execute(
+            select(yara_rule_table.c.id, yara_rule_table.c.compiled_sha256)
+            .where(yara_rule_table.c.id.in_(compiled_ids))
+        ).mappings().all()
+
+    shas: Dict[str, int] = {}
+    missing_rows: List[Dict[str, Any]] = []
+    found_ids = set()
+    for r in rows:
+        found_ids.add(int(r["id"]))
+        csha = (r.get("compiled_sha256") or "").strip()
+        if not csha:
+            missing_rows.append({"id": int(r["id"]), "compiled_sha256": None})
+        elif csha not in shas:
+            shas[csha] = int(r["id"])
+    missing_rows.extend({"id": int(i), "compiled_sha256": None} for i in compiled_ids if int(i) not in found_ids)
+
+    missing = [rid for csha, rid in shas.items() if not has_artifact(csha)]
+    if missing:
+        with db.engine.connect() as conn:
+            blob_rows = conn.execute(
+                select(yara_rule_table.c.compiled_sha256, yara_rule_table.c.compiled_rule)
+                .where(yara_rule_table.c.id.in_(missing))
+            ).mappings().all()
+        for r in blob_rows:
+            if r.get("compiled_rule"):
+                put_artifact(r["compiled_rule"], r["compiled_sha256"].strip())
+
+    bundles: List[Tuple[str, yara.Rules]] = []
+    for csha, rid in shas.items():
+        if has_artifact(csha):
+            bundles.append((csha, yara.load(filepath=artifact_path(csha))))
+        else:
+            missing_rows.append({"id": rid, "compiled_sha256": csha})
+    return bundles, missing_rows
+
+
+def _migrate_db_blobs(clear_db: bool = False) -> Dict[str, Any]:
+    """
+    把 yara_rule.compiled_rule 里已有的 blob 全部写入文件仓库。
+    clear_db=True 时，写入并校验哈希后把 blob 列清空，释放 MySQL 存储和 buffer pool。
+    """
+    yara_rule_table = _get_yara_rule_table()
+    with db.engine.connect() as conn:
+        ids = [int(i) for i in conn.execute(
+            select(yara_rule_table.c.id).order_by(yara_rule_table.c.id)
+        ).scalars().all()]
+
+    migrated = 0
+    already = 0
+    cleared = 0
+    errors: List[Dict[str, Any]] = []
+    for start in range(0, len(ids), _MIGRATE_BATCH):
+        batch = ids[start:start + _MIGRATE_BATCH]
+        with db.engine.connect() as conn:
+            rows = conn.execute(
+                select(yara_rule_table.c.id, yara_rule_table.c.compiled_sha256, yara_rule_table.c.compiled_rule)
+                .where(yara_rule_table.c.id.in_(batch))
+            ).mappings().all()
+
+        verified: List[int] = []
+        for r in rows:
+            csha = (r.get("compiled_sha256") or "").strip()
+            blob = r.get("compiled_rule")
+            if not blob:
+                if has_artifact(csha):
+                    already += 1
+                else:
+                    errors.append({"id": r["id"], "error": "compiled_rule 为空且文件仓库中不存在"})
+                continue
+            if hashlib.sha256(blob).hexdigest() != csha:
+                errors.append({"id": r["id"], "error": "compiled_sha256 与 compiled_rule 不一致"})
+                continue
+            if has_artifact(csha):
+                already += 1
+            else:
+                put_artifact(blob, csha)
+                migrated += 1
+            verified.append(int(r["id"]))
+
+        if clear_db and verified:
+            with db.engine.begin() as conn:
+                conn.execute(
+                    update(yara_rule_table)
+                    .where(yara_rule_table.c.id.in_(verified))
+                    .values(compiled_rule=b"")
+                )
+            cleared += len(verified)
+
+    return {
+        "ok": True,
+        "store_dir": ARTIFACT_STORE_DIR,
+        "total": len(ids),
+        "migrated": migrated,
+        "already_in_store": already,
+        "cleared_db_blobs": cleared,
+        "errors": errors,
+    }
+
+
+class MalYaraArtifact:
+
+    @staticmethod
+    def migrate(clear_db: bool = False) -> Dict[str, Any]:
+        return _migrate_db_blobs(clear_db)
@@ -0,0 +1,80 @@
+# src/apps/services/MalYaraCompile.py
+import io
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple
+
+import yara  # pip install yara-python
+
+# -----------------------
+# 配置
+# -----------------------
+# yara.compile 持有 GIL，多文件编译用进程池才能用满多核
+COMPILE_WORKERS = int(os.environ.get("YARA_COMPILE_WORKERS") or (os.cpu_count() or 4))
+# 文件数少于该值时直接在当前进程编译，省掉进程池的启动 / 传输开销
+_MIN_PARALLEL_FILES = 4
+
+# (编译产物, 错误信息, 编译器告警)
+CompileResult = Tuple[Optional[bytes], str, List[str]]
+
+
+def rules_to_blob(rules: "yara.Rules") -> bytes:
+    """
+    编译产物直接 save 到内存缓冲区，不再为每次编译创建临时目录。
+    """
+    buf = io.BytesIO()
+    rules.save(file=buf)
+    return buf.getvalue()
+
+
+def compile_file_to_blob(filepath: str) -> CompileResult:
+    """
+    进程池 worker：用 filepath 编译（支持 include，相对路径基于文件所在目录）。
+    yara.Rules 不能跨进程传递，返回 (编译产物, 错误信息, 编译器告警)。
+    """
+    try:
+        rules = yara.compile(filepath=filepath)
+    except yara.Error as e:
+        return None, str(e), []
+    return rules_to_blob(rules), "", list(rules.warnings or [])
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # 各平台统一用 spawn：不 fork 带着任务队列 / 预热线程的服务进程；
+            # 子进程只按需导入本模块，启动后台任务处另有子进程判断（见 start_background_tasks）
+            _pool = ProcessPoolExecutor(max_workers=max(1, COMPILE_WORKERS),
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def compile_files_to_blobs(filepaths: List[str]) -> List[CompileResult]:
+    """
+    并行编译多个规则文件，结果与 filepaths 一一对应：(编译产物, 错误信息, 编译器告警)。
+    进程池不可用（worker 崩溃等）时退回当前进程逐个编译。
+    """
+    if len(filepaths) < _MIN_PARALLEL_FILES or COMPILE_WORKERS <= 1:
+        return [compile_file_to_blob(p) for p in filepaths]
+
+    try:
+        return list(_get_pool().map(compile_file_to_blob, filepaths))
+    except BrokenProcessPool:
+        _reset_pool()
+        return [compile_file_to_blob(p) for p in filepaths]
@@ -0,0 +1,81 @@
+# src/apps/services/MalYaraExecutor.py
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+# -----------------------
+# 配置
+# -----------------------
+# yara-python 在 match() 期间释放 GIL，且同一份 yara.Rules 可被多线程并发使用，
+# 因此线程池即可占满多核，规则集只在进程内加载一次、所有 worker 共享。
+SCAN_WORKERS = int(os.environ.get("YARA_SCAN_WORKERS") or (os.cpu_count() or 4))
+
+
+class ScanExecutor:
+    """
+    YARA 扫描线程池：
+      - submit() 提交扫描任务，返回 Future
+      - stats() 返回队列深度 / 运行中任务数 / 利用率
+    """
+
+    def __init__(self, workers: int = SCAN_WORKERS):
+        self.workers = max(1, int(workers))
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="yara-scan")
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._busy_seconds = 0.0
+        self._started_at = time.time()
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        with self._lock:
+            self._queued += 1
+
+        def _run():
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+            started = time.perf_counter()
+            ok = False
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self._running -= 1
+                    self._busy_seconds += elapsed
+                    if ok:
+                        self._completed += 1
+                    else:
+                        self._failed += 1
+
+        return self._pool.submit(_run)
+
+    def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return self.submit(fn, *args, **kwargs).result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            uptime = max(time.time() - self._started_at, 1e-6)
+            return {
+                "workers": self.workers,
+                "queue_depth": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "failed": self._failed,
+                "busy_seconds": round(self._busy_seconds, 3),
+                "uptime_seconds": round(uptime, 3),
+                # 瞬时利用率：正在扫描的 worker 占比
+                "utilisation": round(self._running / self.workers, 4),
+                # 平均利用率：累计扫描耗时 / (worker 数 * 运行时长)
+                "avg_utilisation": round(min(self._busy_seconds / (self.workers * uptime), 1.0), 4),
+            }
+
+
+SCAN_EXECUTOR = ScanExecutor()
@@ -0,0 +1,256 @@
+# src/apps/services/MalYaraLint.py
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import MetaData, Table, Column, String, Integer, DateTime, JSON, select, update, inspect, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from src.extension import *
+
+metadata = MetaData()
+
+# 编译期性能检查结果：每条规则（按 rule_text sha256）一行
+_yara_rule_lint = Table(
+    "yara_rule_lint",
+    metadata,
+    Column("rule_sha256", String(64), primary_key=True),
+    Column("rule_name", String(255), nullable=False),
+    Column("source_name", String(255), nullable=True),
+    Column("source_file", String(512), nullable=True),
+    Column("compiled_rule_id", Integer, nullable=True, index=True),
+    Column("warnings", JSON, nullable=False),
+    Column("cost_reasons", JSON, nullable=False),
+    Column("cost_score", Integer, nullable=False, index=True),
+    Column("flagged", Integer, nullable=False, index=True),
+    # 被停用的慢规则：合并编译时剔除（按规则停用，不影响同一文件里的其它规则）
+    Column("disabled", Integer, nullable=False, default=0, index=True),
+    Column("created_at", DateTime, nullable=False),
+)
+
+_columns_checked = False
+_columns_lock = threading.Lock()
+
+
+def get_yara_rule_lint_table() -> Table:
+    global _columns_checked
+    table = ensure_table(_yara_rule_lint)
+    if not _columns_checked:
+        with _columns_lock:
+            if not _columns_checked:
+                # 旧表补列
+                cols = {c["name"] for c in inspect(db.engine).get_columns(table.name)}
+                if "disabled" not in cols:
+                    with db.engine.begin() as conn:
+                        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN disabled INT NOT NULL DEFAULT 0"))
+                _columns_checked = True
+    return table
+
+
+# -----------------------
+# 配置
+# -----------------------
+# 慢规则处理策略：store（照常入库，仅记录）| disable（被标记的规则停用，同文件其它规则照常）| reject（拒绝上传）
+SLOW_RULE_POLICY = (os.environ.get("YARA_SLOW_RULE_POLICY") or "store").strip().lower()
+# 估算开销达到该分值即视为慢规则（有编译器性能告警的规则总是视为慢规则）
+SLOW_RULE_COST_THRESHOLD = int(os.environ.get("YARA_SLOW_RULE_COST_THRESHOLD") or 5)
+
+_POLICIES = ("store", "disable", "reject")
+
+# 编译器告警："line 12: ..."（source 编译）或 "/path/x.yar(12): ..."（filepath 编译）
+_WARNING_RE = re.compile(r"^(?:line (\d+)|(.*)\((\d+)\)):\s*(.*)$")
+_RULE_HEADER_RE = re.compile(r"(?m)^\s*(?:(?:private|global)\s+)*rule\s+([A-Za-z_]\w*)\b")
+
+# 开销估算：只看 strings / condition 里的典型慢写法
+_TEXT_STRING_RE = re.compile(r'^\s*\$\w*\s*=\s*"((?:[^"\\]|\\.)*)"(.*)$', re.M)
+_HEX_STRING_RE = re.compile(r"^\s*\$\w*\s*=\s*\{([^}]*)\}", re.M)
+_REGEX_STRING_RE = re.compile(r"^\s*\$\w*\s*=\s*/((?:[^/\\]|\\.)*)/", re.M)
+_UNBOUNDED_REGEX_RE = re.compile(r"\.\*|\.\+|\.\{\d*,\}")
+_UNBOUNDED_JUMP_RE = re.compile(r"\[\s*\d*\s*-\s*\]")
+_FILESIZE_LOOP_RE = re.compile(r"\bfor\b[^:]*\bin\s*\(\s*\w+\s*\.\.\s*filesize\s*\)|\(\s*0\s*,\s*filesize\s*\)")
+
+
+def _policy() -> str:
+    return SLOW_RULE_POLICY if SLOW_RULE_POLICY in _POLICIES else "store"
+
+
+def estimate_rule_cost(rule_text: str) -> Tuple[int, List[str]]:
+    """
+    粗略估算单条规则的扫描开销，返回 (分值, 原因)。
+    只用于排序 / 标记，不追求精确。
+    """
+    score = 0
+    reasons: List[str] = []
+
+    for m in _TEXT_STRING_RE.finditer(rule_text):
+        literal = re.sub(r"\\.", "x", m.group(1))
+        if len(literal) < 4:
+            score += 3
+            reasons.append(f"短字符串（{len(literal)} 字节）")
+        modifiers = m.group(2) or ""
+        if "nocase" in modifiers and "wide" in modifiers:
+            score += 1
+            reasons.append("nocase + wide")
+
+    for m in _HEX_STRING_RE.finditer(rule_text):
+        body = m.group(1)
+        if _UNBOUNDED_JUMP_RE.search(body):
+            score += 5
+            reasons.append("hex 无上限跳转 [n-]")
+        fixed = re.findall(r"\b[0-9A-Fa-f]{2}\b", body)
+        if len(fixed) < 4:
+            score += 3
+            reasons.append("hex 固定字节过少")
+
+    for m in _REGEX_STRING_RE.finditer(rule_text):
+        score += 1
+        if _UNBOUNDED_REGEX_RE.search(m.group(1)):
+            score += 5
+            reasons.append("正则无上限重复 .* / .+ / .{n,}")
+
+    _, _, condition = rule_text.partition("condition:")
+    if _FILESIZE_LOOP_RE.search(condition):
+        score += 5
+        reasons.append("condition 遍历整个文件")
+
+    return score, reasons
+
+
+def warnings_by_rule(source_text: str, warnings: List[str], source_path: Optional[str] = None) -> Dict[str, List[str]]:
+    """
+    把编译器告警按行号归到规则名下。
+    filepath 编译时只统计本文件的告警（include 进来的文件各自统计）。
+    """
+    starts = [(source_text.count("\n", 0, m.start()) + 1, m.group(1)) for m in _RULE_HEADER_RE.finditer(source_text)]
+    out: Dict[str, List[str]] = {}
+    for w in warnings or []:
+        m = _WARNING_RE.match(w.strip())
+        if not m:
+            continue
+        path = m.group(2)
+        if path and source_path and os.path.normpath(path) != os.path.normpath(source_path):
+            continue
+        line = int(m.group(1) or m.group(3))
+        owner = None
+        for start_line, name in starts:
+            if start_line <= line:
+                owner = name
+            else:
+                break
+        if owner:
+            out.setdefault(owner, []).append(f"line {line}: {m.group(4)}")
+    return out
+
+
+def lint_rules(rows: List[Dict[str, Any]], rule_warnings: Dict[str, List[str]]) -> List[Dict[str, Any]]:
+    """
+    rows 为 yara_uncompiled 行（rule_name / rule_text / sha256 ...），
+    返回对应的 lint 记录（flagged 表示慢规则；policy=disable 时慢规则 disabled=1）。
+    """
+    disable = _policy() == "disable"
+    out: List[Dict[str, Any]] = []
+    for r in rows:
+        warns = rule_warnings.get(r["rule_name"], [])
+        score, reasons = estimate_rule_cost(r["rule_text"])
+        score += 5 * len(warns)
+        flagged = bool(warns or score >= SLOW_RULE_COST_THRESHOLD)
+        out.append({
+            "rule_sha256": r["sha256"],
+            "rule_name": r["rule_name"],
+            "source_name": r.get("source_name"),
+            "source_file": r.get("source_file"),
+            "compiled_rule_id": r.get("compiled_rule_id"),
+            "warnings": warns,
+            "cost_reasons": reasons,
+            "cost_score": score,
+            "flagged": 1 if flagged else 0,
+            "disabled": 1 if (flagged and disable) else 0,
+        })
+    return out
+
+
+def enforce_policy(lints: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    policy=reject 时有慢规则则抛 ValueError；返回被标记的 lint 记录。
+    """
+    flagged = [item for item in lints if item["flagged"]]
+    if flagged and _policy() == "reject":
+        names = ", ".join(f"{item['source_file']}:{item['rule_name']}" for item in flagged[:20])
+        raise ValueError(f"SLOW_RULE_REJECTED（{len(flagged)} 条）: {names}")
+    return flagged
+
+
+def disabled_rule_shas() -> List[str]:
+    """
+    已停用的慢规则（yara_uncompiled.sha256），合并编译时剔除，也计入规则集版本。
+    """
+    table = get_yara_rule_lint_table()
+    with db.engine.connect() as conn:
+        return sorted(conn.execute(select(table.c.rule_sha256).where(table.c.disabled == 1)).scalars().all())
+
+
+def store_lints(conn, lints: List[Dict[str, Any]], now: datetime) -> None:
+    if not lints:
+        return
+    table = get_yara_rule_lint_table()
+    stmt = mysql_insert(table).values([{**item, "created_at": now} for item in lints])
+    stmt = stmt.on_duplicate_key_update(
+        compiled_rule_id=stmt.inserted.compiled_rule_id,
+        warnings=stmt.inserted.warnings,
+        cost_reasons=stmt.inserted.cost_reasons,
+        cost_score=stmt.inserted.cost_score,
+        flagged=stmt.inserted.flagged,
+        # disabled 不覆盖：已有记录保留人工启停的结果
+    )
+    conn.execute(stmt)
+
+
+class MalYaraLint:
+
+    @staticmethod
+    def list_slow_rules(limit: int = 100, flagged_only: bool = True) -> Dict[str, Any]:
+        try:
+            limit = max(1, min(int(limit), 1000))
+        except (TypeError, ValueError):
+            raise ValueError("limit 参数非法")
+
+        table = get_yara_rule_lint_table()
+        stmt = select(table).order_by(table.c.cost_score.desc(), table.c.rule_name).limit(limit)
+        if flagged_only:
+            stmt = stmt.where(table.c.flagged == 1)
+
+        with db.engine.connect() as conn:
+            rows = conn.execute(stmt).mappings().all()
+
+        items = []
+        for r in rows:
+            item = dict(r)
+            item["created_at"] = r["created_at"].isoformat(timespec="seconds") if r["created_at"] else None
+            items.append(item)
+        return {
+            "ok": True,
+            "policy": _policy(),
+            "disabled_count": sum(1 for item in items if item.get("disabled")),
+            "cost_threshold": SLOW_RULE_COST_THRESHOLD,
+            "count": len(items),
+            "items": items,
+        }
+
+    @staticmethod
+    def set_rule_enabled(rule_sha256: str, enabled: bool) -> Dict[str, Any]:
+        """
+        人工确认后启用 / 停用单条慢规则；规则集版本随之变化，下次扫描自动重建。
+        """
+        rule_sha256 = (rule_sha256 or "").strip().lower()
+        if not re.fullmatch(r"[0-9a-f]{64}", rule_sha256):
+            raise ValueError("rule_sha256 参数非法")
+
+        table = get_yara_rule_lint_table()
+        with db.engine.begin() as conn:
+            res = conn.execute(
+                update(table).where(table.c.rule_sha256 == rule_sha256).values(disabled=0 if enabled else 1)
+            )
+        if res.rowcount == 0:
+            raise ValueError("规则不存在：rule_sha256")
+        return {"ok": True, "rule_sha256": rule_sha256, "enabled": enabled}
@@ -0,0 +1,333 @@
+# src/apps/services/MalYaraProfile.py
+import os
+import shutil
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+import yara  # pip install yara-python
+
+from sqlalchemy import MetaData, Table, Column, String, Integer, Float, DateTime, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from src.extension import *
+from src.apps.services.MalYaraArchive import ArchiveBudget, is_archive_name, iter_archive_members, read_with_budget
+from src.apps.services.MalYaraArtifact import load_compiled_rules
+from src.apps.services.MalYaraRuleset import MalYaraRuleset, get_yara_rule_table
+from src.apps.utils.job_queue import JobQueue, STATUS_FAILED
+
+metadata = MetaData()
+
+# 规则开销画像：每个 yara_rule（单文件编译产物）一行，记录最近一次对参考样本集的扫描耗时
+_yara_rule_profile = Table(
+    "yara_rule_profile",
+    metadata,
+    Column("compiled_rule_id", Integer, primary_key=True),
+    Column("source_name", String(255), nullable=True),
+    Column("source_file", String(512), nullable=True),
+    Column("compiled_sha256", String(64), nullable=True),
+    Column("samples", Integer, nullable=False),
+    Column("total_ms", Float, nullable=False),
+    Column("avg_ms", Float, nullable=False, index=True),
+    Column("max_ms", Float, nullable=False),
+    Column("match_count", Integer, nullable=False),
+    Column("timeouts", Integer, nullable=False),
+    Column("flagged", Integer, nullable=False, index=True),
+    Column("disabled", Integer, nullable=False),
+    Column("job_id", String(64), nullable=False),
+    Column("profiled_at", DateTime, nullable=False),
+)
+
+
+def get_yara_rule_profile_table() -> Table:
+    return ensure_table(_yara_rule_profile)
+
+
+# -----------------------
+# 配置
+# -----------------------
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+# 未上传样本集时使用的默认参考样本目录（只读取第一层文件）
+PROFILE_CORPUS_DIR = os.environ.get("YARA_PROFILE_CORPUS_DIR") or os.path.join(PROJECT_ROOT, "runtime", "yara_profile_corpus")
+PROFILE_MAX_CORPUS_FILES = int(os.environ.get("YARA_PROFILE_MAX_CORPUS_FILES") or 200)
+# 样本集整体放在内存里反复扫描，总大小需要有上限
+PROFILE_MAX_CORPUS_BYTES = int(os.environ.get("YARA_PROFILE_MAX_CORPUS_BYTES") or 256 * 1024 * 1024)
+MAX_CORPUS_UPLOAD_BYTES = 1024 * 1024 * 1024
+# 单个 bundle 对单个样本的扫描超时（秒），超时按该值计入耗时
+PROFILE_SAMPLE_TIMEOUT_SECONDS = int(os.environ.get("YARA_PROFILE_SAMPLE_TIMEOUT_SECONDS") or 10)
+# 延迟预算：bundle 平均每个样本耗时超过该值（毫秒）或出现超时即标记
+PROFILE_LATENCY_BUDGET_MS = float(os.environ.get("YARA_PROFILE_LATENCY_BUDGET_MS") or 200)
+
+_ACTIONS = ("flag", "disable")
+_COPY_CHUNK_BYTES = 1024 * 1024
+
+
+def _load_corpus_dir(path: str) -> Tuple[List[Tuple[str, bytes]], bool]:
+    """
+    读取参考样本目录，到达文件数 / 字节数上限即停止；返回 (样本集, 是否截断)。
+    """
+    if not os.path.isdir(path):
+        raise ValueError(f"参考样本目录不存在：{path}（请上传样本集压缩包或配置 YARA_PROFILE_CORPUS_DIR）")
+
+    corpus: List[Tuple[str, bytes]] = []
+    total = 0
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if not os.path.isfile(full):
+            continue
+        if len(corpus) >= PROFILE_MAX_CORPUS_FILES:
+            return corpus, True
+        size = os.path.getsize(full)
+        if total + size > PROFILE_MAX_CORPUS_BYTES:
+            return corpus, True
+        with open(full, "rb") as f:
+            corpus.append((name, f.read()))
+        total += size
+    return corpus, False
+
+
+def _safe_filename(name: str) -> str:
+    # 简单去危险字符，避免路径穿越
+    name = (name or "").replace("\\", "/").split("/")[-1]
+    return name.replace("..", "_")
+
+
+def _load_corpus_archive(path: str) -> Tuple[List[Tuple[str, bytes]], bool]:
+    """
+    与 _load_corpus_dir 一致：到达文件数 / 字节数上限即停止（超限的成员整个丢弃），
+    返回 (样本集, 是否截断)。成员分块读取，超限时不会先把整个成员读进内存。
+    """
+    budget = ArchiveBudget(max_bytes=PROFILE_MAX_CORPUS_BYTES, max_members=PROFILE_MAX_CORPUS_FILES)
+    corpus: List[Tuple[str, bytes]] = []
+    with open(path, "rb") as fh:
+        for member_name, member in iter_archive_members(fh, os.path.basename(path)):
+            try:
+                budget.add_member()
+                corpus.append((member_name, read_with_budget(member, budget)))
+            except ValueError as e:
+                if str(e) != "ARCHIVE_BUDGET_EXCEEDED":
+                    raise
+                return corpus, True
+    return corpus, False
+
+
+def _profile_bundle(rules: "yara.Rules", corpus: List[Tuple[str, bytes]]) -> Dict[str, Any]:
+    """
+    用一个 bundle 依次扫描整个样本集，返回耗时 / 命中统计。
+    """
+    times: List[float] = []
+    match_count = 0
+    timeouts = 0
+    for _, data in corpus:
+        t0 = time.perf_counter()
+        try:
+            match_count += len(rules.match(data=data, timeout=PROFILE_SAMPLE_TIMEOUT_SECONDS))
+            times.append((time.perf_counter() - t0) * 1000)
+        except yara.TimeoutError:
+            timeouts += 1
+            times.append(PROFILE_SAMPLE_TIMEOUT_SECONDS * 1000.0)
+
+    total_ms = sum(times)
+    avg_ms = total_ms / len(times) if times else 0.0
+    return {
+        "samples": len(times),
+        "total_ms": round(total_ms, 3),
+        "avg_ms": round(avg_ms, 3),
+        "max_ms": round(max(times), 3) if times else 0.0,
+        "match_count": match_count,
+        "timeouts": timeouts,
+        "flagged": 1 if (timeouts or avg_ms > PROFILE_LATENCY_BUDGET_MS) else 0,
+    }
+
+
+def _store_profile(row: Dict[str, Any]) -> None:
+    table = get_yara_rule_profile_table()
+    stmt = mysql_insert(table).values(**row)
+    stmt = stmt.on_duplicate_key_update(**{k: stmt.inserted[k] for k in row if k != "compiled_rule_id"})
+    with db.engine.begin() as conn:
+        conn.execute(stmt)
+
+
+def _run_profile_job(job: Dict[str, Any], queue: JobQueue) -> Dict[str, Any]:
+    """
+    画像任务：逐个 yara_rule 加载编译产物，对同一份样本集计时扫描，结果写入 yara_rule_profile。
+    action=disable 时把超出延迟预算的 bundle 置为 enabled=0。
+    """
+    job_id = job["job_id"]
+    params = job["params"]
+    action = params.get("action") or "flag"
+    corpus_path = params.get("corpus_path")
+
+    try:
+        queue.set_progress(job_id, phase="loading_corpus")
+        corpus, truncated = _load_corpus_archive(corpus_path) if corpus_path else _load_corpus_dir(PROFILE_CORPUS_DIR)
+        if not corpus:
+            raise ValueError("参考样本集为空")
+
+        yara_rule_table = get_yara_rule_table()
+        stmt = select(
+            yara_rule_table.c.id,
+            yara_rule_table.c.source_name,
+            yara_rule_table.c.source_file,
+            yara_rule_table.c.compiled_sha256,
+        ).order_by(yara_rule_table.c.id)
+        if params.get("rule_set", "enabled") == "enabled":
+            stmt = stmt.where(yara_rule_table.c.enabled == 1)
+        with db.engine.connect() as conn:
+            bundles = conn.execute(stmt).mappings().all()
+
+        flagged: List[Dict[str, Any]] = []
+        disabled_ids: List[int] = []
+        errors: List[Dict[str, Any]] = []
+        for i, b in enumerate(bundles):
+            queue.set_progress(job_id, phase="profiling", done=i, total=len(bundles))
+
+            # 编译产物逐个加载，避免一次把所有 bundle 放进内存
+            try:
+                loaded, _ = load_compiled_rules([b["id"]])
+                if not loaded:
+                    raise ValueError("编译产物不存在：文件仓库和 compiled_rule 均为空")
+            except (ValueError, OSError, yara.Error) as e:
+                errors.append({"compiled_rule_id": b["id"], "source_file": b["source_file"], "error": str(e)})
+                continue
+            rules = loaded[0][1]
+
+            stats = _profile_bundle(rules, corpus)
+            disable = action == "disable" and stats["flagged"]
+            if disable:
+                with db.engine.begin() as conn:
+                    conn.execute(
+                        update(yara_rule_table)
+                        .where(yara_rule_table.c.id == b["id"])
+                        .values(enabled=0, updated_at=datetime.now())
+                    )
+                disabled_ids.append(b["id"])
+
+            row = {
+                "compiled_rule_id": b["id"],
+                "source_name": b["source_name"],
+                "source_file": b["source_file"],
+                "compiled_sha256": b["compiled_sha256"],
+                **stats,
+                "disabled": 1 if disable else 0,
+                "job_id": job_id,
+                "profiled_at": datetime.now(),
+            }
+            _store_profile(row)
+            if stats["flagged"]:
+                flagged.append({k: row[k] for k in ("compiled_rule_id", "source_name", "source_file",
+                                                    "avg_ms", "max_ms", "timeouts", "disabled")})
+
+        if disabled_ids:
+            MalYaraRuleset.invalidate()
+
+        return {
+            "ok": True,
+            "job_id": job_id,
+            "action": action,
+            "latency_budget_ms": PROFILE_LATENCY_BUDGET_MS,
+            "corpus_files": len(corpus),
+            "corpus_bytes": sum(len(d) for _, d in corpus),
+            # 样本集超过 PROFILE_MAX_CORPUS_FILES / PROFILE_MAX_CORPUS_BYTES，只用了前面一部分
+            "truncated": truncated,
+            "bundles": len(bundles),
+            "flagged": flagged,
+            "disabled_ids": disabled_ids,
+            "errors": errors,
+        }
+    finally:
+        shutil.rmtree(queue.job_dir(job_id), ignore_errors=True)
+
+
+PROFILE_JOBS = JobQueue("yara_profile", _run_profile_job, workers=1)
+
+
+class MalYaraProfile:
+
+    @staticmethod
+    def submit_profile_job(file_storage=None,
+                           rule_set: str = "enabled",
+                           action: str = "flag") -> Dict[str, Any]:
+        """
+        提交画像任务：file 为参考样本集压缩包（zip / tar），不传则使用 YARA_PROFILE_CORPUS_DIR。
+        """
+        MalYaraRuleset.check_rule_set(rule_set)
+        if action not in _ACTIONS:
+            raise ValueError("action 参数非法：仅允许 flag|disable")
+
+        has_file = file_storage is not None and bool(file_storage.filename)
+        if has_file and not is_archive_name(file_storage.filename):
+            raise ValueError("文件类型不支持：参考样本集仅支持 .zip / .tar / .tar.gz / .tgz")
+
+        job_id = PROFILE_JOBS.new_job_id()
+        params: Dict[str, Any] = {"rule_set": rule_set, "action": action}
+        if has_file:
+            job_dir = PROFILE_JOBS.job_dir(job_id)
+            os.makedirs(job_dir, exist_ok=True)
+            corpus_path = os.path.join(job_dir, _safe_filename(file_storage.filename) or "corpus.bin")
+            size = 0
+            try:
+                with open(corpus_path, "wb") as out:
+                    while True:
+                        chunk = file_storage.stream.read(_COPY_CHUNK_BYTES)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        if size > MAX_CORPUS_UPLOAD_BYTES:
+                            raise ValueError("FILE_TOO_LARGE")
+                        out.write(chunk)
+            except BaseException:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                raise
+            params["corpus_path"] = corpus_path
+
+        PROFILE_JOBS.submit(params, job_id=job_id)
+        return {"ok": True, "job_id": job_id, "status": "queued"}
+
+    @staticmethod
+    def profile_job_status(job_id: str) -> Dict[str, Any]:
+        job = PROFILE_JOBS.get(job_id or "")
+        if job is None:
+            raise ValueError("任务不存在：job_id")
+        data = {
+            "ok": True,
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "progress": job["progress"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+        }
+        if "queue_position" in job:
+            data["queue_position"] = job["queue_position"]
+        if job["result"] is not None:
+            data["result"] = job["result"]
+        if job["status"] == STATUS_FAILED:
+            data["message"] = job["error"]
+        return data
+
+    @staticmethod
+    def top_expensive(limit: int = 20, flagged_only: bool = False) -> Dict[str, Any]:
+        try:
+            limit = max(1, min(int(limit), 1000))
+        except (TypeError, ValueError):
+            raise ValueError("limit 参数非法")
+
+        table = get_yara_rule_profile_table()
+        stmt = select(table).order_by(table.c.avg_ms.desc(), table.c.compiled_rule_id).limit(limit)
+        if flagged_only:
+            stmt = stmt.where(table.c.flagged == 1)
+
+        with db.engine.connect() as conn:
+            rows = conn.execute(stmt).mappings().all()
+
+        items = []
+        for r in rows:
+            item = dict(r)
+            item["profiled_at"] = r["profiled_at"].isoformat(timespec="seconds") if r["profiled_at"] else None
+            items.append(item)
+        return {
+            "ok": True,
+            "latency_budget_ms": PROFILE_LATENCY_BUDGET_MS,
+            "count": len(items),
+            "items": items,
+        }
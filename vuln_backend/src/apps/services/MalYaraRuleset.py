@@ -0,0 +1,570 @@
+# src/apps/services/MalYaraRuleset.py
+import os
+import re
+import json
+import uuid
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import yara  # pip install yara-python
+
+from sqlalchemy import MetaData, Table, select
+from src.extension import *
+from src.apps.services.MalYaraArtifact import load_compiled_rules
+from src.apps.services.MalYaraLint import disabled_rule_shas
+from src.apps.utils.warmup import register_warmup
+
+metadata = MetaData()
+
+
+def get_yara_rule_table() -> Table:
+    return Table("yara_rule", metadata, autoload_with=db.engine)
+
+
+def get_yara_uncompiled_table() -> Table:
+    return Table("yara_uncompiled", metadata, autoload_with=db.engine)
+
+
+# -----------------------
+# 配置路径
+# -----------------------
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+# 合并编译产物：<rule_set>_<version>.yarc + 同名 .json 清单
+ARTIFACT_DIR = os.path.join(PROJECT_ROOT, "runtime", "yara_ruleset")
+
+_RULE_SETS = ("enabled", "all")
+# namespace 命名方式变更时旧清单需要重建
+_NAMESPACE_SCHEME = "source_name/source_file#compiled_rule_id"
+
+# 规则子集选择器：source_name / source_file / namespace（按 source_file 选择的别名）/ tag
+_SELECTOR_KEYS = ("source_name", "source_file", "namespace", "tag")
+# 进程内最多同时保留的已加载规则集（rule_set + selector）个数，超出按 LRU 淘汰
+RULESET_CACHE_SIZE = int(os.environ.get("YARA_RULESET_CACHE_SIZE") or 16)
+# 每个 rule_set + 选择器在 ARTIFACT_DIR 里保留的合并编译产物版本数（含当前版本）
+KEEP_VERSIONS = int(os.environ.get("YARA_RULESET_KEEP_VERSIONS") or 3)
+
+# rule 声明头：[private|global] rule 名称 [: tag1 tag2] {
+_RULE_HEAD_RE = re.compile(r"^\s*((?:(?:private|global)\s+)*)rule\s+(\w+)\s*(?::\s*([\w\s]*?))?\s*\{", re.M)
+
+# 分窗扫描（大文件）时只能近似求值的条件：依赖整个文件或绝对偏移
+_WHOLE_FILE_PATTERNS = (
+    ("filesize", re.compile(r"\bfilesize\b")),
+    ("entrypoint", re.compile(r"\bentrypoint\b")),
+    ("module", re.compile(r"\b(?:pe|elf|math|dotnet|hash|magic|macho)\.[A-Za-z_]")),
+    ("offset", re.compile(r"\bat\b|\bin\s*\(|@\w*\[|\b[iu]nt(?:8|16|32)(?:be)?\s*\(")),
+    ("count", re.compile(r"#\w*")),
+)
+
+# 拆分入库时文件头部的 import 会丢失，合并编译前按用到的模块补回
+_AUTO_IMPORT_MODULES = ("pe", "elf", "math", "hash", "dotnet", "time", "console")
+_MODULE_USE_RE = re.compile(r"\b(" + "|".join(_AUTO_IMPORT_MODULES) + r")\.[A-Za-z_]")
+
+
+def _ensure_dir(p: str):
+    os.makedirs(p, exist_ok=True)
+
+
+def _apply_rule_set(stmt, yara_rule_table: Table, rule_set: str):
+    if rule_set == "enabled":
+        return stmt.where(yara_rule_table.c.enabled == 1)
+    if rule_set == "all":
+        return stmt
+    raise ValueError("rule_set 参数非法：仅允许 enabled|all")
+
+
+def parse_selector(text: Optional[str]) -> Dict[str, Tuple[str, ...]]:
+    """
+    解析规则子集选择器，格式：key:v1,v2;key2:v3
+      例：source_name:vendorA;tag:webshell,apt
+    不同 key 之间取交集，同一 key 的多个值取并集；namespace 等同 source_file。
+    """
+    selector: Dict[str, set] = {}
+    for part in (text or "").split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        key, sep, values = part.partition(":")
+        key = key.strip().lower()
+        if not sep or key not in _SELECTOR_KEYS:
+            raise ValueError("selector 参数非法：格式 key:v1,v2;key2:v3，key 仅允许 " + "|".join(_SELECTOR_KEYS))
+        if key == "namespace":
+            key = "source_file"
+        vals = {v.strip() for v in values.split(",") if v.strip()}
+        if not vals:
+            raise ValueError(f"selector 参数非法：{key} 没有取值")
+        selector.setdefault(key, set()).update(vals)
+    return {k: tuple(sorted(v)) for k, v in sorted(selector.items())}
+
+
+def selector_key(selector: Dict[str, Tuple[str, ...]]) -> str:
+    return ";".join(f"{k}:{','.join(v)}" for k, v in selector.items())
+
+
+def _apply_selector(stmt, yara_rule_table: Table, selector: Dict[str, Tuple[str, ...]]):
+    # tag 不在库里单独存储，编译前按 rule_text 过滤
+    if selector.get("source_name"):
+        stmt = stmt.where(yara_rule_table.c.source_name.in_(selector["source_name"]))
+    if selector.get("source_file"):
+        stmt = stmt.where(yara_rule_table.c.source_file.in_(selector["source_file"]))
+    return stmt
+
+
+def _rule_tags(rule_text: str) -> Tuple[bool, List[str]]:
+    """
+    返回 (是否 private/global 规则, tags)。
+    """
+    m = _RULE_HEAD_RE.search(rule_text or "")
+    if not m:
+        return False, []
+    return bool((m.group(1) or "").strip()), (m.group(3) or "").split()
+
+
+def _whole_file_reasons(rule_text: str) -> Tuple[Optional[str], List[str]]:
+    """
+    返回 (规则名, 只能近似求值的原因)；只检查 condition 部分，避免 strings 里的字面量误判。
+    """
+    m = _RULE_HEAD_RE.search(rule_text or "")
+    if not m:
+        return None, []
+    _, _, condition = rule_text.partition("condition:")
+    return m.group(2), [name for name, pattern in _WHOLE_FILE_PATTERNS if pattern.search(condition)]
+
+
+def _fingerprint(compiled_shas: List[str], salt: str = "") -> str:
+    """
+    规则集指纹：对 compiled_sha256 集合排序后再取 sha256，
+    只依赖哈希列，不需要读取 compiled_rule 大字段。
+    salt 为选择器 key：同一批编译产物按不同选择器得到不同版本。
+    """
+    h = hashlib.sha256()
+    if salt:
+        h.update(salt.encode("utf-8"))
+        h.update(b"\n")
+    for csha in sorted(set(compiled_shas)):
+        h.update(csha.encode("ascii", errors="replace"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def _namespace_name(source_name: Optional[str], source_file: Optional[str], compiled_rule_id: int) -> str:
+    """
+    每个编译产物（一次上传的一个文件）一个 namespace：
+    同名文件重新上传 / 不同来源的同名文件不会落进同一 namespace 而引发 duplicated identifier。
+    """
+    return f"{source_name or 'manual-upload'}/{source_file or 'default'}#{compiled_rule_id}"
+
+
+def _namespace_source(rule_texts: List[str]) -> str:
+    body = "\n\n".join(rule_texts)
+    modules = sorted(set(_MODULE_USE_RE.findall(body)))
+    header = "".join(f'import "{m}"\n' for m in modules)
+    return header + "\n" + body if header else body
+
+
+def _artifact_paths(rule_set: str, version: str) -> Tuple[str, str]:
+    # version 已包含选择器，同一 rule_set 下不同子集的产物不会互相覆盖
+    base = os.path.join(ARTIFACT_DIR, f"{rule_set}_{version}")
+    return base + ".yarc", base + ".json"
+
+
+class LoadedRuleset:
+    """
+    进程内缓存的一份已加载规则集：
+      bundles: [(bundle_key, yara.Rules), ...]
+        - "merged"：所有可合并源文件编译成的一份规则（每个编译产物一个 namespace）
+        - compiled_sha256：合并失败时回退加载的单文件编译产物
+    """
+
+    def __init__(self, rule_set: str, version: str,
+                 bundles: List[Tuple[str, "yara.Rules"]], load_seconds: float,
+                 namespaces: Optional[List[str]] = None,
+                 fallback: Optional[List[Dict[str, Any]]] = None,
+                 selector: Optional[Dict[str, Tuple[str, ...]]] = None,
+                 approximate: Optional[Dict[str, List[str]]] = None,
+                 missing: Optional[List[Dict[str, Any]]] = None,
+                 disabled: Optional[List[str]] = None):
+        self.rule_set = rule_set
+        self.version = version
+        self.selector = selector or {}
+        self.selector_key = selector_key(self.selector)
+        # 结果缓存等按 key 区分不同子集（列宽有限，选择器取哈希）
+        self.key = rule_set if not self.selector_key else \
+            rule_set + ":" + hashlib.sha256(self.selector_key.encode("utf-8")).hexdigest()[:16]
+        # 回退 bundle 是整文件编译产物，按 tag 选择时需要在匹配后过滤
+        self.tags = set(self.selector.get("tag") or ())
+        # "namespace:rule" -> 原因；分窗扫描时这些规则只是近似结果
+        self.approximate = approximate or {}
+        self.bundles = bundles
+        self.load_seconds = load_seconds
+        self.namespaces = namespaces or []
+        self.fallback = fallback or []
+        # 需要回退加载、但文件仓库和 compiled_rule 都没有产物的编译规则：扫描结果必须标记为不完整
+        self.missing = missing or []
+        # 回退 bundle（整文件编译产物）里无法剔除的已停用慢规则名，匹配后过滤
+        self.disabled = set(disabled or [])
+        self.namespace_set = set(self.namespaces)
+        self.loaded_at = time.time()
+
+
+# (rule_set, selector_key) -> LoadedRuleset（每个子集只保留最新版本，LRU 淘汰）
+_CACHE: "OrderedDict[Tuple[str, str], LoadedRuleset]" = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+_BUILD_LOCK = threading.Lock()
+
+
+def _current_version(rule_set: str, selector: Dict[str, Tuple[str, ...]]) -> Optional[str]:
+    yara_rule_table = get_yara_rule_table()
+    stmt = _apply_rule_set(select(yara_rule_table.c.compiled_sha256), yara_rule_table, rule_set)
+    stmt = _apply_selector(stmt, yara_rule_table, selector)
+
+    with db.engine.connect() as conn:
+        shas = [(s or "").strip() for s in conn.execute(stmt).scalars().all()]
+
+    shas = [s for s in shas if s]
+    if not shas:
+        return None
+    salt = selector_key(selector)
+    disabled = disabled_rule_shas()
+    if disabled:
+        # 停用 / 启用单条慢规则也要换版本，触发重新合并编译
+        salt += "\ndisabled:" + hashlib.sha256(",".join(disabled).encode("ascii")).hexdigest()
+    return _fingerprint(shas, salt=salt)
+
+
+def _load_compiled_blobs(compiled_ids: List[int]
+                         ) -> Tuple[List[Tuple[str, "yara.Rules"]], List[Dict[str, Any]]]:
+    """
+    按 yara_rule.id 读取单文件编译产物（只用于合并失败的回退部分），
+    从内容寻址文件仓库加载，不再经 MySQL 传输 blob。返回 (bundles, 找不到产物的规则)。
+    """
+    return load_compiled_rules(compiled_ids)
+
+
+def _collect_sources(rule_set: str, selector: Dict[str, Tuple[str, ...]]
+                     ) -> Tuple["OrderedDict[str, List[str]]", Dict[str, List[int]], List[int], Dict[int, List[str]]]:
+    """
+    读取当前规则集对应的 yara_uncompiled.rule_text，按编译产物（source_name/source_file#id）分组。
+    按 tag 选择时只保留带这些 tag 的规则，以及 private / global 规则（可能被引用）。
+    已停用的慢规则（yara_rule_lint.disabled）不参与合并编译。
+    返回：
+      sources:   namespace -> [rule_text, ...]（保持入库顺序）
+      ns_ids:    namespace -> [compiled_rule_id, ...]
+      orphan_ids: 没有任何 uncompiled 行指向的 yara_rule.id（只能走 blob 回退）
+      disabled:  compiled_rule_id -> [已停用的规则名]（回退加载时用于过滤命中）
+    """
+    yara_rule_table = get_yara_rule_table()
+    yara_un_table = get_yara_uncompiled_table()
+
+    stmt_un = _apply_rule_set(
+        select(
+            yara_rule_table.c.source_name,
+            yara_un_table.c.source_file,
+            yara_un_table.c.rule_name,
+            yara_un_table.c.rule_text,
+            yara_un_table.c.sha256,
+            yara_un_table.c.compiled_rule_id,
+        ).select_from(
+            yara_un_table.join(yara_rule_table, yara_un_table.c.compiled_rule_id == yara_rule_table.c.id)
+        ).order_by(yara_un_table.c.id),
+        yara_rule_table,
+        rule_set,
+    )
+    stmt_un = _apply_selector(stmt_un, yara_rule_table, selector)
+    stmt_ids = _apply_selector(_apply_rule_set(select(yara_rule_table.c.id), yara_rule_table, rule_set),
+                               yara_rule_table, selector)
+    tags = set(selector.get("tag") or ())
+
+    with db.engine.connect() as conn:
+        rows = conn.execute(stmt_un).mappings().all()
+        active_ids = [int(i) for i in conn.execute(stmt_ids).scalars().all()]
+    disabled_shas = set(disabled_rule_shas())
+
+    sources: "OrderedDict[str, List[str]]" = OrderedDict()
+    ns_ids: Dict[str, List[int]] = {}
+    disabled: Dict[int, List[str]] = {}
+    referenced = set()
+    for r in rows:
+        text = r.get("rule_text") or ""
+        cid = r.get("compiled_rule_id")
+        if not text.strip() or cid is None:
+            continue
+        ns = _namespace_name(r.get("source_name"), r.get("source_file"), int(cid))
+        referenced.add(int(cid))
+        if r.get("sha256") in disabled_shas:
+            disabled.setdefault(int(cid), []).append(r.get("rule_name") or "")
+            continue
+        if tags:
+            is_helper, rule_tags = _rule_tags(text)
+            if not is_helper and not tags.intersection(rule_tags):
+                continue
+        sources.setdefault(ns, []).append(text)
+        ns_ids.setdefault(ns, [int(cid)])
+
+    orphan_ids = [i for i in active_ids if i not in referenced]
+    return sources, ns_ids, orphan_ids, disabled
+
+
+def _prune_versions(rule_set: str, selector: Dict[str, Tuple[str, ...]], keep_version: str) -> None:
+    """
+    删除同一 rule_set + 选择器的旧版本产物，保留最近 KEEP_VERSIONS 个；
+    本进程缓存里仍在使用的版本不删除。选择器从清单里读取（文件名里的 version 已含选择器哈希）。
+    """
+    key = selector_key(selector)
+    with _CACHE_LOCK:
+        in_use = {loaded.version for loaded in _CACHE.values()}
+    prefix = rule_set + "_"
+    try:
+        names = [n for n in os.listdir(ARTIFACT_DIR) if n.startswith(prefix) and n.endswith(".json")]
+    except OSError:
+        return
+
+    candidates: List[Tuple[float, str]] = []
+    for name in names:
+        version = name[len(prefix):-len(".json")]
+        if version == keep_version or version in in_use:
+            continue
+        manifest_path = os.path.join(ARTIFACT_DIR, name)
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("rule_set") != rule_set or (manifest.get("selector") or "") != key:
+                continue
+            candidates.append((os.path.getmtime(manifest_path), version))
+        except (OSError, ValueError):
+            continue
+
+    candidates.sort(reverse=True)
+    for _, version in candidates[max(0, KEEP_VERSIONS - 1):]:
+        for path in _artifact_paths(rule_set, version):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _build_merged(rule_set: str, version: str,
+                  selector: Dict[str, Tuple[str, ...]]) -> Tuple[Optional["yara.Rules"], Dict[str, Any]]:
+    """
+    把所有源文件编译成一份 yara.Rules（每个编译产物一个 namespace），
+    并保存为版本化产物。无法合并的 namespace 记入 manifest，由调用方回退加载。
+    """
+    sources, ns_ids, orphan_ids, disabled = _collect_sources(rule_set, selector)
+    ns_sources = {ns: _namespace_source(texts) for ns, texts in sources.items()}
+
+    failed: Dict[str, str] = {}
+    merged = None
+    if ns_sources:
+        try:
+            merged = yara.compile(sources=ns_sources)
+        except yara.Error:
+            # 整体编译失败时逐个 namespace 定位，剔除坏的再合并一次
+            good: Dict[str, str] = {}
+            for ns, text in ns_sources.items():
+                try:
+                    yara.compile(source=text)
+                    good[ns] = text
+                except yara.Error as e:
+                    failed[ns] = str(e)
+            if good:
+                try:
+                    merged = yara.compile(sources=good)
+                except yara.Error as e:
+                    failed.update({ns: f"合并失败：{str(e)}" for ns in good})
+                    merged = None
+
+    namespaces = [ns for ns in ns_sources if ns not in failed] if merged is not None else []
+
+    approximate: Dict[str, List[str]] = {}
+    for ns, texts in sources.items():
+        for text in texts:
+            rule_name, reasons = _whole_file_reasons(text)
+            if rule_name and reasons:
+                approximate[f"{ns}:{rule_name}"] = reasons
+
+    fallback_ids: List[int] = list(orphan_ids)
+    for ns in failed:
+        for cid in ns_ids.get(ns, []):
+            if cid not in fallback_ids:
+                fallback_ids.append(cid)
+
+    manifest = {
+        "rule_set": rule_set,
+        "selector": selector_key(selector),
+        "version": version,
+        "yara_python": getattr(yara, "__version__", ""),
+        "namespaces": namespaces,
+        "failed_namespaces": failed,
+        "fallback_rule_ids": fallback_ids,
+        "approximate_rules": approximate,
+        "disabled_rule_count": sum(len(names) for names in disabled.values()),
+        # 回退 bundle 整文件加载，其中已停用的规则只能在匹配后过滤
+        "fallback_disabled_rules": sorted({name for cid in fallback_ids for name in disabled.get(cid, [])}),
+        "namespace_scheme": _NAMESPACE_SCHEME,
+        "built_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+    _ensure_dir(ARTIFACT_DIR)
+    yarc_path, manifest_path = _artifact_paths(rule_set, version)
+    tmp_suffix = "." + uuid.uuid4().hex + ".tmp"
+    if merged is not None:
+        merged.save(yarc_path + tmp_suffix)
+        os.replace(yarc_path + tmp_suffix, yarc_path)
+    with open(manifest_path + tmp_suffix, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(manifest_path + tmp_suffix, manifest_path)
+    _prune_versions(rule_set, selector, version)
+
+    return merged, manifest
+
+
+def _load_ruleset(rule_set: str, version: str, selector: Dict[str, Tuple[str, ...]]) -> LoadedRuleset:
+    started = time.perf_counter()
+
+    yarc_path, manifest_path = _artifact_paths(rule_set, version)
+    merged = None
+    manifest = None
+    if os.path.exists(manifest_path):
+        # 已有同版本产物（其它进程或上次启动构建）直接复用
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if "approximate_rules" not in manifest or manifest.get("namespace_scheme") != _NAMESPACE_SCHEME:
+                # 旧版清单缺少分窗扫描需要的信息，重新构建
+                raise ValueError("manifest outdated")
+            if manifest.get("namespaces"):
+                merged = yara.load(filepath=yarc_path)
+        except (OSError, ValueError, yara.Error):
+            manifest = None
+            merged = None
+
+    if manifest is None:
+        merged, manifest = _build_merged(rule_set, version, selector)
+
+    bundles: List[Tuple[str, yara.Rules]] = []
+    if merged is not None:
+        bundles.append(("merged", merged))
+    fallback_bundles, missing = _load_compiled_blobs(manifest.get("fallback_rule_ids") or [])
+    bundles.extend(fallback_bundles)
+
+    if not bundles:
+        if missing:
+            raise ValueError("规则集不可用：编译产物缺失（文件仓库和 compiled_rule 均为空），yara_rule.id="
+                             + ",".join(str(m["id"]) for m in missing[:50]))
+        raise ValueError("规则集为空：没有可用的预编译规则（compiled_rule 为空）")
+
+    fallback = [
+        {"namespace": ns, "error": err}
+        for ns, err in (manifest.get("failed_namespaces") or {}).items()
+    ]
+
+    return LoadedRuleset(
+        rule_set=rule_set,
+        version=version,
+        bundles=bundles,
+        load_seconds=time.perf_counter() - started,
+        namespaces=manifest.get("namespaces") or [],
+        fallback=fallback,
+        selector=selector,
+        approximate=manifest.get("approximate_rules") or {},
+        missing=missing,
+        disabled=manifest.get("fallback_disabled_rules") or [],
+    )
+
+
+class MalYaraRuleset:
+    """
+    进程内 yara.Rules 缓存：
+      - 以 rule_set + 选择器 + compiled_sha256 集合指纹作为 key，每个子集单独编译、单独缓存
+      - 启用规则合并编译为一份（每个编译产物一个 namespace），样本只扫一遍
+      - 稳态扫描只查一次哈希列，不读 blob、不调用 yara.load
+      - 上传 / 启停规则后调用 invalidate()
+    """
+
+    @staticmethod
+    def check_rule_set(rule_set: str) -> None:
+        if rule_set not in _RULE_SETS:
+            raise ValueError("rule_set 参数非法：仅允许 enabled|all")
+
+    @staticmethod
+    def get_ruleset(rule_set: str = "enabled", selector: Optional[str] = None) -> LoadedRuleset:
+        """
+        selector 为空时使用整个 rule_set；否则只编译 / 扫描选中的规则子集。
+        """
+        MalYaraRuleset.check_rule_set(rule_set)
+        parsed = parse_selector(selector)
+        cache_key = (rule_set, selector_key(parsed))
+
+        version = _current_version(rule_set, parsed)
+        if version is None:
+            if parsed:
+                raise ValueError("规则集为空：selector 没有匹配到任何可用 YARA 规则")
+            raise ValueError("规则集为空：数据库里没有可用 YARA 规则（请先上传规则或启用规则）")
+
+        with _CACHE_LOCK:
+            cached = _CACHE.get(cache_key)
+            if cached is not None and cached.version == version:
+                _CACHE.move_to_end(cache_key)
+                return cached
+
+        # 同一时刻只允许一个线程加载，其余线程等待后直接复用
+        with _BUILD_LOCK:
+            with _CACHE_LOCK:
+                cached = _CACHE.get(cache_key)
+            if cached is not None and cached.version == version:
+                return cached
+
+            loaded = _load_ruleset(rule_set, version, parsed)
+            with _CACHE_LOCK:
+                _CACHE[cache_key] = loaded
+                _CACHE.move_to_end(cache_key)
+                while len(_CACHE) > RULESET_CACHE_SIZE:
+                    _CACHE.popitem(last=False)
+            return loaded
+
+    @staticmethod
+    def cache_stats() -> List[Dict[str, Any]]:
+        """
+        进程内已加载的规则集；fallback_namespaces > 0 表示有 namespace 合并失败、退回逐 bundle 扫描。
+        """
+        with _CACHE_LOCK:
+            loaded = list(_CACHE.values())
+        return [{
+            "rule_set": r.rule_set,
+            "selector": r.selector_key,
+            "version": r.version,
+            "namespaces": len(r.namespaces),
+            "fallback_namespaces": len(r.fallback),
+            "missing_bundles": len(r.missing),
+            "fallback_disabled_rules": len(r.disabled),
+            "bundles": len(r.bundles),
+        } for r in loaded]
+
+    @staticmethod
+    def invalidate(rule_set: Optional[str] = None) -> None:
+        with _CACHE_LOCK:
+            if rule_set is None:
+                _CACHE.clear()
+            else:
+                for key in [k for k in _CACHE if k[0] == rule_set]:
+                    _CACHE.pop(key, None)
+
+
+def _warm_up() -> Dict[str, Any]:
+    """
+    启动预热：加载启用规则集（表反射 + 合并编译 / 读取已有产物 + yara.load）。
+    """
+    if _current_version("enabled", {}) is None:
+        return {"version": None, "message": "没有启用的 YARA 规则"}
+    loaded = MalYaraRuleset.get_ruleset("enabled")
+    return {
+        "version": loaded.version,
+        "load_seconds": round(loaded.load_seconds, 3),
+        "namespaces": len(loaded.namespaces),
+        "bundles": len(loaded.bundles),
+    }
+
+
+register_warmup("yara_ruleset", _warm_up)
@@ -1,20 +1,45 @@
 # src/apps/services/MalYaraScan.py
+import io
 import os
 import uuid
 import hashlib
-import shutil
-from typing import Any, Dict, List
+import tarfile
+import time
+import threading
+import zipfile
+from collections import deque
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from datetime import datetime, timedelta
 
 import yara  # pip install yara-python
 
-from sqlalchemy import MetaData, Table, select
+from sqlalchemy import MetaData, Table, Column, String, DateTime, JSON, select, delete
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from src.extension import *
+from src.apps.services.MalYaraRuleset import MalYaraRuleset, parse_selector
+from src.apps.services.MalYaraArchive import (
+    ARCHIVE_MAX_DEPTH, ArchiveBudget, is_archive_name, iter_archive_members_recursive
+)
+from src.apps.services.MalYaraExecutor import SCAN_EXECUTOR
+from src.apps.utils.job_queue import JobQueue, STATUS_DONE, STATUS_FAILED
 
 metadata = MetaData()
 
+# 扫描结果缓存：同一样本 + 同一规则集版本直接复用结果
+_yara_scan_result = Table(
+    "yara_scan_result",
+    metadata,
+    Column("sample_sha256", String(64), primary_key=True),
+    Column("ruleset_version", String(64), primary_key=True),
+    Column("rule_set", String(64), nullable=False, index=True),
+    Column("matches", JSON, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+)
+
 
-def get_yara_rule_table():
-    return Table("yara_rule", metadata, autoload_with=db.engine)
+def get_yara_scan_result_table() -> Table:
+    return ensure_table(_yara_scan_result)
 
 
 # -----------------------
@@ -23,25 +48,190 @@ def get_yara_rule_table():
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
 RUNTIME_DIR = os.path.join(PROJECT_ROOT, "runtime", "yara_scan_py")
 
-MAX_SAMPLE_BYTES = 50 * 1024 * 1024
+MAX_SAMPLE_BYTES = 512 * 1024 * 1024
+MAX_BATCH_FILES = 1000
+MAX_ARCHIVE_BYTES = 1024 * 1024 * 1024
+SPOOL_MEMORY_BYTES = 8 * 1024 * 1024  # 小于该值的样本留在内存，超过则落盘
+READ_CHUNK_BYTES = 1024 * 1024
+# 单个样本的总扫描预算（秒），所有规则 bundle 共享；超时返回已得到的命中并标记 complete=false
 SCAN_TIMEOUT_SECONDS = 10
 
+# 大文件模式：超过 WINDOW_SCAN_THRESHOLD_BYTES 的样本按重叠窗口从磁盘分段读取扫描，内存占用只与窗口大小有关
+# 单样本 / 异步任务接口允许上传到 MAX_LARGE_SAMPLE_BYTES；批量 / 压缩包成员仍受 MAX_SAMPLE_BYTES 限制
+MAX_LARGE_SAMPLE_BYTES = int(os.environ.get("YARA_MAX_LARGE_SAMPLE_BYTES") or 64 * 1024 * 1024 * 1024)
+WINDOW_SCAN_THRESHOLD_BYTES = int(os.environ.get("YARA_WINDOW_SCAN_THRESHOLD_BYTES") or MAX_SAMPLE_BYTES)
+WINDOW_BYTES = int(os.environ.get("YARA_WINDOW_BYTES") or 64 * 1024 * 1024)
+# 相邻窗口重叠字节数：跨窗口边界、长度不超过该值的字符串不会漏报
+WINDOW_OVERLAP_BYTES = int(os.environ.get("YARA_WINDOW_OVERLAP_BYTES") or 1024 * 1024)
+LARGE_SCAN_TIMEOUT_SECONDS = int(os.environ.get("YARA_LARGE_SCAN_TIMEOUT_SECONDS") or 600)
+# 每条命中规则最多返回的偏移个数
+MAX_MATCH_OFFSETS = 100
+
+# 结果缓存清理：同一规则集 key 下其它版本的结果超过 STALE 秒后删除（留出多 worker 切换版本的窗口），
+# 任何版本的结果超过 TTL 秒后删除；每个进程最多每 PURGE_INTERVAL 秒清理一次
+RESULT_CACHE_STALE_SECONDS = int(os.environ.get("YARA_RESULT_CACHE_STALE_SECONDS") or 600)
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get("YARA_RESULT_CACHE_TTL_SECONDS") or 30 * 24 * 3600)
+_RESULT_CACHE_PURGE_INTERVAL_SECONDS = 60
+
+# mode=verdict：命中第一条达到该严重级别的规则即停止扫描；为空表示任意命中即停止
+VERDICT_MIN_SEVERITY = os.environ.get("YARA_VERDICT_MIN_SEVERITY", "")
+_SCAN_MODES = ("full", "verdict")
+_SEVERITY_LEVELS = {"informational": 0, "info": 0, "low": 1, "medium": 2, "high": 3, "critical": 4}
+
 
 def _ensure_dir(p: str):
     os.makedirs(p, exist_ok=True)
 
 
-def _sha256_hex(data: bytes) -> str:
-    return hashlib.sha256(data).hexdigest()
-
-
-def _read_filestorage_bytes(file_storage) -> bytes:
-    data = file_storage.read()
-    try:
-        file_storage.stream.seek(0)
-    except Exception:
-        pass
-    return data
+class _SpooledSample:
+    """
+    上传样本：边读边算 sha256、边检查大小。
+      - 小样本留在内存，match(data=...)
+      - 大样本落盘到 RUNTIME_DIR，match(filepath=...)，由 libyara 自己 mmap
+    用完调用 close() 删除落盘文件。
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.sha256 = ""
+        self.data: Optional[bytes] = None
+        self.path: Optional[str] = None
+
+    @classmethod
+    def from_stream(cls, stream, max_bytes: int = MAX_SAMPLE_BYTES,
+                    spool_path: Optional[str] = None) -> "_SpooledSample":
+        """
+        spool_path 不为空时样本总是写入该路径（异步任务用，需跨进程重启保留）。
+        """
+        sample = cls()
+        h = hashlib.sha256()
+        buf = io.BytesIO()
+        fh = None
+        if spool_path is not None:
+            _ensure_dir(os.path.dirname(spool_path))
+            sample.path = spool_path
+            fh = open(spool_path, "wb")
+        try:
+            while True:
+                chunk = stream.read(READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                sample.size += len(chunk)
+                if sample.size > max_bytes:
+                    raise ValueError("FILE_TOO_LARGE")
+                h.update(chunk)
+
+                if fh is None and sample.size > SPOOL_MEMORY_BYTES:
+                    _ensure_dir(RUNTIME_DIR)
+                    sample.path = os.path.join(RUNTIME_DIR, uuid.uuid4().hex + ".bin")
+                    fh = open(sample.path, "wb")
+                    fh.write(buf.getvalue())
+                    buf = None
+                if fh is not None:
+                    fh.write(chunk)
+                else:
+                    buf.write(chunk)
+        except BaseException:
+            if fh is not None:
+                fh.close()
+            sample.close()
+            raise
+
+        if fh is not None:
+            fh.close()
+        else:
+            sample.data = buf.getvalue()
+        sample.sha256 = h.hexdigest()
+        return sample
+
+    @classmethod
+    def from_path(cls, path: str, sha256: str) -> "_SpooledSample":
+        sample = cls()
+        sample.path = path
+        sample.size = os.path.getsize(path)
+        sample.sha256 = sha256
+        return sample
+
+    def match(self, rules: "yara.Rules", **kwargs) -> List["yara.Match"]:
+        if self.path is not None:
+            return rules.match(filepath=self.path, **kwargs)
+        return rules.match(data=self.data or b"", **kwargs)
+
+    def open(self) -> BinaryIO:
+        if self.path is not None:
+            return open(self.path, "rb")
+        return io.BytesIO(self.data or b"")
+
+    def close(self) -> None:
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+_purge_lock = threading.Lock()
+_last_purge_at = 0.0
+
+
+def _purge_cached_matches(conn, table: Table, ruleset) -> None:
+    """
+    按时间清理结果缓存：只删超过 STALE 的其它版本结果和超过 TTL 的结果。
+    不立即删除其它版本，避免多个 worker 在规则集切换期间互相删除对方刚写入的结果。
+    """
+    global _last_purge_at
+    with _purge_lock:
+        now = time.monotonic()
+        if now - _last_purge_at < _RESULT_CACHE_PURGE_INTERVAL_SECONDS:
+            return
+        _last_purge_at = now
+    wall_now = datetime.now()
+    conn.execute(
+        delete(table)
+        .where(table.c.rule_set == ruleset.key)
+        .where(table.c.ruleset_version != ruleset.version)
+        .where(table.c.created_at < wall_now - timedelta(seconds=RESULT_CACHE_STALE_SECONDS))
+    )
+    conn.execute(
+        delete(table).where(table.c.created_at < wall_now - timedelta(seconds=RESULT_CACHE_TTL_SECONDS))
+    )
+
+
+def _lookup_cached_matches(sample_sha256: str, ruleset) -> Optional[List[Dict[str, Any]]]:
+    table = get_yara_scan_result_table()
+    stmt = select(table.c.matches).where(
+        table.c.sample_sha256 == sample_sha256,
+        table.c.ruleset_version == ruleset.version,
+    )
+    with db.engine.connect() as conn:
+        row = conn.execute(stmt).first()
+    if row is None:
+        return None
+    return list(row[0] or [])
+
+
+def _store_cached_matches(sample_sha256: str, ruleset, matches: List[Dict[str, Any]]) -> None:
+    table = get_yara_scan_result_table()
+    now = datetime.now()
+    stmt = mysql_insert(table).values(
+        sample_sha256=sample_sha256,
+        ruleset_version=ruleset.version,
+        rule_set=ruleset.key,
+        matches=matches,
+        created_at=now,
+    )
+    stmt = stmt.on_duplicate_key_update(matches=stmt.inserted.matches, created_at=now)
+    with db.engine.begin() as conn:
+        conn.execute(stmt)
+        _purge_cached_matches(conn, table, ruleset)
 
 
 def _safe_filename(name: str) -> str:
@@ -49,17 +239,450 @@ def _safe_filename(name: str) -> str:
     return name.replace("..", "_")
 
 
-def _to_matches_from_yara(matches: List[yara.Match]) -> List[Dict[str, Any]]:
-    out: List[Dict[str, Any]] = []
+def _match_to_dict(rule: str, namespace: Optional[str], tags, meta) -> Dict[str, Any]:
+    return {
+        "rule": rule,
+        "namespace": namespace,
+        "tags": list(tags or []),
+        "meta": dict(meta or {}),
+        "strings": []
+    }
+
+
+def _match_severity(match: Dict[str, Any]) -> Optional[int]:
+    """
+    规则严重级别：优先取 meta.severity / meta.threat_level，其次取同名 tag。
+    """
+    meta = match.get("meta") or {}
+    for key in ("severity", "threat_level"):
+        level = _SEVERITY_LEVELS.get(str(meta.get(key, "")).strip().lower())
+        if level is not None:
+            return level
+    levels = [_SEVERITY_LEVELS[t.lower()] for t in (match.get("tags") or []) if t.lower() in _SEVERITY_LEVELS]
+    return max(levels) if levels else None
+
+
+def _is_verdict_hit(match: Dict[str, Any]) -> bool:
+    threshold = _SEVERITY_LEVELS.get(VERDICT_MIN_SEVERITY.strip().lower())
+    if threshold is None:
+        return True
+    level = _match_severity(match)
+    return level is not None and level >= threshold
+
+
+def _is_filtered(ruleset, match: Dict[str, Any]) -> bool:
+    # 回退 bundle（整文件编译）不能按规则剔除：按 tag 选择子集时不带这些 tag 的命中、
+    # 以及已停用的慢规则的命中都不报告
+    if ruleset.tags and not ruleset.tags.intersection(match["tags"]):
+        return True
+    return match["rule"] in ruleset.disabled and match["namespace"] not in ruleset.namespace_set
+
+
+def _bundle_names(ruleset, bundle_key: str) -> List[str]:
+    # merged bundle 按 namespace（source_name/source_file#id）报告，回退 bundle 按 compiled_sha256 报告
+    if bundle_key == "merged":
+        return list(ruleset.namespaces) or ["merged"]
+    return [bundle_key]
+
+
+def _missing_names(ruleset) -> List[str]:
+    return [f"missing:{m.get('compiled_sha256') or 'yara_rule#' + str(m['id'])}" for m in ruleset.missing]
+
+
+def _match_sample(sample: _SpooledSample, ruleset, mode: str = "full",
+                  deadline: Optional[float] = None) -> Dict[str, Any]:
+    """
+    纯 YARA 匹配（不访问数据库），在扫描线程池里执行。
+    超过 WINDOW_SCAN_THRESHOLD_BYTES 的落盘样本转为分窗扫描。
+    所有 bundle 共享一个截止时间（默认从开始扫描起 SCAN_TIMEOUT_SECONDS）；
+    超时的 / 来不及扫描的 bundle 记入 unevaluated，已得到的命中照常返回。
+    mode=verdict 时使用 fast 匹配，并在第一条达到阈值的命中后中止；
+    提前中止的结果 complete=False、stopped_early=True（其余规则未扫描）。
+    返回 {"matches", "complete", "stopped_early", "unevaluated"}。
+    """
+    if _is_windowed(sample):
+        return _match_sample_windowed(sample, ruleset, mode, deadline)
+    if deadline is None:
+        deadline = time.monotonic() + SCAN_TIMEOUT_SECONDS
+    verdict = mode == "verdict"
+
+    hits: List[Dict[str, Any]] = []
+    # 产物缺失的编译规则从未加载，直接记为未扫描
+    unevaluated: List[str] = _missing_names(ruleset)
+    stopped_early = False
+
+    def _on_match(data: Dict[str, Any]):
+        nonlocal stopped_early
+        match = _match_to_dict(data.get("rule"), data.get("namespace"), data.get("tags"), data.get("meta"))
+        if _is_filtered(ruleset, match):
+            return yara.CALLBACK_CONTINUE
+        hits.append(match)
+        if verdict and _is_verdict_hit(match):
+            stopped_early = True
+            return yara.CALLBACK_ABORT
+        return yara.CALLBACK_CONTINUE
+
+    for bundle_key, rules in ruleset.bundles:
+        if stopped_early:
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            unevaluated.extend(_bundle_names(ruleset, bundle_key))
+            continue
+        try:
+            # yara 的 timeout 只接受整秒
+            sample.match(rules, timeout=max(1, int(remaining)), fast=verdict,
+                         callback=_on_match, which_callbacks=yara.CALLBACK_MATCHES)
+        except yara.TimeoutError:
+            unevaluated.extend(_bundle_names(ruleset, bundle_key))
+
+    return {"matches": hits, "complete": not unevaluated and not stopped_early,
+            "stopped_early": stopped_early, "unevaluated": unevaluated}
+
+
+def _is_windowed(sample: _SpooledSample) -> bool:
+    return sample.path is not None and sample.size > WINDOW_SCAN_THRESHOLD_BYTES
+
+
+def _windowed_info(ruleset) -> Dict[str, Any]:
+    names = sorted(ruleset.approximate)
+    return {
+        "windowed": True,
+        "approximate_rule_count": len(names),
+        "approximate_rules": names[:500],
+    }
+
+
+def _match_sample_windowed(sample: _SpooledSample, ruleset, mode: str = "full",
+                           deadline: Optional[float] = None) -> Dict[str, Any]:
+    """
+    大文件分窗扫描：按 WINDOW_BYTES 窗口（相邻窗口重叠 WINDOW_OVERLAP_BYTES）从磁盘顺序读取，
+    每个窗口对所有 bundle 匹配一次；同一规则在多个窗口的命中合并为一条，偏移换算成文件内绝对偏移。
+    依赖 filesize / 入口点 / 模块 / 绝对偏移 / 计数的规则只是近似结果，记入 approximate。
+    超时未扫描的 bundle 每个名称只记一条，附带未扫描的窗口范围（相连窗口合并）。
+    """
+    if deadline is None:
+        deadline = time.monotonic() + LARGE_SCAN_TIMEOUT_SECONDS
+    verdict = mode == "verdict"
+    step = max(1, WINDOW_BYTES - WINDOW_OVERLAP_BYTES)
+
+    merged: "Dict[Tuple[str, str], Dict[str, Any]]" = {}
+    unevaluated: List[str] = _missing_names(ruleset)
+    # bundle 名称 -> 未扫描的 [start, end] 范围列表（按插入顺序输出）
+    skipped: "Dict[str, List[List[int]]]" = {}
+    window_start = 0
+    windows = 0
+
+    def _skip(bundle_key: str, start: int, end: int):
+        for name in _bundle_names(ruleset, bundle_key):
+            ranges = skipped.setdefault(name, [])
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+    stopped_early = False
+
+    def _on_match(data: Dict[str, Any]):
+        nonlocal stopped_early
+        match = _match_to_dict(data.get("rule"), data.get("namespace"), data.get("tags"), data.get("meta"))
+        if _is_filtered(ruleset, match):
+            return yara.CALLBACK_CONTINUE
+        key = (match["namespace"] or "", match["rule"])
+        entry = merged.get(key)
+        if entry is None:
+            entry = match
+            entry["offsets"] = []
+            reasons = ruleset.approximate.get(f"{key[0]}:{key[1]}")
+            if reasons:
+                entry["approximate"] = reasons
+            merged[key] = entry
+        offsets = entry["offsets"]
+        for sm in data.get("strings") or []:
+            for inst in getattr(sm, "instances", []):
+                if len(offsets) >= MAX_MATCH_OFFSETS:
+                    break
+                pair = [sm.identifier, window_start + inst.offset]
+                # 重叠区里的同一处命中只记一次
+                if pair not in offsets:
+                    offsets.append(pair)
+        if verdict and _is_verdict_hit(match):
+            stopped_early = True
+            return yara.CALLBACK_ABORT
+        return yara.CALLBACK_CONTINUE
+
+    with open(sample.path, "rb") as fh:
+        while window_start < sample.size:
+            if stopped_early:
+                break
+            window_end = min(window_start + WINDOW_BYTES, sample.size)
+            fh.seek(window_start)
+            chunk = fh.read(window_end - window_start)
+            windows += 1
+            for bundle_key, rules in ruleset.bundles:
+                if stopped_early:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    _skip(bundle_key, window_start, window_end)
+                    continue
+                try:
+                    rules.match(data=chunk, timeout=max(1, int(remaining)), fast=verdict,
+                                callback=_on_match, which_callbacks=yara.CALLBACK_MATCHES)
+                except yara.TimeoutError:
+                    _skip(bundle_key, window_start, window_end)
+            if window_end >= sample.size:
+                break
+            window_start += step
+
+    unevaluated.extend(f"{name}@" + ",".join(f"{a}-{b}" for a, b in ranges)
+                       for name, ranges in skipped.items())
+    matches = list(merged.values())
     for m in matches:
-        out.append({
-            "rule": m.rule,
-            "namespace": getattr(m, "namespace", None),
-            "tags": [],
-            "meta": {},
-            "strings": []
-        })
-    return out
+        m["offsets"].sort(key=lambda pair: pair[1])
+    result = {"matches": matches, "complete": not unevaluated and not stopped_early,
+              "stopped_early": stopped_early, "unevaluated": unevaluated, "windows": windows}
+    result.update(_windowed_info(ruleset))
+    return result
+
+
+def _scan_sample(sample: _SpooledSample, ruleset, mode: str = "full") -> Tuple[Dict[str, Any], bool]:
+    """
+    扫描单个样本，返回 (扫描结果, 是否命中结果缓存)。
+    只缓存 full 模式的完整结果；verdict / 超时的部分结果只读缓存、不写缓存。
+    """
+    cached = _lookup_cached_matches(sample.sha256, ruleset)
+    if cached is not None:
+        result = {"matches": cached, "complete": True, "unevaluated": []}
+        if _is_windowed(sample):
+            result.update(_windowed_info(ruleset))
+        return result, True
+
+    result = SCAN_EXECUTOR.run(_match_sample, sample, ruleset, mode)
+    if mode == "full" and result["complete"]:
+        _store_cached_matches(sample.sha256, ruleset, result["matches"])
+    return result, False
+
+
+def _scan_error(code: str, message: str, job_id: str, filename: str) -> Dict[str, Any]:
+    return {"ok": False, "code": code, "message": message,
+            "sample_id": job_id, "sample_filename": filename}
+
+
+def _scan_response(job_id: str, label: str, filename: str, sample: _SpooledSample,
+                   ruleset, result: Dict[str, Any], cached: bool,
+                   mode: str = "full") -> Dict[str, Any]:
+    matches = result["matches"]
+    data = {
+        "ok": True,
+        "sample_id": job_id,
+        "label": label or "",
+        "sample_filename": filename,
+        "sample_sha256": sample.sha256,
+        "sample_size": sample.size,
+        "rule_set": ruleset.rule_set,
+        "selector": ruleset.selector_key,
+        "ruleset_version": ruleset.version,
+        "matches": matches,
+        "cached": cached,
+        "complete": result["complete"],
+        # verdict 模式命中后提前中止：verdict 可信，但 matches 不是完整命中列表
+        "stopped_early": result.get("stopped_early", False),
+        "unevaluated": result["unevaluated"],
+        # 合并编译失败、退回逐个编译产物扫描的 namespace 数
+        "fallback_namespace_count": len(ruleset.fallback),
+        # 编译产物缺失、未参与扫描的 yara_rule.id（结果不完整）
+        "missing_rule_ids": [m["id"] for m in ruleset.missing],
+        "windowed": result.get("windowed", False),
+        "mode": mode,
+        "verdict": "malicious" if any(_is_verdict_hit(m) for m in matches) else "clean",
+        "engine_stdout": "",
+        "engine_stderr": "",
+    }
+    if result.get("windowed"):
+        for key in ("windows", "approximate_rule_count", "approximate_rules"):
+            if key in result:
+                data[key] = result[key]
+    return data
+
+
+def _archive_sources(file_storage, max_depth: int = ARCHIVE_MAX_DEPTH) -> Iterator[Tuple[Any, str, Dict[str, Any]]]:
+    """
+    压缩包成员来源：上传包先流式落到 spool（zip 需要 seek），
+    成员直接从解压流读取，嵌套压缩包按 max_depth / 解压预算递归展开。
+    读取失败时产出一条 stream 为 None 的错误条目并停止。
+    """
+    archive_name = _safe_filename(file_storage.filename or "") or "archive.zip"
+    budget = ArchiveBudget()
+    try:
+        with _SpooledSample.from_stream(file_storage.stream, max_bytes=MAX_ARCHIVE_BYTES) as archive:
+            with archive.open() as fh:
+                for member_path, member, depth in iter_archive_members_recursive(
+                        fh, archive_name, budget=budget, max_depth=max_depth):
+                    member_name = member_path.rsplit("::", 1)[-1]
+                    yield member, _safe_filename(member_name) or "sample.bin", \
+                        {"archive": archive_name, "member": member_path, "depth": depth}
+    except (ValueError, OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+        yield None, archive_name, {"archive": archive_name, "error": str(e)}
+
+
+def _iter_scan_items(sources: Iterator[Tuple[Any, str, Dict[str, Any]]], label: str,
+                     ruleset, mode: str) -> Iterator[Dict[str, Any]]:
+    """
+    批量 / 压缩包扫描共用：sources 产出 (stream, filename, 附加字段)，
+    stream 为 None 时附加字段里的 error 作为该条目的错误。
+    每扫完一个样本产出一条结果（按输入顺序），最后产出一条 summary。
+    """
+    def _finish(entry: Dict[str, Any]) -> Dict[str, Any]:
+        sample = entry.get("sample")
+        job_id = entry["job_id"]
+        filename = entry["filename"]
+        try:
+            if "item" in entry:
+                item = entry["item"]
+            elif "cached" in entry:
+                result = {"matches": entry["cached"], "complete": True, "unevaluated": []}
+                item = _scan_response(job_id, label, filename, sample, ruleset, result,
+                                      cached=True, mode=mode)
+            else:
+                result = entry["future"].result()
+                if mode == "full" and result["complete"]:
+                    _store_cached_matches(sample.sha256, ruleset, result["matches"])
+                item = _scan_response(job_id, label, filename, sample, ruleset, result,
+                                      cached=False, mode=mode)
+        except (ValueError, yara.Error) as e:
+            item = _scan_error("BAD_REQUEST", str(e), job_id, filename)
+        except Exception as e:
+            # 单个样本的意外错误（数据库 / IO 等）只记在该条目上，不中断整个 NDJSON 流
+            item = _scan_error("SCAN_FAILED", str(e), job_id, filename)
+        finally:
+            if sample is not None:
+                sample.close()
+        item.update(entry["extra"])
+        item["index"] = entry["index"]
+        return item
+
+    def _iter_items() -> Iterator[Dict[str, Any]]:
+        total = 0
+        errors = 0
+        hit_files = 0
+        # 同时在扫描线程池里的样本数上限，控制落盘 / 内存占用
+        window = SCAN_EXECUTOR.workers * 2
+        pending: "deque[Dict[str, Any]]" = deque()
+
+        def _account(item: Dict[str, Any]):
+            nonlocal errors, hit_files
+            errors += 0 if item.get("ok") else 1
+            hit_files += 1 if item.get("matches") else 0
+
+        source_iter = iter(sources)
+        source_failed = False
+
+        def _next_source():
+            # 来源本身（上传 / 解压流）抛出意外错误时，产出一条错误条目并停止读取后续来源
+            nonlocal source_failed
+            try:
+                return next(source_iter)
+            except StopIteration:
+                return None
+            except Exception as e:
+                source_failed = True
+                return None, "", {"error": str(e)}
+
+        try:
+            while not source_failed:
+                source = _next_source()
+                if source is None:
+                    break
+                stream, filename, extra = source
+                entry: Dict[str, Any] = {"job_id": uuid.uuid4().hex, "filename": filename,
+                                         "extra": extra, "index": total}
+                total += 1
+                if stream is None:
+                    error = extra.pop("error", "")
+                    if source_failed:
+                        code = "SOURCE_READ_FAILED"
+                    else:
+                        code = error if error == "ARCHIVE_BUDGET_EXCEEDED" else "ARCHIVE_READ_FAILED"
+                    entry["item"] = {"ok": False, "code": code, "message": error,
+                                     "sample_filename": filename}
+                else:
+                    try:
+                        sample = _SpooledSample.from_stream(stream)
+                        entry["sample"] = sample
+                        cached = _lookup_cached_matches(sample.sha256, ruleset)
+                        if cached is not None:
+                            entry["cached"] = cached
+                        else:
+                            entry["future"] = SCAN_EXECUTOR.submit(_match_sample, sample, ruleset, mode)
+                    except ValueError as e:
+                        msg = str(e)
+                        code = msg if msg in ("FILE_TOO_LARGE", "ARCHIVE_BUDGET_EXCEEDED") else "BAD_REQUEST"
+                        entry["item"] = _scan_error(code, msg, entry["job_id"], filename)
+                    except Exception as e:
+                        # 成员解压流损坏 / 缓存查询失败等：只影响当前条目
+                        entry["item"] = _scan_error("SCAN_FAILED", str(e), entry["job_id"], filename)
+
+                pending.append(entry)
+                while len(pending) >= window:
+                    item = _finish(pending.popleft())
+                    _account(item)
+                    yield item
+
+            while pending:
+                item = _finish(pending.popleft())
+                _account(item)
+                yield item
+        finally:
+            # 客户端中途断开时，清理尚未完成样本的落盘文件
+            for entry in pending:
+                if entry.get("future") is not None:
+                    entry["future"].cancel()
+                if entry.get("sample") is not None:
+                    entry["sample"].close()
+
+        yield {
+            "ok": True,
+            "summary": True,
+            "rule_set": ruleset.rule_set,
+            "selector": ruleset.selector_key,
+            "ruleset_version": ruleset.version,
+            "total": total,
+            "hit_files": hit_files,
+            "errors": errors,
+        }
+
+    return _iter_items()
+
+
+def _run_scan_job(job: Dict[str, Any], queue: JobQueue) -> Dict[str, Any]:
+    """
+    异步扫描任务：样本已在提交时落盘到任务目录，扫描完成后删除。
+    """
+    job_id = job["job_id"]
+    params = job["params"]
+    mode = params.get("mode") or "full"
+
+    sample = _SpooledSample.from_path(params["sample_path"], params["sample_sha256"])
+    try:
+        queue.set_progress(job_id, phase="loading_ruleset")
+        ruleset = MalYaraRuleset.get_ruleset(params.get("rule_set") or "enabled",
+                                             params.get("selector") or "")
+
+        queue.set_progress(job_id, phase="scanning", bundles=len(ruleset.bundles))
+        result, cached = _scan_sample(sample, ruleset, mode)
+        return _scan_response(job_id, params.get("label") or "", params.get("sample_filename") or "",
+                              sample, ruleset, result, cached=cached, mode=mode)
+    finally:
+        sample.close()
+        try:
+            os.rmdir(queue.job_dir(job_id))
+        except OSError:
+            pass
+
+
+# 任务 worker 只负责排队和落库，实际匹配仍在 SCAN_EXECUTOR 里执行
+SCAN_JOB_WORKERS = int(os.environ.get("YARA_JOB_WORKERS") or SCAN_EXECUTOR.workers)
+SCAN_JOBS = JobQueue("yara_scan", _run_scan_job, workers=SCAN_JOB_WORKERS)
 
 
 class MalYaraScan:
@@ -67,89 +690,180 @@ class MalYaraScan:
     @staticmethod
     def scan_sample_with_yara(file_storage,
                               label: str = "",
-                              rule_set: str = "enabled") -> Dict[str, Any]:
+                              rule_set: str = "enabled",
+                              mode: str = "full",
+                              selector: str = "") -> Dict[str, Any]:
 
         if file_storage is None:
             raise ValueError("缺少上传文件：file")
+        if mode not in _SCAN_MODES:
+            raise ValueError("mode 参数非法：仅允许 full|verdict")
 
         filename = _safe_filename(file_storage.filename or "")
         if not filename:
             filename = "sample.bin"
 
-        raw = _read_filestorage_bytes(file_storage)
-        if len(raw) > MAX_SAMPLE_BYTES:
-            raise ValueError("FILE_TOO_LARGE")
+        # 流式读取：超过 MAX_LARGE_SAMPLE_BYTES 立即中止，大文件落盘后分窗扫描，不进内存
+        sample = _SpooledSample.from_stream(file_storage.stream, max_bytes=MAX_LARGE_SAMPLE_BYTES)
 
-        sample_sha256 = _sha256_hex(raw)
-
-        # --------- 任务目录 ----------
         job_id = uuid.uuid4().hex
-        job_dir = os.path.join(RUNTIME_DIR, job_id)
-        _ensure_dir(job_dir)
 
         try:
-            # 只从 yara_rule（编译表）取启用规则
-            yara_rule_table = get_yara_rule_table()
-
-            stmt = select(
-                yara_rule_table.c.compiled_sha256,
-                yara_rule_table.c.compiled_rule
-            )
-
-            if rule_set == "enabled":
-                stmt = stmt.where(yara_rule_table.c.enabled == 1)
-            elif rule_set == "all":
-                pass
-            else:
-                raise ValueError("rule_set 参数非法：仅允许 enabled|all")
+            # 规则从进程内缓存取，稳态下不读 compiled_rule、不调用 yara.load
+            ruleset = MalYaraRuleset.get_ruleset(rule_set, selector)
 
-            with db.engine.connect() as conn:
-                rows = conn.execute(stmt).mappings().all()
+            result, cached = _scan_sample(sample, ruleset, mode)
+            return _scan_response(job_id, label, filename, sample, ruleset, result, cached=cached, mode=mode)
 
-            if not rows:
-                raise ValueError("规则集为空：数据库里没有可用 YARA 规则（请先上传规则或启用规则）")
+        finally:
+            sample.close()
 
-            # compiled_sha256 去重加载
-            unique: Dict[str, bytes] = {}
-            for r in rows:
-                csha = (r.get("compiled_sha256") or "").strip()
-                blob = r.get("compiled_rule")
-                if not csha or not blob:
-                    continue
-                if csha not in unique:
-                    unique[csha] = blob
+    @staticmethod
+    def scan_samples_with_yara(file_storages: List[Any],
+                               label: str = "",
+                               rule_set: str = "enabled",
+                               mode: str = "full",
+                               selector: str = "",
+                               labels: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        批量扫描：多个文件，或单个压缩包（zip/tar/tgz，成员从解压流直接扫描）。
+        labels 不为空时与上传文件一一对应，作为各样本的 label（否则都用 label）。
+        规则集只加载一次；返回生成器，每扫完一个样本产出一条结果，
+        最后产出一条 summary。参数 / 规则集错误在返回生成器之前抛出。
+        """
+        file_storages = [f for f in (file_storages or []) if f is not None]
+        if not file_storages:
+            raise ValueError("缺少上传文件：files")
+        if len(file_storages) > MAX_BATCH_FILES:
+            raise ValueError(f"文件数量过多（>{MAX_BATCH_FILES}），已拒绝。")
+        if labels and len(labels) != len(file_storages):
+            raise ValueError("labels 数量必须与上传文件数量一致")
+        if mode not in _SCAN_MODES:
+            raise ValueError("mode 参数非法：仅允许 full|verdict")
+
+        ruleset = MalYaraRuleset.get_ruleset(rule_set, selector)
+
+        single = file_storages[0] if len(file_storages) == 1 else None
+        if single is not None and is_archive_name(single.filename or ""):
+            sources = _archive_sources(single)
+        else:
+            sources = ((f.stream, _safe_filename(f.filename or "") or "sample.bin",
+                        {"label": labels[i]} if labels else {})
+                       for i, f in enumerate(file_storages))
+
+        return _iter_scan_items(sources, label, ruleset, mode)
 
-            if not unique:
-                raise ValueError("规则集为空：没有可用的预编译规则（compiled_rule 为空）")
+    @staticmethod
+    def scan_archive_with_yara(file_storage,
+                               label: str = "",
+                               rule_set: str = "enabled",
+                               mode: str = "full",
+                               max_depth: Optional[int] = None,
+                               selector: str = "") -> Iterator[Dict[str, Any]]:
+        """
+        压缩包扫描（zip/tar/tgz）：成员不解压到磁盘，直接从解压流扫描，
+        嵌套压缩包递归展开（max_depth 不超过 ARCHIVE_MAX_DEPTH）。
+        返回生成器，每个成员一条结果，最后一条 summary。
+        """
+        if file_storage is None:
+            raise ValueError("缺少上传文件：file")
+        if not is_archive_name(file_storage.filename or ""):
+            raise ValueError("压缩包类型不支持：仅支持 .zip / .tar / .tar.gz / .tgz")
+        if mode not in _SCAN_MODES:
+            raise ValueError("mode 参数非法：仅允许 full|verdict")
+        depth = ARCHIVE_MAX_DEPTH if max_depth is None else min(max(1, int(max_depth)), ARCHIVE_MAX_DEPTH)
 
-            all_matches: List[yara.Match] = []
+        ruleset = MalYaraRuleset.get_ruleset(rule_set, selector)
+        return _iter_scan_items(_archive_sources(file_storage, max_depth=depth), label, ruleset, mode)
 
-            for csha, blob in unique.items():
-                compiled_path = os.path.join(job_dir, f"{csha}.yarc")
-                with open(compiled_path, "wb") as f:
-                    f.write(blob)
+    @staticmethod
+    def submit_scan_job(file_storage,
+                        label: str = "",
+                        rule_set: str = "enabled",
+                        mode: str = "full",
+                        selector: str = "") -> Dict[str, Any]:
+        """
+        异步扫描：样本落盘到任务目录后立即返回 sample_id，
+        通过 scan_job_status / scan_job_result 轮询。
+        """
+        if file_storage is None:
+            raise ValueError("缺少上传文件：file")
+        if mode not in _SCAN_MODES:
+            raise ValueError("mode 参数非法：仅允许 full|verdict")
+        MalYaraRuleset.check_rule_set(rule_set)
+        parse_selector(selector)
 
-                rules = yara.load(filepath=compiled_path)
+        filename = _safe_filename(file_storage.filename or "") or "sample.bin"
 
-                ms = rules.match(data=raw, timeout=SCAN_TIMEOUT_SECONDS)
-                if ms:
-                    all_matches.extend(ms)
+        job_id = SCAN_JOBS.new_job_id()
+        spool_path = os.path.join(SCAN_JOBS.job_dir(job_id), "sample.bin")
+        try:
+            sample = _SpooledSample.from_stream(file_storage.stream, max_bytes=MAX_LARGE_SAMPLE_BYTES,
+                                                spool_path=spool_path)
+        except BaseException:
+            try:
+                os.rmdir(SCAN_JOBS.job_dir(job_id))
+            except OSError:
+                pass
+            raise
+
+        SCAN_JOBS.submit({
+            "label": label or "",
+            "rule_set": rule_set,
+            "selector": selector or "",
+            "mode": mode,
+            "sample_filename": filename,
+            "sample_path": sample.path,
+            "sample_sha256": sample.sha256,
+            "sample_size": sample.size,
+        }, job_id=job_id)
+
+        return {
+            "ok": True,
+            "sample_id": job_id,
+            "status": "queued",
+            "sample_filename": filename,
+            "sample_sha256": sample.sha256,
+            "sample_size": sample.size,
+        }
 
-            matches = _to_matches_from_yara(all_matches)
+    @staticmethod
+    def scan_job_status(sample_id: str) -> Dict[str, Any]:
+        job = SCAN_JOBS.get(sample_id or "")
+        if job is None:
+            raise ValueError("任务不存在：sample_id")
+        params = job["params"]
+        data = {
+            "ok": True,
+            "sample_id": job["job_id"],
+            "status": job["status"],
+            "progress": job["progress"],
+            "sample_filename": params.get("sample_filename"),
+            "sample_sha256": params.get("sample_sha256"),
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+        }
+        if "queue_position" in job:
+            data["queue_position"] = job["queue_position"]
+        if job["status"] == STATUS_FAILED:
+            data["message"] = job["error"]
+        return data
 
-            return {
-                "ok": True,
-                "sample_id": job_id,
-                "label": label or "",
-                "sample_filename": filename,
-                "sample_sha256": sample_sha256,
-                "rule_set": rule_set,
-                "matches": matches,
-                "engine_stdout": "",
-                "engine_stderr": "",
-            }
+    @staticmethod
+    def scan_job_result(sample_id: str) -> Dict[str, Any]:
+        job = SCAN_JOBS.get(sample_id or "")
+        if job is None:
+            raise ValueError("任务不存在：sample_id")
+        if job["status"] == STATUS_DONE:
+            return job["result"]
+        if job["status"] == STATUS_FAILED:
+            return {"ok": False, "code": "SCAN_FAILED", "message": job["error"],
+                    "sample_id": job["job_id"], "status": job["status"]}
+        return {"ok": False, "code": "JOB_NOT_FINISHED", "message": "任务尚未完成",
+                "sample_id": job["job_id"], "status": job["status"], "progress": job["progress"]}
 
-        except yara.TimeoutError:
-            raise ValueError("SCAN_TIMEOUT")
-        finally:
-            shutil.rmtree(job_dir, ignore_errors=True)
+    @staticmethod
+    def executor_stats() -> Dict[str, Any]:
+        return {"ok": True, **SCAN_EXECUTOR.stats(), "jobs": SCAN_JOBS.stats(),
+                "rulesets": MalYaraRuleset.cache_stats()}
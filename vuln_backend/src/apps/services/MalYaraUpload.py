@@ -11,9 +11,15 @@ from typing import List, Dict, Any, Tuple, Optional
 
 import yara  # pip install yara-python
 
-from sqlalchemy import MetaData, Table, select
+from sqlalchemy import MetaData, Table, Column, String, Integer, DateTime, select, update
 from sqlalchemy.dialects.mysql import insert as mysql_insert
 from src.extension import *
+from src.apps.services.MalYaraRuleset import MalYaraRuleset
+from src.apps.services.MalYaraCompile import CompileResult, compile_files_to_blobs, rules_to_blob
+from src.apps.services.MalYaraArtifact import db_blob_value, put_artifact
+from src.apps.services.MalYaraLint import (
+    enforce_policy, lint_rules, store_lints, warnings_by_rule
+)
 
 metadata = MetaData()
 
@@ -26,6 +32,21 @@ def get_yara_uncompiled_table() -> Table:
     return Table("yara_uncompiled", metadata, autoload_with=db.engine)
 
 
+# 编译缓存：源文件 sha256 + yara-python 版本 -> yara_rule.id，未变化的文件不再重新编译
+_yara_source_cache = Table(
+    "yara_source_cache",
+    metadata,
+    Column("source_sha256", String(64), primary_key=True),
+    Column("yara_version", String(32), primary_key=True),
+    Column("compiled_rule_id", Integer, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+)
+
+
+def get_yara_source_cache_table() -> Table:
+    return ensure_table(_yara_source_cache)
+
+
 # --------------------------
 # 配置路径
 # --------------------------
@@ -37,8 +58,13 @@ _MAX_ZIP_ENTRIES = 500
 _MAX_SINGLE_FILE_BYTES = 20 * 1024 * 1024
 _MAX_ZIP_TOTAL_BYTES = 80 * 1024 * 1024
 _TEXT_DECODE_FALLBACK = "utf-8"
+# yara_uncompiled 批量写入：每条多行 INSERT 携带的行数
+_INSERT_BATCH_SIZE = 500
 
 _RULE_HEADER_RE = re.compile(r"(?m)^\s*(?:private\s+)?rule\s+([A-Za-z_]\w*)\b")
+# 带 include 的源文件编译结果还取决于被包含文件，不走编译缓存
+_INCLUDE_RE = re.compile(r'(?m)^\s*include\s+"')
+_YARA_VERSION = getattr(yara, "__version__", "") or "unknown"
 
 
 def _ensure_dir(p: str):
@@ -115,43 +141,13 @@ def _write_zip_members_to_dir(zf: zipfile.ZipFile, members: List[zipfile.ZipInfo
             f.write(zf.read(info))
 
 
-def _compile_rules_to_blob_from_source(source_text: str) -> bytes:
+def _compile_rules_to_blob_from_source(source_text: str) -> Tuple[bytes, List[str]]:
     """
-    单文件上传：直接 compile(source=...)
+    单文件上传：直接 compile(source=...)，返回 (编译产物, 编译器告警)
     注意：如果规则 include 其它文件，这种方式会失败
     """
     rules = yara.compile(source=source_text)
-
-    job_id = uuid.uuid4().hex
-    job_dir = os.path.join(RUNTIME_DIR, "single_" + job_id)
-    _ensure_dir(job_dir)
-    out_path = os.path.join(job_dir, "compiled.yarc")
-
-    try:
-        rules.save(out_path)
-        with open(out_path, "rb") as f:
-            return f.read()
-    finally:
-        shutil.rmtree(job_dir, ignore_errors=True)
-
-
-def _compile_rules_to_blob_from_filepath(filepath: str) -> bytes:
-    """
-    zip 上传：用 filepath 编译，支持 include（相对路径基于文件所在目录）。
-    """
-    rules = yara.compile(filepath=filepath)
-
-    job_id = uuid.uuid4().hex
-    job_dir = os.path.join(RUNTIME_DIR, "file_" + job_id)
-    _ensure_dir(job_dir)
-    out_path = os.path.join(job_dir, "compiled.yarc")
-
-    try:
-        rules.save(out_path)
-        with open(out_path, "rb") as f:
-            return f.read()
-    finally:
-        shutil.rmtree(job_dir, ignore_errors=True)
+    return rules_to_blob(rules), list(rules.warnings or [])
 
 
 def _get_or_create_compiled_rule_id(
@@ -168,6 +164,8 @@ def _get_or_create_compiled_rule_id(
       - 不存在：插入并拿到 id
     """
     compiled_sha = _sha256_hex(compiled_blob)
+    # 编译产物落到内容寻址文件仓库；事务回滚留下的文件按哈希命名，无害且可复用
+    put_artifact(compiled_blob, compiled_sha)
 
     # 先查
     stmt_sel = select(yara_rule_table.c.id).where(yara_rule_table.c.compiled_sha256 == compiled_sha)
@@ -179,7 +177,7 @@ def _get_or_create_compiled_rule_id(
     row_ins = {
         "source_name": source_name,
         "source_file": source_file,
-        "compiled_rule": compiled_blob,
+        "compiled_rule": db_blob_value(compiled_blob),
         "compiled_sha256": compiled_sha,
         "compiled_at": now,
         "enabled": 1,
@@ -200,6 +198,94 @@ def _get_or_create_compiled_rule_id(
     return int(new_id)
 
 
+def _uncompiled_row(rule_name: str, rule_text: str, source_name: str, source_file: str,
+                    compiled_rule_id: int, now: datetime) -> Dict[str, Any]:
+    return {
+        "rule_name": rule_name,
+        "rule_text": rule_text,
+        "source_name": source_name,
+        "source_file": source_file,
+        "sha256": _sha256_hex(rule_text.encode("utf-8", errors="replace")),
+        "compiled_rule_id": compiled_rule_id,  #外键
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def _bulk_insert_uncompiled(conn, yara_un_table: Table, rows: List[Dict[str, Any]]) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    yara_uncompiled 分批写入（按 sha256 去重）：
+      - 每批先用一条 IN 查询取出已存在的 sha256，批内重复的也只保留第一条
+      - 剩余行用一条多行 INSERT IGNORE 写入，rowcount 即实际写入条数
+    返回 (inserted, 新写入的行)。
+    """
+    inserted = 0
+    new_rows: List[Dict[str, Any]] = []
+    seen = set()
+    for i in range(0, len(rows), _INSERT_BATCH_SIZE):
+        batch = rows[i:i + _INSERT_BATCH_SIZE]
+        shas = list({r["sha256"] for r in batch})
+        existing = set(conn.execute(
+            select(yara_un_table.c.sha256).where(yara_un_table.c.sha256.in_(shas))
+        ).scalars().all())
+
+        fresh: List[Dict[str, Any]] = []
+        for r in batch:
+            if r["sha256"] in existing or r["sha256"] in seen:
+                continue
+            seen.add(r["sha256"])
+            fresh.append(r)
+        if not fresh:
+            continue
+
+        res = conn.execute(mysql_insert(yara_un_table).values(fresh).prefix_with("IGNORE"))
+        inserted += max(res.rowcount, 0)
+        new_rows.extend(fresh)
+    return inserted, new_rows
+
+
+def _lookup_source_cache(source_shas: List[str]) -> Dict[str, int]:
+    """
+    按源文件 sha256 查编译缓存，只返回 yara_rule 里仍然存在的 id。
+    """
+    if not source_shas:
+        return {}
+    cache_table = get_yara_source_cache_table()
+    yara_rule_table = get_yara_rule_table()
+    stmt = select(cache_table.c.source_sha256, cache_table.c.compiled_rule_id).select_from(
+        cache_table.join(yara_rule_table, cache_table.c.compiled_rule_id == yara_rule_table.c.id)
+    ).where(
+        cache_table.c.source_sha256.in_(list(set(source_shas))),
+        cache_table.c.yara_version == _YARA_VERSION,
+    )
+    with db.engine.connect() as conn:
+        return {r[0]: int(r[1]) for r in conn.execute(stmt).all()}
+
+
+def _store_source_cache(conn, entries: Dict[str, int], now: datetime) -> None:
+    if not entries:
+        return
+    cache_table = get_yara_source_cache_table()
+    stmt = mysql_insert(cache_table).values([
+        {"source_sha256": sha, "yara_version": _YARA_VERSION, "compiled_rule_id": cid, "created_at": now}
+        for sha, cid in entries.items()
+    ])
+    stmt = stmt.on_duplicate_key_update(compiled_rule_id=stmt.inserted.compiled_rule_id, created_at=now)
+    conn.execute(stmt)
+
+
+def _slow_rule_summary(lint: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "rule_sha256": lint["rule_sha256"],
+        "rule_name": lint["rule_name"],
+        "source_file": lint["source_file"],
+        "cost_score": lint["cost_score"],
+        "warnings": lint["warnings"],
+        "cost_reasons": lint["cost_reasons"],
+        "disabled": bool(lint["disabled"]),
+    }
+
+
 class MalYaraUpload:
 
     @staticmethod
@@ -219,17 +305,31 @@ class MalYaraUpload:
 
         rule_text_full = _decode_text(raw)
         rules = _split_yara_rules(rule_text_full)
+        file_sha = _sha256_hex(raw)
+        cacheable = not _INCLUDE_RE.search(rule_text_full)
+
+        # 同一源文件已编译过：直接复用 yara_rule.id，跳过编译
+        cached_rule_id = _lookup_source_cache([file_sha]).get(file_sha) if cacheable else None
 
         # 编译（单文件：不支持 include 依赖，失败即报错）
-        try:
-            compiled_blob = _compile_rules_to_blob_from_source(rule_text_full)
-        except yara.SyntaxError as e:
-            raise ValueError(f"YARA_COMPILE_FAILED: {str(e)}")
-        except yara.Error as e:
-            raise ValueError(f"YARA_COMPILE_FAILED: {str(e)}")
+        compiled_blob = None
+        compile_warnings: List[str] = []
+        if cached_rule_id is None:
+            try:
+                compiled_blob, compile_warnings = _compile_rules_to_blob_from_source(rule_text_full)
+            except yara.SyntaxError as e:
+                raise ValueError(f"YARA_COMPILE_FAILED: {str(e)}")
+            except yara.Error as e:
+                raise ValueError(f"YARA_COMPILE_FAILED: {str(e)}")
 
         now = datetime.now()
         source_name2 = source_name or "manual-upload"
+
+        # 性能检查：编译器告警按规则归类 + 开销估算；命中编译缓存的文件上次上传时已检查过
+        rows = [_uncompiled_row(rule_name, rule_text, source_name2, filename, None, now)
+                for rule_name, rule_text in rules]
+        lints = lint_rules(rows, warnings_by_rule(rule_text_full, compile_warnings)) if cached_rule_id is None else []
+        slow_rules = enforce_policy(lints)
         yara_rule_table = get_yara_rule_table()
         yara_un_table = get_yara_uncompiled_table()
 
@@ -239,35 +339,30 @@ class MalYaraUpload:
 
         with db.engine.begin() as conn:
             # 1) 编译产物入 yara_rule（去重复用）
-            compiled_rule_id = _get_or_create_compiled_rule_id(
-                conn,
-                yara_rule_table,
-                source_name=source_name2,
-                source_file=filename,
-                compiled_blob=compiled_blob,
-                now=now,
-            )
-
-            # 2) 原始规则入 yara_uncompiled（按 rule_text sha 去重）
-            for rule_name, rule_text in rules:
-                sha = _sha256_hex(rule_text.encode("utf-8", errors="replace"))
-                row = {
-                    "rule_name": rule_name,
-                    "rule_text": rule_text,
-                    "source_name": source_name2,
-                    "source_file": filename,
-                    "sha256": sha,
-                    "compiled_rule_id": compiled_rule_id,  #外键
-                    "created_at": now,
-                    "updated_at": now,
-                }
-                stmt = mysql_insert(yara_un_table).values(**row).prefix_with("IGNORE")
-                res = conn.execute(stmt)
-                if res.rowcount == 1:
-                    inserted += 1
-                    stored_rule_names.append(rule_name)
-                else:
-                    skipped += 1
+            if cached_rule_id is not None:
+                compiled_rule_id = cached_rule_id
+            else:
+                compiled_rule_id = _get_or_create_compiled_rule_id(
+                    conn,
+                    yara_rule_table,
+                    source_name=source_name2,
+                    source_file=filename,
+                    compiled_blob=compiled_blob,
+                    now=now,
+                )
+                if cacheable:
+                    _store_source_cache(conn, {file_sha: compiled_rule_id}, now)
+
+            # 2) 原始规则入 yara_uncompiled（按 rule_text sha 去重，批量写入）
+            for r in rows + lints:
+                r["compiled_rule_id"] = compiled_rule_id
+            inserted, new_rows = _bulk_insert_uncompiled(conn, yara_un_table, rows)
+            store_lints(conn, lints, now)
+            skipped = len(rows) - inserted
+            stored_rule_names = [r["rule_name"] for r in new_rows]
+
+        # 规则集变化：丢弃扫描侧的进程内缓存
+        MalYaraRuleset.invalidate()
 
         return {
             "ok": True,
@@ -277,7 +372,11 @@ class MalYaraUpload:
             "stored_count": inserted,
             "skipped_count": skipped,
             "rule_names": stored_rule_names,
-            "file_sha256": _sha256_hex(raw),
+            "compile_cached": cached_rule_id is not None,
+            "slow_rules": [_slow_rule_summary(item) for item in slow_rules],
+            # policy=disable：只停用被标记的规则，人工确认后用 /setYaraSlowRuleEnabled 启用
+            "disabled_rules": [_slow_rule_summary(item) for item in slow_rules if item["disabled"]],
+            "file_sha256": file_sha,
             "created_at": now.isoformat(timespec="seconds"),
         }
 
@@ -307,6 +406,7 @@ class MalYaraUpload:
             skipped = 0
             stored_files: List[str] = []
             stored_rule_names: List[str] = []
+            pending_rows: List[Dict[str, Any]] = []
 
             # 一个 job_dir 用于落盘 zip（支持 include）
             job_id = uuid.uuid4().hex
@@ -318,28 +418,60 @@ class MalYaraUpload:
                     members = _safe_zip_members(zf)
                     _write_zip_members_to_dir(zf, members, job_dir)
 
-                    with db.engine.begin() as conn:
-                        for info in members:
-                            member_name = info.filename.replace("\\", "/").lstrip("/")
-                            disk_path = os.path.join(job_dir, member_name)
-
-                            if os.path.getsize(disk_path) > _MAX_SINGLE_FILE_BYTES:
-                                raise ValueError(f"zip 内文件过大：{member_name}")
-
-                            with open(disk_path, "rb") as f:
-                                text = _decode_text(f.read())
-
-                            rules = _split_yara_rules(text)
-
-                            # 编译：用 filepath（支持 include）
-                            try:
-                                compiled_blob = _compile_rules_to_blob_from_filepath(disk_path)
-                            except yara.SyntaxError as e:
-                                raise ValueError(f"YARA_COMPILE_FAILED: {member_name}: {str(e)}")
-                            except yara.Error as e:
-                                raise ValueError(f"YARA_COMPILE_FAILED: {member_name}: {str(e)}")
-
-                            # 1) 编译产物入 yara_rule（去重复用）
+                # 1) 读取 + 拆分规则（不连数据库）
+                member_names: List[str] = []
+                member_rules: List[List[Tuple[str, str]]] = []
+                disk_paths: List[str] = []
+                member_shas: List[Optional[str]] = []  # None 表示带 include，不走编译缓存
+                for info in members:
+                    member_name = info.filename.replace("\\", "/").lstrip("/")
+                    disk_path = os.path.join(job_dir, member_name)
+
+                    if os.path.getsize(disk_path) > _MAX_SINGLE_FILE_BYTES:
+                        raise ValueError(f"zip 内文件过大：{member_name}")
+
+                    with open(disk_path, "rb") as f:
+                        raw_member = f.read()
+                    text = _decode_text(raw_member)
+
+                    member_names.append(member_name)
+                    member_shas.append(None if _INCLUDE_RE.search(text) else _sha256_hex(raw_member))
+                    member_rules.append(_split_yara_rules(text))
+                    disk_paths.append(disk_path)
+
+                # 2) 编译：源文件 sha256 命中编译缓存的直接复用 yara_rule.id；
+                #    其余用进程池并行编译（filepath，支持 include），错误按成员收集，任一失败整包拒绝
+                cached_ids = _lookup_source_cache([sha for sha in member_shas if sha])
+                to_compile = [i for i, sha in enumerate(member_shas) if sha not in cached_ids]
+                compiled: List[CompileResult] = [(None, "", [])] * len(member_names)
+                for i, result in zip(to_compile, compile_files_to_blobs([disk_paths[i] for i in to_compile])):
+                    compiled[i] = result
+                # 错误信息里的落盘路径换成 zip 内相对路径
+                errors = [f"{member_names[i]}: {compiled[i][1].replace(job_dir + os.sep, '')}"
+                          for i in to_compile if compiled[i][0] is None]
+                if errors:
+                    raise ValueError(f"YARA_COMPILE_FAILED（{len(errors)} 个文件）: " + "; ".join(errors))
+
+                # 性能检查：只检查本次实际编译的文件（命中编译缓存的上次已检查）
+                member_lints: List[List[Dict[str, Any]]] = [[] for _ in member_names]
+                for i in to_compile:
+                    rows_i = [_uncompiled_row(rule_name, rule_text, source_name2, member_names[i], None, now)
+                              for rule_name, rule_text in member_rules[i]]
+                    with open(disk_paths[i], "rb") as f:
+                        source_i = _decode_text(f.read())
+                    member_lints[i] = lint_rules(rows_i, warnings_by_rule(source_i, compiled[i][2], disk_paths[i]))
+                slow_rules = enforce_policy([item for lints_i in member_lints for item in lints_i])
+
+                # 3) 一个短事务写库
+                with db.engine.begin() as conn:
+                    new_cache: Dict[str, int] = {}
+                    all_lints: List[Dict[str, Any]] = []
+                    for member_name, rules, sha, (compiled_blob, _, _), lints_i in zip(
+                            member_names, member_rules, member_shas, compiled, member_lints):
+                        # 编译产物入 yara_rule（去重复用）
+                        if sha in cached_ids:
+                            compiled_rule_id = cached_ids[sha]
+                        else:
                             compiled_rule_id = _get_or_create_compiled_rule_id(
                                 conn,
                                 yara_rule_table,
@@ -348,36 +480,32 @@ class MalYaraUpload:
                                 compiled_blob=compiled_blob,
                                 now=now,
                             )
-
-                            # 2) 原始规则入 yara_uncompiled（按 rule_text sha 去重）
-                            file_inserted_any = False
-                            for rule_name, rule_text in rules:
-                                sha = _sha256_hex(rule_text.encode("utf-8", errors="replace"))
-                                row = {
-                                    "rule_name": rule_name,
-                                    "rule_text": rule_text,
-                                    "source_name": source_name2,
-                                    "source_file": member_name,
-                                    "sha256": sha,
-                                    "compiled_rule_id": compiled_rule_id,
-                                    "created_at": now,
-                                    "updated_at": now,
-                                }
-                                stmt = mysql_insert(yara_un_table).values(**row).prefix_with("IGNORE")
-                                res = conn.execute(stmt)
-                                if res.rowcount == 1:
-                                    inserted += 1
-                                    stored_rule_names.append(rule_name)
-                                    file_inserted_any = True
-                                else:
-                                    skipped += 1
-
-                            if file_inserted_any:
-                                stored_files.append(member_name)
+                            if sha:
+                                new_cache[sha] = compiled_rule_id
+                        for item in lints_i:
+                            item["compiled_rule_id"] = compiled_rule_id
+                        all_lints.extend(lints_i)
+
+                        # 原始规则先缓冲，最后统一批量写入
+                        pending_rows.extend(
+                            _uncompiled_row(rule_name, rule_text, source_name2, member_name, compiled_rule_id, now)
+                            for rule_name, rule_text in rules
+                        )
+
+                    _store_source_cache(conn, new_cache, now)
+                    store_lints(conn, all_lints, now)
+                    inserted, new_rows = _bulk_insert_uncompiled(conn, yara_un_table, pending_rows)
+                    skipped = len(pending_rows) - inserted
+                    stored_rule_names = [r["rule_name"] for r in new_rows]
+                    for r in new_rows:
+                        if r["source_file"] not in stored_files:
+                            stored_files.append(r["source_file"])
 
             finally:
                 shutil.rmtree(job_dir, ignore_errors=True)
 
+            MalYaraRuleset.invalidate()
+
             return {
                 "ok": True,
                 "kind": "zip",
@@ -386,6 +514,10 @@ class MalYaraUpload:
                 "stored_count": inserted,
                 "skipped_count": skipped,
                 "stored_files": stored_files,
+                "compiled_files": len(to_compile),
+                "compile_cached_files": len(member_names) - len(to_compile),
+                "slow_rules": [_slow_rule_summary(item) for item in slow_rules[:200]],
+                "disabled_rules": [_slow_rule_summary(item) for item in slow_rules if item["disabled"]][:200],
                 "rule_names_sample": stored_rule_names[:50],
                 "zip_sha256": _sha256_hex(raw_zip),
                 "created_at": now.isoformat(timespec="seconds"),
@@ -393,3 +525,36 @@ class MalYaraUpload:
 
         except Exception as e:
             raise ValueError(f"[upload_zip] {str(e)}")
+
+    @staticmethod
+    def set_rule_enabled(rule_id: int, enabled: bool) -> Dict[str, Any]:
+        """
+        启用 / 停用一条编译规则（yara_rule.id），并让扫描侧缓存失效。
+        """
+        try:
+            rule_id = int(rule_id)
+        except (TypeError, ValueError):
+            raise ValueError("rule_id 参数非法")
+
+        now = datetime.now()
+        yara_rule_table = get_yara_rule_table()
+
+        stmt = (
+            update(yara_rule_table)
+            .where(yara_rule_table.c.id == rule_id)
+            .values(enabled=1 if enabled else 0, updated_at=now)
+        )
+        with db.engine.begin() as conn:
+            res = conn.execute(stmt)
+
+        if res.rowcount == 0:
+            raise ValueError(f"未找到 YARA 规则：id={rule_id}")
+
+        MalYaraRuleset.invalidate()
+
+        return {
+            "ok": True,
+            "id": rule_id,
+            "enabled": bool(enabled),
+            "updated_at": now.isoformat(timespec="seconds"),
+        }
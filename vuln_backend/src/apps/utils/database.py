@@ -1,4 +1,26 @@
+import threading
+
+from sqlalchemy import Table
+
 from src.apps import db
 
+_ensured_tables = set()
+_ensure_lock = threading.Lock()
+
+
 def get_db_connection():
-    return db.session
\ No newline at end of file
+    return db.session
+
+
+def ensure_table(table: Table) -> Table:
+    """
+    服务自己维护的缓存 / 任务表：首次使用时 CREATE TABLE IF NOT EXISTS，
+    之后直接返回，不再访问数据库。
+    """
+    if table.name in _ensured_tables:
+        return table
+    with _ensure_lock:
+        if table.name not in _ensured_tables:
+            table.create(db.engine, checkfirst=True)
+            _ensured_tables.add(table.name)
+    return table
@@ -0,0 +1,314 @@
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../.."))
+JOB_DIR = os.path.join(PROJECT_ROOT, "runtime", "jobs")
+JOB_DB_PATH = os.path.join(JOB_DIR, "jobs.sqlite3")
+
+# 已结束任务（done / failed）保留时长，过期后连同任务目录一起清理
+JOB_RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_SECONDS") or 7 * 24 * 3600)
+_POLL_SECONDS = 1.0
+# 任务租约：执行中的任务由领取它的进程定期续约，超过该时长未续约才视为进程已退出、重新排队
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS") or 60)
+_HEARTBEAT_SECONDS = max(1.0, JOB_LEASE_SECONDS / 4)
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+_db_lock = threading.Lock()
+_db_ready = False
+
+# 本进程的租约标识（主机 + pid + 随机串，pid 复用时也不会误认）
+_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# kind -> JobQueue；服务模块导入时注册，create_app 里统一启动
+_QUEUES: Dict[str, "JobQueue"] = {}
+
+
+def _connect() -> sqlite3.Connection:
+    global _db_ready
+    if not _db_ready:
+        os.makedirs(JOB_DIR, exist_ok=True)
+    conn = sqlite3.connect(JOB_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if not _db_ready:
+        with _db_lock:
+            if not _db_ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS job ("
+                    " id TEXT PRIMARY KEY,"
+                    " kind TEXT NOT NULL,"
+                    " status TEXT NOT NULL,"
+                    " params TEXT NOT NULL,"
+                    " progress TEXT,"
+                    " result TEXT,"
+                    " error TEXT,"
+                    " created_at REAL NOT NULL,"
+                    " started_at REAL,"
+                    " finished_at REAL,"
+                    " owner TEXT,"
+                    " heartbeat_at REAL)"
+                )
+                # 旧库补列
+                cols = {r["name"] for r in conn.execute("PRAGMA table_info(job)").fetchall()}
+                for col, ddl in (("owner", "TEXT"), ("heartbeat_at", "REAL")):
+                    if col not in cols:
+                        conn.execute(f"ALTER TABLE job ADD COLUMN {col} {ddl}")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_job_kind_status ON job (kind, status, created_at)")
+                _db_ready = True
+    return conn
+
+
+def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "params": json.loads(row["params"] or "{}"),
+        "progress": json.loads(row["progress"] or "{}"),
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"] or "",
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+    }
+
+
+class JobQueue:
+    """
+    本地持久化任务队列（runtime/jobs/jobs.sqlite3）：
+      - submit() 只写一行 queued 记录，立即返回 job_id
+      - 后台 worker 线程按提交顺序领取任务，在 app_context 里调用 handler(job, queue)
+      - 执行中的任务带租约（owner + heartbeat_at），只有租约过期（领取它的进程已退出）
+        的任务才会重新排队，其它进程正在执行的任务不受影响
+    任务的输入文件放在 job_dir(job_id)，任务结束后由 handler 自行清理。
+    """
+
+    def __init__(self, kind: str, handler: Callable[[Dict[str, Any], "JobQueue"], Dict[str, Any]],
+                 workers: int = 1):
+        self.kind = kind
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self._app = None
+        self._threads: List[threading.Thread] = []
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+        # 本进程正在执行的 job_id，由心跳线程续约
+        self._running: set = set()
+        self._running_lock = threading.Lock()
+        _QUEUES[kind] = self
+
+    # -----------------------
+    # 提交 / 查询
+    # -----------------------
+    def new_job_id(self) -> str:
+        return uuid.uuid4().hex
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(JOB_DIR, self.kind, job_id)
+
+    def submit(self, params: Dict[str, Any], job_id: Optional[str] = None) -> str:
+        job_id = job_id or self.new_job_id()
+        conn = _connect()
+        try:
+            conn.execute(
+                "INSERT INTO job (id, kind, status, params, progress, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, self.kind, STATUS_QUEUED, json.dumps(params, ensure_ascii=False),
+                 json.dumps({"phase": STATUS_QUEUED}), time.time()),
+            )
+        finally:
+            conn.close()
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        conn = _connect()
+        try:
+            row = conn.execute("SELECT * FROM job WHERE id = ? AND kind = ?", (job_id, self.kind)).fetchone()
+            if row is None:
+                return None
+            job = _row_to_job(row)
+            if job["status"] == STATUS_QUEUED:
+                ahead = conn.execute(
+                    "SELECT COUNT(*) FROM job WHERE kind = ? AND status = ? AND created_at < ?",
+                    (self.kind, STATUS_QUEUED, row["created_at"]),
+                ).fetchone()[0]
+                job["queue_position"] = int(ahead)
+            return job
+        finally:
+            conn.close()
+
+    def set_progress(self, job_id: str, **progress) -> None:
+        conn = _connect()
+        try:
+            conn.execute("UPDATE job SET progress = ? WHERE id = ?",
+                         (json.dumps(progress, ensure_ascii=False), job_id))
+        finally:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        conn = _connect()
+        try:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM job WHERE kind = ? GROUP BY status",
+                                (self.kind,)).fetchall()
+        finally:
+            conn.close()
+        counts = {STATUS_QUEUED: 0, STATUS_RUNNING: 0, STATUS_DONE: 0, STATUS_FAILED: 0}
+        counts.update({r["status"]: int(r["n"]) for r in rows})
+        return {"kind": self.kind, "workers": self.workers, **counts}
+
+    # -----------------------
+    # worker
+    # -----------------------
+    def start(self, app) -> None:
+        with self._start_lock:
+            if self._threads:
+                return
+            self._app = app
+            self._recover_expired()
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker_loop, name=f"job-{self.kind}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            t = threading.Thread(target=self._heartbeat_loop, name=f"job-{self.kind}-heartbeat", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _recover_expired(self) -> None:
+        """
+        租约过期（领取进程已退出且超过 JOB_LEASE_SECONDS 未续约）的执行中任务重新排队。
+        """
+        conn = _connect()
+        try:
+            conn.execute(
+                "UPDATE job SET status = ?, started_at = NULL, owner = NULL, heartbeat_at = NULL"
+                " WHERE kind = ? AND status = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (STATUS_QUEUED, self.kind, STATUS_RUNNING, time.time() - JOB_LEASE_SECONDS),
+            )
+        finally:
+            conn.close()
+
+    def _heartbeat_loop(self) -> None:
+        while True:
+            time.sleep(_HEARTBEAT_SECONDS)
+            with self._running_lock:
+                ids = list(self._running)
+            if not ids:
+                continue
+            try:
+                conn = _connect()
+                try:
+                    conn.executemany(
+                        "UPDATE job SET heartbeat_at = ? WHERE id = ? AND owner = ?",
+                        [(time.time(), job_id, _OWNER) for job_id in ids],
+                    )
+                finally:
+                    conn.close()
+            except sqlite3.Error:
+                traceback.print_exc()
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        conn = _connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM job WHERE kind = ? AND status = ? ORDER BY created_at LIMIT 1",
+                (self.kind, STATUS_QUEUED),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            started = time.time()
+            conn.execute("UPDATE job SET status = ?, started_at = ?, owner = ?, heartbeat_at = ? WHERE id = ?",
+                         (STATUS_RUNNING, started, _OWNER, started, row["id"]))
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        job = _row_to_job(row)
+        job["status"] = STATUS_RUNNING
+        job["started_at"] = started
+        return job
+
+    def _finish(self, job_id: str, status: str, result: Optional[Dict[str, Any]], error: str) -> None:
+        conn = _connect()
+        try:
+            # 只有仍持有租约时才写结果：租约已被回收（任务被别的进程重新执行）时不覆盖对方的状态
+            conn.execute(
+                "UPDATE job SET status = ?, result = ?, error = ?, progress = ?, finished_at = ?"
+                " WHERE id = ? AND owner = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+                 json.dumps({"phase": status}), time.time(), job_id, _OWNER),
+            )
+        finally:
+            conn.close()
+
+    def _purge_expired(self) -> None:
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        conn = _connect()
+        try:
+            ids = [r["id"] for r in conn.execute(
+                "SELECT id FROM job WHERE kind = ? AND status IN (?, ?) AND finished_at < ?",
+                (self.kind, STATUS_DONE, STATUS_FAILED, cutoff),
+            ).fetchall()]
+            conn.executemany("DELETE FROM job WHERE id = ?", [(i,) for i in ids])
+        finally:
+            conn.close()
+        for job_id in ids:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    def _worker_loop(self) -> None:
+        last_purge = 0.0
+        last_recover = time.time()
+        while True:
+            try:
+                if time.time() - last_purge > 3600:
+                    last_purge = time.time()
+                    self._purge_expired()
+                if time.time() - last_recover > JOB_LEASE_SECONDS:
+                    last_recover = time.time()
+                    self._recover_expired()
+                job = self._claim()
+            except sqlite3.Error:
+                traceback.print_exc()
+                time.sleep(_POLL_SECONDS)
+                continue
+
+            if job is None:
+                self._wakeup.wait(_POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+
+            with self._running_lock:
+                self._running.add(job["job_id"])
+            try:
+                with self._app.app_context():
+                    result = self.handler(job, self)
+                self._finish(job["job_id"], STATUS_DONE, result, "")
+            except Exception as e:
+                self._finish(job["job_id"], STATUS_FAILED, None, str(e))
+            finally:
+                with self._running_lock:
+                    self._running.discard(job["job_id"])
+
+
+def start_job_queues(app) -> None:
+    """
+    启动所有已注册队列的 worker，并恢复租约已过期的任务。
+    """
+    for queue in list(_QUEUES.values()):
+        queue.start(app)
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# 启动预热：服务模块导入时注册预热函数，create_app 里在后台线程依次执行。
+# 预热函数返回附加信息（规则集版本等），抛异常视为该项失败。
+# required=False 的项（如 Sigma）失败不影响整体就绪，只在 items 里体现。
+_WARMUPS: List[Tuple[str, Callable[[], Dict[str, Any]], bool]] = []
+
+# 失败项按指数退避重试（数据库 / 规则产物暂不可用时不会永久停在 failed）
+RETRY_BASE_SECONDS = float(os.environ.get("WARMUP_RETRY_BASE_SECONDS") or 5)
+RETRY_MAX_SECONDS = float(os.environ.get("WARMUP_RETRY_MAX_SECONDS") or 300)
+
+_lock = threading.Lock()
+_state: Dict[str, Any] = {"started_at": None, "finished_at": None, "items": {}}
+_thread = None
+
+
+def register_warmup(name: str, fn: Callable[[], Dict[str, Any]], required: bool = True) -> None:
+    _WARMUPS.append((name, fn, required))
+
+
+def _run_one(app, name: str, fn: Callable[[], Dict[str, Any]], required: bool, attempts: int) -> bool:
+    with _lock:
+        _state["items"][name] = {**_state["items"].get(name, {}), "status": "running"}
+    started = time.perf_counter()
+    try:
+        with app.app_context():
+            info = fn() or {}
+        item = {"status": "ready", **info}
+    except Exception as e:
+        traceback.print_exc()
+        delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** (attempts - 1)))
+        item = {"status": "failed", "error": str(e), "next_retry_at": time.time() + delay}
+    item["required"] = required
+    item["attempts"] = attempts
+    item["seconds"] = round(time.perf_counter() - started, 3)
+    with _lock:
+        _state["items"][name] = item
+    return item["status"] == "ready"
+
+
+def _run(app) -> None:
+    attempts: Dict[str, int] = {}
+    retry_at: Dict[str, float] = {}
+    for name, fn, required in list(_WARMUPS):
+        attempts[name] = 1
+        if not _run_one(app, name, fn, required, 1):
+            retry_at[name] = _state["items"][name]["next_retry_at"]
+    with _lock:
+        _state["finished_at"] = time.time()
+
+    # 首轮结束后只重试失败项，直到全部就绪
+    warmups = {name: (fn, required) for name, fn, required in _WARMUPS}
+    while retry_at:
+        name = min(retry_at, key=retry_at.get)
+        time.sleep(max(0.0, retry_at.pop(name) - time.time()))
+        attempts[name] += 1
+        fn, required = warmups[name]
+        if not _run_one(app, name, fn, required, attempts[name]):
+            retry_at[name] = _state["items"][name]["next_retry_at"]
+
+
+def start_warmup(app) -> None:
+    """
+    create_app 里调用：后台线程预热，不阻塞启动；进度通过 readiness() 查询。
+    """
+    global _thread
+    with _lock:
+        if _thread is not None:
+            return
+        _state["started_at"] = time.time()
+        _state["items"] = {name: {"status": "pending", "required": required}
+                           for name, _, required in _WARMUPS}
+        _thread = threading.Thread(target=_run, args=(app,), name="warmup", daemon=True)
+    _thread.start()
+
+
+def readiness(names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """
+    names 为空时按 required 项判断整体就绪；指定 names 时只看这些项
+    （如 YARA / Sigma 分开部署的实例各自检查自己的规则集）。
+    """
+    with _lock:
+        items = {name: dict(item) for name, item in _state["items"].items()}
+        started_at = _state["started_at"]
+        finished_at = _state["finished_at"]
+    if names:
+        wanted = set(names)
+        unknown = wanted.difference(items)
+        if unknown:
+            raise ValueError(f"未知的预热项：{', '.join(sorted(unknown))}")
+        gating = [items[name] for name in wanted]
+    else:
+        gating = [item for item in items.values() if item.get("required", True)]
+    ready = started_at is not None and all(item["status"] == "ready" for item in gating)
+    return {
+        "ready": ready,
+        "started_at": started_at,
+        "finished_at": finished_at,
+        "items": items,
+    }
@@ -9,7 +9,7 @@ from flask import Blueprint, jsonify
 
 #for services
 #from src.apps.models.user import User
-from src.apps.utils.database import get_db_connection
+from src.apps.utils.database import get_db_connection, ensure_table
 from sqlalchemy import func,select
 
 #for api
@@ -17,7 +17,7 @@ from src.apps.utils.api_result import ApiResult
 #for utils
 import_lst=[]
 import_lst.append(['Table', 'MetaData','db','Blueprint','jsonify',
-                   'get_db_connection','func',
+                   'get_db_connection','ensure_table','func',
                    'select','ApiResult','exists'])
 
 
@@ -1,9 +1,17 @@
-from src.apps import create_app
+import os
+
+from src.apps import create_app, start_background_tasks
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
 
-app = create_app()
+DEBUG = True
+
+# 导入时只创建 app（供 WSGI 服务器 / flask --app src.run 使用），不启动任务队列和预热
+app = create_app(start_background=False)
 CORS(app)
 
+
 if __name__ == '__main__':
-    app.run(debug=True,port=3000)
\ No newline at end of file
+    # debug 模式下 reloader 父进程只监控文件变更，任务队列只在实际处理请求的子进程里启动
+    if not DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_tasks(app)
+    app.run(debug=DEBUG, port=3000)
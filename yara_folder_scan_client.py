@@ -8,9 +8,6 @@ import json
 import time
 import hashlib
 import argparse
-import tempfile
-import zipfile
-import tarfile
 from pathlib import Path
 from typing import Dict, Any, Iterable, List, Tuple, Optional
 
@@ -22,7 +19,11 @@ import requests
 # ---------------------------
 DEFAULT_RULE_SET = "enabled"          # enabled | all
 DEFAULT_TIMEOUT = (10, 60)            # (connect_timeout, read_timeout)
-MAX_UPLOAD_BYTES = 50 * 1024 * 1024   # 与后端 MAX_SAMPLE_BYTES 对齐（50MB）
+DEFAULT_JOB_TIMEOUT = 3600            # 异步任务模式下等待全部结果的总时长（秒）
+MAX_UPLOAD_BYTES = 512 * 1024 * 1024  # 与后端 MAX_SAMPLE_BYTES 对齐（512MB），批量接口单文件上限
+MAX_LARGE_UPLOAD_BYTES = 64 * 1024 * 1024 * 1024  # 与后端 MAX_LARGE_SAMPLE_BYTES 对齐（64GB），单文件接口分窗扫描
+LARGE_READ_TIMEOUT = 900              # 大文件分窗扫描的读超时下限（后端默认 600 秒截止）
+MAX_ARCHIVE_UPLOAD_BYTES = 1024 * 1024 * 1024  # 与后端 MAX_ARCHIVE_BYTES 对齐（1GB）
 
 
 # ---------------------------
@@ -69,30 +70,6 @@ def iter_files_recursive(root: Path) -> Iterable[Path]:
             yield Path(dirpath) / fn
 
 
-def extract_archive_to_temp(archive_path: Path, temp_dir: Path) -> List[Path]:
-    """
-    解压 zip/tar/tar.gz/tgz 到 temp_dir，返回解压出的文件列表（仅文件，不含目录）
-    """
-    extracted_files: List[Path] = []
-    name = archive_path.name.lower()
-
-    if name.endswith(".zip"):
-        with zipfile.ZipFile(archive_path, "r") as z:
-            z.extractall(temp_dir)
-    elif name.endswith(".tar") or name.endswith(".tar.gz") or name.endswith(".tgz"):
-        mode = "r:gz" if (name.endswith(".tar.gz") or name.endswith(".tgz")) else "r:"
-        with tarfile.open(archive_path, mode) as t:
-            t.extractall(temp_dir)
-    else:
-        return extracted_files
-
-    for p in iter_files_recursive(temp_dir):
-        if p.is_file():
-            extracted_files.append(p)
-
-    return extracted_files
-
-
 def call_yara_scan_api(
     api_url: str,
     file_path: Path,
@@ -122,6 +99,116 @@ def call_yara_scan_api(
     return payload
 
 
+def call_yara_batch_api(
+    api_url: str,
+    file_paths: List[Path],
+    rule_set: str = DEFAULT_RULE_SET,
+    label: str = "",
+    timeout: Tuple[int, int] = DEFAULT_TIMEOUT,
+    labels: Optional[List[str]] = None,
+) -> Iterable[Dict[str, Any]]:
+    """
+    调用后端 /scanSamplesWithYara：一次请求上传多个文件，按行（NDJSON）读取结果。
+    每行对应一个样本，顺序与 file_paths 一致（index 字段）；最后一行为 summary。
+    labels 不为空时与 file_paths 一一对应，作为各文件的 label。
+    """
+    handles = [p.open("rb") for p in file_paths]
+    try:
+        files = [("files", (p.name, fh, "application/octet-stream")) for p, fh in zip(file_paths, handles)]
+        data = [("label", label), ("rule_set", rule_set)] + [("labels", lb) for lb in (labels or [])]
+        with requests.post(api_url, files=files, data=data, timeout=timeout, stream=True) as r:
+            if r.status_code != 200:
+                try:
+                    payload = r.json()
+                except Exception:
+                    payload = {"ok": False, "code": "NON_JSON_RESPONSE", "message": r.text[:2000]}
+                payload["_http_status"] = r.status_code
+                yield payload
+                return
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                payload = json.loads(line)
+                payload["_http_status"] = r.status_code
+                yield payload
+    finally:
+        for fh in handles:
+            fh.close()
+
+
+def call_yara_archive_api(
+    api_url: str,
+    archive_path: Path,
+    rule_set: str = DEFAULT_RULE_SET,
+    label: str = "",
+    timeout: Tuple[int, int] = DEFAULT_TIMEOUT,
+) -> Iterable[Dict[str, Any]]:
+    """
+    调用后端 /scanArchiveWithYara：整个压缩包上传，由后端从解压流逐个成员扫描
+    （嵌套压缩包递归展开），按行（NDJSON）读取每个成员的结果；最后一行为 summary。
+    """
+    with archive_path.open("rb") as f:
+        files = {"file": (archive_path.name, f, "application/octet-stream")}
+        data = {"label": label, "rule_set": rule_set}
+        with requests.post(api_url, files=files, data=data, timeout=timeout, stream=True) as r:
+            if r.status_code != 200:
+                try:
+                    payload = r.json()
+                except Exception:
+                    payload = {"ok": False, "code": "NON_JSON_RESPONSE", "message": r.text[:2000]}
+                payload["_http_status"] = r.status_code
+                yield payload
+                return
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                payload = json.loads(line)
+                payload["_http_status"] = r.status_code
+                yield payload
+
+
+def submit_yara_job(
+    job_api: str,
+    file_path: Path,
+    rule_set: str = DEFAULT_RULE_SET,
+    label: str = "",
+    timeout: Tuple[int, int] = DEFAULT_TIMEOUT,
+) -> Dict[str, Any]:
+    """
+    调用后端 /submitYaraScanJob：上传后立即返回 sample_id，不等待扫描完成。
+    job_api 为后端根地址，例如 http://127.0.0.1:5000
+    """
+    with file_path.open("rb") as f:
+        files = {"file": (file_path.name, f, "application/octet-stream")}
+        data = {"label": label, "rule_set": rule_set}
+        r = requests.post(job_api.rstrip("/") + "/submitYaraScanJob", files=files, data=data, timeout=timeout)
+    try:
+        payload = r.json()
+    except Exception:
+        payload = {"ok": False, "code": "NON_JSON_RESPONSE", "message": r.text[:2000]}
+    payload["_http_status"] = r.status_code
+    return payload
+
+
+def fetch_yara_job_result(
+    job_api: str,
+    sample_id: str,
+    timeout: Tuple[int, int] = DEFAULT_TIMEOUT,
+) -> Optional[Dict[str, Any]]:
+    """
+    调用后端 /yaraScanJobResult/<sample_id>：任务未完成（202）时返回 None。
+    """
+    r = requests.get(job_api.rstrip("/") + "/yaraScanJobResult/" + sample_id, timeout=timeout)
+    if r.status_code == 202:
+        return None
+    try:
+        payload = r.json()
+    except Exception:
+        payload = {"ok": False, "code": "NON_JSON_RESPONSE", "message": r.text[:2000]}
+    payload["_http_status"] = r.status_code
+    return payload
+
+
 def parse_scan_result(payload: Dict[str, Any]) -> Dict[str, Any]:
     """
     从后端返回中提取：命中规则数、命中规则名等
@@ -144,6 +231,9 @@ def parse_scan_result(payload: Dict[str, Any]) -> Dict[str, Any]:
         "rule_set": payload.get("rule_set"),
         "hit_rule_count": len(matches),
         "hit_rule_names": uniq_rule_names,
+        "complete": payload.get("complete"),
+        "unevaluated": payload.get("unevaluated") or [],
+        "windowed": payload.get("windowed", False),
         # 如你想保留原始 matches，可开启下面这行：
         "matches": matches,
         # 调试信息（可选，可能很长，建议裁剪）
@@ -175,7 +265,7 @@ def scan_one_file(
 ) -> Dict[str, Any]:
     rel_path = str(file_path.relative_to(root_dir)).replace("\\", "/")
 
-    # 文件大小预检（跟后端 50MB 限制对齐）
+    # 文件大小预检（跟后端 MAX_LARGE_SAMPLE_BYTES 限制对齐）
     try:
         size = file_path.stat().st_size
     except Exception as e:
@@ -188,11 +278,11 @@ def scan_one_file(
         write_result_json(out_dir, rel_path, result)
         return result
 
-    if size > MAX_UPLOAD_BYTES:
+    if size > MAX_LARGE_UPLOAD_BYTES:
         result = {
             "ok": False,
             "code": "SKIP_TOO_LARGE",
-            "message": f"skip: file size {size} > {MAX_UPLOAD_BYTES} (backend limit)",
+            "message": f"skip: file size {size} > {MAX_LARGE_UPLOAD_BYTES} (backend limit)",
             "rel_path": rel_path,
             "size": size,
         }
@@ -208,6 +298,10 @@ def scan_one_file(
 
     label = f"{label_prefix}{rel_path}" if label_prefix else rel_path
 
+    # 超过 MAX_UPLOAD_BYTES 的文件由后端落盘后分窗扫描，耗时更长
+    if size > MAX_UPLOAD_BYTES:
+        timeout = (timeout[0], max(timeout[1], LARGE_READ_TIMEOUT))
+
     payload = call_yara_scan_api(
         api_url=api_url,
         file_path=file_path,
@@ -237,7 +331,15 @@ def main():
     parser.add_argument("--connect-timeout", type=int, default=DEFAULT_TIMEOUT[0])
     parser.add_argument("--read-timeout", type=int, default=DEFAULT_TIMEOUT[1])
     parser.add_argument("--no-archives", action="store_true", help="不处理压缩包（zip/tar/tgz）")
+    parser.add_argument("--archive-api", default="",
+                        help="压缩包接口URL（可选，默认与 --api 同主机的 /scanArchiveWithYara）")
     parser.add_argument("--label-prefix", default="", help="label 前缀（可选）")
+    parser.add_argument("--batch-api", default="", help="批量接口URL（可选），例如 http://127.0.0.1:5000/scanSamplesWithYara")
+    parser.add_argument("--batch-size", type=int, default=50, help="批量模式下每个请求携带的文件数")
+    parser.add_argument("--job-api", default="", help="异步任务模式（可选）：后端根地址，例如 http://127.0.0.1:5000")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="异步任务模式下轮询结果的间隔（秒）")
+    parser.add_argument("--job-timeout", type=float, default=DEFAULT_JOB_TIMEOUT,
+                        help="异步任务模式下等待全部结果的总时长（秒），超时未完成的任务记为 JOB_TIMEOUT")
     args = parser.parse_args()
 
     root_dir = Path(args.folder).expanduser().resolve()
@@ -250,6 +352,7 @@ def main():
     out_dir.mkdir(parents=True, exist_ok=True)
 
     timeout = (args.connect_timeout, args.read_timeout)
+    archive_api = args.archive_api or (args.api.rsplit("/", 1)[0] + "/scanArchiveWithYara")
 
     summary = {
         "root_dir": str(root_dir),
@@ -270,6 +373,99 @@ def main():
         for r in hit_rules:
             c[r] = int(c.get(r, 0)) + 1
 
+    def account(r: Dict[str, Any]):
+        if r.get("ok"):
+            summary["total_ok"] += 1
+            if r.get("hit_rule_count", 0) > 0:
+                summary["total_hit_files"] += 1
+                bump_rule_counter(r.get("hit_rule_names", []))
+        else:
+            if r.get("code") == "SKIP_TOO_LARGE" or r.get("code") == "FILE_TOO_LARGE":
+                summary["total_skipped_too_large"] += 1
+            else:
+                summary["total_errors"] += 1
+
+    def file_label(fp: Path) -> str:
+        rel_path = str(fp.relative_to(root_dir)).replace("\\", "/")
+        return f"{args.label_prefix}{rel_path}" if args.label_prefix else rel_path
+
+    # 批量模式：攒够 batch_size 个普通文件后一次请求
+    pending: List[Path] = []
+
+    def flush_batch():
+        if not pending:
+            return
+        batch = list(pending)
+        pending.clear()
+        results = {}
+        try:
+            for payload in call_yara_batch_api(args.batch_api, batch, rule_set=args.rule_set,
+                                               label=args.label_prefix, timeout=timeout,
+                                               labels=[file_label(fp) for fp in batch]):
+                if payload.get("summary"):
+                    continue
+                idx = payload.get("index")
+                if isinstance(idx, int) and 0 <= idx < len(batch):
+                    results[idx] = payload
+                else:
+                    # 整个请求失败：本批文件都记同一个错误
+                    for i in range(len(batch)):
+                        results.setdefault(i, payload)
+        except (requests.RequestException, ValueError) as e:
+            # 连接失败 / 流中途断开：已收到的结果保留，其余文件记为请求失败
+            failed = {"ok": False, "code": "REQUEST_FAILED", "message": str(e)}
+            for i in range(len(batch)):
+                results.setdefault(i, failed)
+        for i, fp in enumerate(batch):
+            rel_path = str(fp.relative_to(root_dir)).replace("\\", "/")
+            payload = results.get(i) or {"ok": False, "code": "NO_RESULT", "message": "batch response missing item"}
+            parsed = parse_scan_result(payload)
+            parsed.update({
+                "rel_path": rel_path,
+                "abs_path": str(fp),
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            })
+            write_result_json(out_dir, rel_path, parsed)
+            account(parsed)
+
+    # 异步任务模式：先全部提交，最后统一轮询结果
+    submitted: List[Tuple[str, Path]] = []
+
+    def write_parsed(fp: Path, payload: Dict[str, Any]):
+        rel_path = str(fp.relative_to(root_dir)).replace("\\", "/")
+        parsed = parse_scan_result(payload)
+        parsed.update({
+            "rel_path": rel_path,
+            "abs_path": str(fp),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+        write_result_json(out_dir, rel_path, parsed)
+        account(parsed)
+
+    def collect_jobs():
+        waiting = list(submitted)
+        submitted.clear()
+        deadline = time.monotonic() + args.job_timeout
+        while waiting:
+            if time.monotonic() >= deadline:
+                for sample_id, fp in waiting:
+                    write_parsed(fp, {"ok": False, "code": "JOB_TIMEOUT", "sample_id": sample_id,
+                                      "message": f"job not finished within {args.job_timeout}s"})
+                break
+            still: List[Tuple[str, Path]] = []
+            for sample_id, fp in waiting:
+                try:
+                    payload = fetch_yara_job_result(args.job_api, sample_id, timeout=timeout)
+                except requests.RequestException as e:
+                    payload = {"ok": False, "code": "REQUEST_FAILED", "message": str(e)}
+                if payload is None:
+                    still.append((sample_id, fp))
+                    continue
+                write_parsed(fp, payload)
+            waiting = still
+            if waiting:
+                time.sleep(args.poll_interval)
+
     # 遍历
     for p in iter_files_recursive(root_dir):
         if not p.is_file():
@@ -277,90 +473,92 @@ def main():
 
         summary["total_files_seen"] += 1
 
-        # 处理压缩包：解压 -> 扫描解压文件 -> 立刻删除临时解压文件
+        # 处理压缩包：整包上传，由后端从解压流扫描各成员（含嵌套压缩包），本地不解压
         if (not args.no_archives) and is_archive(p):
             rel_arch = str(p.relative_to(root_dir)).replace("\\", "/")
-            # 给压缩包也写一个“容器结果”文件（可选）
             container_note = {
                 "ok": True,
                 "code": "ARCHIVE_CONTAINER",
-                "message": f"archive detected, will extract+scan then delete extracted files: {p.name}",
+                "message": f"archive detected, members scanned server-side: {p.name}",
                 "rel_path": rel_arch,
                 "abs_path": str(p),
                 "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
             }
-            write_result_json(out_dir, rel_arch + ".__archive__", container_note)
-
-            with tempfile.TemporaryDirectory(prefix="yara_extract_") as td:
-                temp_dir = Path(td)
-                try:
-                    extracted = extract_archive_to_temp(p, temp_dir)
-                except Exception as e:
-                    err = {
-                        "ok": False,
-                        "code": "ARCHIVE_EXTRACT_FAILED",
-                        "message": str(e),
-                        "rel_path": rel_arch,
-                        "abs_path": str(p),
-                        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                    }
-                    write_result_json(out_dir, rel_arch + ".__archive__", err)
-                    summary["total_errors"] += 1
-                    continue
 
-                # 扫描解压出来的文件（注意：这些文件不在 root_dir 下，所以 rel_path 用 “压缩包相对路径::解压相对路径”）
-                for ep in extracted:
+            try:
+                archive_size = p.stat().st_size
+            except Exception:
+                archive_size = 0
+            if archive_size > MAX_ARCHIVE_UPLOAD_BYTES:
+                container_note.update({
+                    "ok": False,
+                    "code": "SKIP_TOO_LARGE",
+                    "message": f"skip: archive size {archive_size} > {MAX_ARCHIVE_UPLOAD_BYTES} (backend limit)",
+                })
+                write_result_json(out_dir, rel_arch + ".__archive__", container_note)
+                summary["total_skipped_too_large"] += 1
+                continue
+
+            label = (args.label_prefix + rel_arch) if args.label_prefix else rel_arch
+            try:
+                for payload in call_yara_archive_api(archive_api, p, rule_set=args.rule_set,
+                                                     label=label, timeout=timeout):
+                    if payload.get("summary"):
+                        container_note["archive_summary"] = payload
+                        continue
+                    member = payload.get("member")
+                    if not member:
+                        # 整个压缩包读取失败 / 请求失败
+                        container_note.update({"ok": False, "code": payload.get("code"),
+                                               "message": payload.get("message")})
+                        summary["total_errors"] += 1
+                        continue
+
+                    # 成员结果 rel_path 用 “压缩包相对路径::成员路径”（嵌套成员同样以 :: 连接）
+                    fake_rel = rel_arch + "::" + member
                     summary["total_scanned"] += 1
-                    fake_rel = rel_arch + "::" + str(ep.relative_to(temp_dir)).replace("\\", "/")
-
-                    # 尺寸检查（解压文件也可能很大）
-                    try:
-                        if ep.stat().st_size > MAX_UPLOAD_BYTES:
-                            result = {
-                                "ok": False,
-                                "code": "SKIP_TOO_LARGE",
-                                "message": f"skip: file size {ep.stat().st_size} > {MAX_UPLOAD_BYTES} (backend limit)",
-                                "rel_path": fake_rel,
-                                "abs_path": str(ep),
-                                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                            }
-                            write_result_json(out_dir, fake_rel, result)
-                            summary["total_skipped_too_large"] += 1
-                            continue
-                    except Exception:
-                        pass
-
-                    payload = call_yara_scan_api(
-                        api_url=args.api,
-                        file_path=ep,
-                        rule_set=args.rule_set,
-                        label=(args.label_prefix + fake_rel) if args.label_prefix else fake_rel,
-                        timeout=timeout,
-                    )
                     parsed = parse_scan_result(payload)
                     parsed.update({
                         "rel_path": fake_rel,
-                        "abs_path": str(ep),
+                        "abs_path": str(p),
+                        "depth": payload.get("depth"),
                         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
                     })
                     write_result_json(out_dir, fake_rel, parsed)
+                    account(parsed)
+            except (requests.RequestException, ValueError) as e:
+                container_note.update({"ok": False, "code": "REQUEST_FAILED", "message": str(e)})
+                summary["total_errors"] += 1
 
-                    if parsed.get("ok"):
-                        summary["total_ok"] += 1
-                        if parsed.get("hit_rule_count", 0) > 0:
-                            summary["total_hit_files"] += 1
-                            bump_rule_counter(parsed.get("hit_rule_names", []))
-                    else:
-                        if parsed.get("code") == "FILE_TOO_LARGE" or parsed.get("code") == "SKIP_TOO_LARGE":
-                            summary["total_skipped_too_large"] += 1
-                        else:
-                            summary["total_errors"] += 1
-
-            # TemporaryDirectory 会自动删除解压出来的所有文件：满足“扫描完立即删除”
+            write_result_json(out_dir, rel_arch + ".__archive__", container_note)
             continue
 
         # 普通文件扫描
         summary["total_scanned"] += 1
+        if args.job_api:
+            try:
+                payload = submit_yara_job(args.job_api, p, rule_set=args.rule_set,
+                                          label=file_label(p), timeout=timeout)
+            except requests.RequestException as e:
+                payload = {"ok": False, "code": "REQUEST_FAILED", "message": str(e)}
+            if payload.get("ok") and payload.get("sample_id"):
+                submitted.append((payload["sample_id"], p))
+            else:
+                write_parsed(p, payload)
+            continue
+
+        if args.batch_api:
+            try:
+                size = p.stat().st_size
+            except Exception:
+                size = 0
+            if size <= MAX_UPLOAD_BYTES:
+                pending.append(p)
+                if len(pending) >= args.batch_size:
+                    flush_batch()
+                continue
+            # 超过批量接口上限的大文件走单文件接口（后端分窗扫描）
+
         r = scan_one_file(
             api_url=args.api,
             root_dir=root_dir,
@@ -370,17 +568,10 @@ def main():
             timeout=timeout,
             label_prefix=args.label_prefix,
         )
+        account(r)
 
-        if r.get("ok"):
-            summary["total_ok"] += 1
-            if r.get("hit_rule_count", 0) > 0:
-                summary["total_hit_files"] += 1
-                bump_rule_counter(r.get("hit_rule_names", []))
-        else:
-            if r.get("code") == "SKIP_TOO_LARGE" or r.get("code") == "FILE_TOO_LARGE":
-                summary["total_skipped_too_large"] += 1
-            else:
-                summary["total_errors"] += 1
+    flush_batch()
+    collect_jobs()
 
     summary["finished_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
 